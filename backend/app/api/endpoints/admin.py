@@ -6,7 +6,7 @@
 from fastapi import APIRouter, HTTPException, Depends, Request
 from sqlalchemy.orm import Session
 from sqlalchemy import func
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from pydantic import BaseModel
 
 from ...core.database import get_db
@@ -14,6 +14,9 @@ from ...models.image import Image
 from ...models.faiss_index import FaissIndexInfo
 from ...models.operation_log import OperationLog
 from ...services.faiss_service import FaissService
+from ...services.neighbor_table import NeighborTable
+from ...services.bulk_ingest import BulkIngestor
+from ...services.derivatives import DerivativeService
 from ...utils.logger import api_logger
 
 router = APIRouter()
@@ -29,6 +32,7 @@ def get_faiss_service(request: Request) -> FaissService:
 
 @router.get("/dashboard")
 async def get_dashboard_stats(
+    request: Request,
     db: Session = Depends(get_db),
     faiss_service: FaissService = Depends(get_faiss_service)
 ):
@@ -40,6 +44,24 @@ async def get_dashboard_stats(
         # Faiss索引信息
         faiss_info = faiss_service.get_index_info()
         
+        # 模型推理批处理统计
+        model_service = getattr(request.app.state, 'model_service', None)
+        model_info = model_service.get_stats() if model_service is not None else None
+        
+        # 特征向量缓存统计
+        embedding_cache = getattr(request.app.state, 'embedding_cache', None)
+        cache_info = embedding_cache.get_stats() if embedding_cache is not None else None
+        result_cache = getattr(request.app.state, 'result_cache', None)
+        result_cache_info = result_cache.get_stats() if result_cache is not None else None
+        neighbor_table = getattr(request.app.state, 'neighbor_table', None)
+        neighbor_table_info = neighbor_table.get_stats() if neighbor_table is not None else None
+        indexing_queue = getattr(request.app.state, 'indexing_queue', None)
+        indexing_queue_info = indexing_queue.get_stats() if indexing_queue is not None else None
+        derivative_service = getattr(request.app.state, 'derivative_service', None)
+        derivatives_info = derivative_service.get_stats() if derivative_service is not None else None
+        url_fetcher = getattr(request.app.state, 'url_fetcher', None)
+        url_fetcher_info = url_fetcher.get_stats() if url_fetcher is not None else None
+        
         # 存储使用情况
         total_size = db.query(func.sum(Image.file_size)).filter(Image.is_active == True).scalar() or 0
         
@@ -50,7 +72,14 @@ async def get_dashboard_stats(
                     "total_images": total_images,
                     "total_storage_mb": round(total_size / 1024 / 1024, 2)
                 },
-                "faiss_index": faiss_info
+                "faiss_index": faiss_info,
+                "model_service": model_info,
+                "embedding_cache": cache_info,
+                "result_cache": result_cache_info,
+                "neighbor_table": neighbor_table_info,
+                "indexing_queue": indexing_queue_info,
+                "derivatives": derivatives_info,
+                "url_fetcher": url_fetcher_info
             }
         }
         
@@ -189,16 +218,39 @@ async def restart_system():
         raise HTTPException(status_code=500, detail=f"系统重启失败: {str(e)}")
 
 
+@router.get("/system/cache/stats")
+async def get_cache_stats(request: Request):
+    """获取缓存统计信息"""
+    embedding_cache = getattr(request.app.state, 'embedding_cache', None)
+    result_cache = getattr(request.app.state, 'result_cache', None)
+    return {
+        "success": True,
+        "data": {
+            "embedding_cache": embedding_cache.get_stats() if embedding_cache is not None else None,
+            "result_cache": result_cache.get_stats() if result_cache is not None else None
+        }
+    }
+
+
 @router.post("/system/cache/clear")
-async def clear_system_cache():
-    """清理系统缓存"""
+async def clear_system_cache(request: Request, include_disk: bool = False):
+    """清理系统缓存（搜索结果缓存和特征向量缓存，include_disk 时同时清理磁盘层）"""
     try:
-        # 这里应该实现缓存清理逻辑
-        api_logger.info("清理系统缓存")
+        cleared = {}
+        result_cache = getattr(request.app.state, 'result_cache', None)
+        if result_cache is not None:
+            cleared["result_cache"] = result_cache.clear()
+        
+        embedding_cache = getattr(request.app.state, 'embedding_cache', None)
+        if embedding_cache is not None:
+            cleared["embedding_cache"] = embedding_cache.clear(include_disk=include_disk)
+        
+        api_logger.info(f"清理系统缓存: {cleared}")
         
         return {
             "success": True,
-            "message": "系统缓存清理完成"
+            "message": "系统缓存清理完成",
+            "data": {"cleared": cleared}
         }
         
     except Exception as e:
@@ -208,23 +260,277 @@ async def clear_system_cache():
 
 @router.post("/index/rebuild")
 async def rebuild_faiss_index(
+    index_type: Optional[str] = None,
     faiss_service: FaissService = Depends(get_faiss_service)
 ):
-    """重建Faiss索引"""
+    """重建Faiss索引（后台执行，重建期间旧索引继续提供搜索）"""
     try:
-        # 这里应该实现异步重建索引的逻辑
-        api_logger.info("开始重建Faiss索引")
+        api_logger.info(f"开始重建Faiss索引: {index_type or '当前配置类型'}")
+        progress = await faiss_service.start_rebuild(index_type)
         
         return {
             "success": True,
-            "message": "索引重建任务已启动，请稍后查看进度"
+            "message": "索引重建任务已启动，请稍后查看进度",
+            "data": progress
         }
-        
+    
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         api_logger.error(f"重建索引失败: {e}")
         raise HTTPException(status_code=500, detail=f"重建索引失败: {str(e)}")
 
 
+@router.get("/index/rebuild/status")
+async def get_rebuild_status(
+    faiss_service: FaissService = Depends(get_faiss_service)
+):
+    """获取索引重建进度"""
+    try:
+        return {
+            "success": True,
+            "data": faiss_service.get_rebuild_status()
+        }
+        
+    except Exception as e:
+        api_logger.error(f"获取重建进度失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取重建进度失败: {str(e)}")
+
+
+def get_neighbor_table(request: Request) -> NeighborTable:
+    """获取预计算近邻表"""
+    neighbor_table = getattr(request.app.state, 'neighbor_table', None)
+    if neighbor_table is None:
+        raise HTTPException(status_code=400, detail="近邻表未启用")
+    return neighbor_table
+
+
+@router.post("/index/neighbors/rebuild")
+async def rebuild_neighbor_table(
+    neighbor_table: NeighborTable = Depends(get_neighbor_table)
+):
+    """全量重新生成预计算近邻表（后台执行，生成期间继续使用旧表）"""
+    try:
+        api_logger.info("开始生成预计算近邻表")
+        progress = await neighbor_table.start_build()
+        
+        return {
+            "success": True,
+            "message": "近邻表生成任务已启动，请稍后查看进度",
+            "data": progress
+        }
+    
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        api_logger.error(f"生成近邻表失败: {e}")
+        raise HTTPException(status_code=500, detail=f"生成近邻表失败: {str(e)}")
+
+
+@router.get("/index/neighbors/status")
+async def get_neighbor_table_status(
+    neighbor_table: NeighborTable = Depends(get_neighbor_table)
+):
+    """获取预计算近邻表状态"""
+    try:
+        return {
+            "success": True,
+            "data": neighbor_table.get_stats()
+        }
+        
+    except Exception as e:
+        api_logger.error(f"获取近邻表状态失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取近邻表状态失败: {str(e)}")
+
+
+class BulkIngestRequest(BaseModel):
+    """批量导入请求"""
+    source_dir: Optional[str] = None  # 服务器上的图片目录，必须位于 ingest.ingest_root 内
+    manifest: Optional[str] = None  # 服务器上的清单文件，每行一个图片路径，清单及其中的路径都必须位于 ingest.ingest_root 内
+    job_id: Optional[str] = None  # 恢复已有任务
+
+
+def get_bulk_ingestor(request: Request) -> BulkIngestor:
+    """获取批量导入服务"""
+    if not hasattr(request.app.state, 'bulk_ingestor'):
+        raise HTTPException(status_code=500, detail="批量导入服务未初始化")
+    return request.app.state.bulk_ingestor
+
+
+@router.post("/ingest/bulk")
+async def start_bulk_ingest(
+    body: BulkIngestRequest,
+    bulk_ingestor: BulkIngestor = Depends(get_bulk_ingestor)
+):
+    """启动或恢复批量导入任务（后台执行）"""
+    try:
+        api_logger.info(f"开始批量导入: {body.job_id or body.source_dir or body.manifest}")
+        progress = await bulk_ingestor.start(body.source_dir, body.manifest, body.job_id)
+        
+        return {
+            "success": True,
+            "message": "批量导入任务已启动，请稍后查看进度",
+            "data": progress
+        }
+    
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        api_logger.error(f"批量导入失败: {e}")
+        raise HTTPException(status_code=500, detail=f"批量导入失败: {str(e)}")
+
+
+@router.get("/ingest/bulk/status")
+async def get_bulk_ingest_status(
+    bulk_ingestor: BulkIngestor = Depends(get_bulk_ingestor)
+):
+    """获取当前批量导入任务进度"""
+    return {
+        "success": True,
+        "data": bulk_ingestor.get_status()
+    }
+
+
+@router.get("/ingest/bulk/jobs")
+async def list_bulk_ingest_jobs(
+    bulk_ingestor: BulkIngestor = Depends(get_bulk_ingestor)
+):
+    """获取全部批量导入任务"""
+    try:
+        return {
+            "success": True,
+            "data": bulk_ingestor.list_jobs()
+        }
+        
+    except Exception as e:
+        api_logger.error(f"获取导入任务失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取导入任务失败: {str(e)}")
+
+
+@router.post("/ingest/bulk/cancel")
+async def cancel_bulk_ingest(
+    bulk_ingestor: BulkIngestor = Depends(get_bulk_ingestor)
+):
+    """取消批量导入任务，当前批次完成后停止，可用 job_id 恢复"""
+    if not bulk_ingestor.cancel():
+        raise HTTPException(status_code=409, detail="没有进行中的批量导入任务")
+    return {
+        "success": True,
+        "message": "已请求取消，当前批次完成后停止",
+        "data": bulk_ingestor.get_status()
+    }
+
+
+@router.post("/ingest/retry-failed")
+async def retry_failed_indexing(request: Request):
+    """重新处理建索引失败的图片"""
+    indexing_queue = getattr(request.app.state, 'indexing_queue', None)
+    if indexing_queue is None:
+        raise HTTPException(status_code=500, detail="建索引队列未初始化")
+    try:
+        count = await indexing_queue.retry_failed()
+        return {
+            "success": True,
+            "message": f"已重新提交{count}张图片",
+            "data": {"count": count}
+        }
+        
+    except Exception as e:
+        api_logger.error(f"重新提交建索引失败: {e}")
+        raise HTTPException(status_code=500, detail=f"重新提交失败: {str(e)}")
+
+
+def get_derivative_service(request: Request) -> DerivativeService:
+    """获取派生图片服务"""
+    derivative_service = getattr(request.app.state, 'derivative_service', None)
+    if derivative_service is None:
+        raise HTTPException(status_code=400, detail="派生图片服务未启用")
+    return derivative_service
+
+
+@router.post("/derivatives/backfill")
+async def backfill_derivatives(
+    derivative_service: DerivativeService = Depends(get_derivative_service)
+):
+    """为缺少缩略图或分析副本的图片补齐派生文件（后台执行）"""
+    try:
+        api_logger.info("开始回填派生图片")
+        progress = derivative_service.start_backfill()
+        
+        return {
+            "success": True,
+            "message": "派生图片回填任务已启动，请稍后查看进度",
+            "data": progress
+        }
+    
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        api_logger.error(f"回填派生图片失败: {e}")
+        raise HTTPException(status_code=500, detail=f"回填派生图片失败: {str(e)}")
+
+
+@router.get("/derivatives/status")
+async def get_derivatives_status(
+    derivative_service: DerivativeService = Depends(get_derivative_service)
+):
+    """获取派生图片生成统计和回填进度"""
+    try:
+        return {
+            "success": True,
+            "data": derivative_service.get_stats()
+        }
+        
+    except Exception as e:
+        api_logger.error(f"获取派生图片状态失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取派生图片状态失败: {str(e)}")
+
+
+@router.get("/index/snapshots")
+async def list_index_snapshots(
+    faiss_service: FaissService = Depends(get_faiss_service)
+):
+    """获取索引快照列表"""
+    try:
+        return {
+            "success": True,
+            "data": faiss_service.list_snapshots()
+        }
+        
+    except Exception as e:
+        api_logger.error(f"获取索引快照失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取索引快照失败: {str(e)}")
+
+
+@router.post("/index/rollback")
+async def rollback_faiss_index(
+    version: Optional[str] = None,
+    faiss_service: FaissService = Depends(get_faiss_service)
+):
+    """回滚索引到指定快照，默认回滚到上一个快照；快照之后入库的图片重置为待建索引，由后台队列补做"""
+    try:
+        api_logger.warning(f"回滚Faiss索引: {version or '上一个快照'}")
+        result = await faiss_service.rollback(version)
+        
+        return {
+            "success": True,
+            "message": f"索引已回滚到快照 {result['version']}",
+            "data": result
+        }
+    
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        api_logger.error(f"回滚索引失败: {e}")
+        raise HTTPException(status_code=500, detail=f"回滚索引失败: {str(e)}")
+
+
 @router.get("/logs")
 async def get_operation_logs(
     page: int = 1,
@@ -3,19 +3,22 @@
 提供图片上传、查看、删除等功能
 """
 
+import asyncio
 from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form, Request, Query
 from sqlalchemy.orm import Session
 from typing import List, Optional
-import os
-import uuid
-import hashlib
-from PIL import Image as PILImage
-import io
 
 from ...core.database import get_db
-from ...models.image import Image
+from ...models.image import Image, INDEX_STATUS_PENDING
 from ...services.model_service import ModelService
 from ...services.faiss_service import FaissService
+from ...services.feature_store import FeatureStore
+from ...services.embedding_cache import EmbeddingCache
+from ...services.image_storage import (
+    FileTooLargeError, commit_temp_file, discard_temp_file, probe_image, stream_to_temp_file
+)
+from ...services.indexing_queue import IndexingQueue
+from ...services.derivatives import DerivativeService
 from ...core.config import get_settings
 from ...utils.logger import api_logger
 
@@ -37,28 +40,24 @@ def get_faiss_service(request: Request) -> FaissService:
     return request.app.state.faiss_service
 
 
-def calculate_file_hash(file_content: bytes) -> str:
-    """计算文件MD5哈希值"""
-    return hashlib.md5(file_content).hexdigest()
+def get_feature_store(request: Request) -> Optional[FeatureStore]:
+    """获取特征存储（未启用时为None）"""
+    return getattr(request.app.state, 'feature_store', None)
 
 
-def save_uploaded_file(file_content: bytes, filename: str) -> str:
-    """保存上传的文件"""
-    # 确保上传目录存在
-    upload_dir = settings.storage.upload_dir
-    if not os.path.exists(upload_dir):
-        os.makedirs(upload_dir, exist_ok=True)
-    
-    # 生成唯一文件名
-    file_ext = os.path.splitext(filename)[1].lower()
-    unique_filename = f"{uuid.uuid4().hex}{file_ext}"
-    file_path = os.path.join(upload_dir, unique_filename)
-    
-    # 保存文件
-    with open(file_path, 'wb') as f:
-        f.write(file_content)
-    
-    return file_path, unique_filename
+def get_embedding_cache(request: Request) -> Optional[EmbeddingCache]:
+    """获取特征向量缓存（未启用时为None）"""
+    return getattr(request.app.state, 'embedding_cache', None)
+
+
+def get_indexing_queue(request: Request) -> Optional[IndexingQueue]:
+    """获取后台建索引队列（未启动时为None）"""
+    return getattr(request.app.state, 'indexing_queue', None)
+
+
+def get_derivative_service(request: Request) -> Optional[DerivativeService]:
+    """获取派生图片服务（未启用时为None）"""
+    return getattr(request.app.state, 'derivative_service', None)
 
 
 @router.post("/upload")
@@ -66,26 +65,39 @@ async def upload_image(
     file: UploadFile = File(...),
     description: Optional[str] = Form(None),
     tags: Optional[str] = Form(None),
+    async_index: Optional[bool] = Form(None),
     db: Session = Depends(get_db),
     model_service: ModelService = Depends(get_model_service),
-    faiss_service: FaissService = Depends(get_faiss_service)
+    faiss_service: FaissService = Depends(get_faiss_service),
+    feature_store: Optional[FeatureStore] = Depends(get_feature_store),
+    embedding_cache: Optional[EmbeddingCache] = Depends(get_embedding_cache),
+    indexing_queue: Optional[IndexingQueue] = Depends(get_indexing_queue),
+    derivative_service: Optional[DerivativeService] = Depends(get_derivative_service)
 ):
-    """上传图片"""
+    """
+    上传图片
+    
+    async_index 为真时（默认取 ingest.async_upload）只保存文件和记录并立即返回 pending 状态，
+    由后台队列提取特征并写入索引，可通过 /images/{image_id}/index-status 查询进度。
+    
+    文件分块写入临时文件并同时计算哈希，不在内存中保留完整内容；
+    图片只在特征提取时从磁盘解码一次，读取尺寸只解析文件头。
+    缩略图和分析副本在记录提交后由派生图片服务在后台生成。
+    """
+    temp_path = None
     try:
         # 验证文件类型
         if not file.content_type or not file.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="文件必须是图片格式")
         
-        # 读取文件内容
-        file_content = await file.read()
-        
-        # 验证文件大小
-        if len(file_content) > settings.storage.max_file_size:
+        # 分块接收文件，超过大小限制时立即中止
+        try:
+            temp_path, file_size, file_hash = await asyncio.get_event_loop().run_in_executor(
+                None, stream_to_temp_file, file.file, settings.storage.max_file_size
+            )
+        except FileTooLargeError:
             raise HTTPException(status_code=400, detail="文件大小超过限制")
         
-        # 计算文件哈希
-        file_hash = calculate_file_hash(file_content)
-        
         # 检查是否已存在相同文件
         existing_image = db.query(Image).filter(Image.hash_value == file_hash).first()
         if existing_image and existing_image.is_active:
@@ -96,28 +108,59 @@ async def upload_image(
             }
         
         # 获取图片信息
-        try:
-            with PILImage.open(io.BytesIO(file_content)) as img:
-                width, height = img.size
-                format_name = img.format.lower() if img.format else 'unknown'
-        except Exception as e:
-            api_logger.warning(f"获取图片信息失败: {e}")
-            width = height = None
-            format_name = 'unknown'
+        width, height, format_name = probe_image(temp_path)
+        if width is None:
+            api_logger.warning(f"获取图片信息失败: {file.filename}")
         
         # 保存文件
-        file_path, unique_filename = save_uploaded_file(file_content, file.filename)
+        file_path, unique_filename = commit_temp_file(temp_path, file_hash, file.filename)
+        temp_path = None
+        
+        if async_index is None:
+            async_index = settings.ingest.async_upload
+        if async_index and indexing_queue is not None:
+            # 两阶段上传：先提交记录，特征提取和建索引在后台批量完成
+            image_record = Image(
+                filename=unique_filename,
+                original_name=file.filename,
+                file_path=file_path,
+                file_size=file_size,
+                width=width,
+                height=height,
+                format=format_name,
+                hash_value=file_hash,
+                description=description,
+                tags=tags.split(',') if tags else None,
+                index_status=INDEX_STATUS_PENDING
+            )
+            db.add(image_record)
+            db.commit()
+            indexing_queue.submit(image_record.id)
+            if derivative_service is not None:
+                derivative_service.submit(file_path, unique_filename)
+            
+            api_logger.info(f"图片已上传，等待建索引: {file.filename} -> {unique_filename}")
+            
+            return {
+                "success": True,
+                "message": "图片上传成功，正在后台建立索引",
+                "data": image_record.to_dict()
+            }
         
-        # 提取特征
-        api_logger.info(f"开始提取图片特征: {file.filename}")
-        features = await model_service.extract_features(file_content)
+        # 提取特征（刚被搜索过的相同图片直接复用缓存的向量）
+        features = await embedding_cache.get(file_hash) if embedding_cache is not None else None
+        if features is None:
+            api_logger.info(f"开始提取图片特征: {file.filename}")
+            features = await model_service.extract_features(file_path)
+            if embedding_cache is not None:
+                await embedding_cache.put(file_hash, features)
         
         # 创建数据库记录
         image_record = Image(
             filename=unique_filename,
             original_name=file.filename,
             file_path=file_path,
-            file_size=len(file_content),
+            file_size=file_size,
             width=width,
             height=height,
             format=format_name,
@@ -129,12 +172,18 @@ async def upload_image(
         db.add(image_record)
         db.flush()  # 获取ID但不提交
         
+        # 持久化原始特征，重建索引时无需重新推理
+        if feature_store is not None:
+            await feature_store.add([image_record.id], features)
+        
         # 添加到Faiss索引
         faiss_id = await faiss_service.add_vector(features, image_record.id)
         image_record.faiss_id = faiss_id
         
         # 提交事务
         db.commit()
+        if derivative_service is not None:
+            derivative_service.submit(file_path, unique_filename)
         
         api_logger.info(f"图片上传成功: {file.filename} -> {unique_filename}")
         
@@ -151,6 +200,9 @@ async def upload_image(
         db.rollback()
         api_logger.error(f"图片上传失败: {e}")
         raise HTTPException(status_code=500, detail=f"上传失败: {str(e)}")
+    finally:
+        # 重复文件或处理失败时删除未移动的临时文件
+        discard_temp_file(temp_path)
 
 
 @router.get("/list")
@@ -191,6 +243,49 @@ async def list_images(
         raise HTTPException(status_code=500, detail=f"获取图片列表失败: {str(e)}")
 
 
+@router.get("/indexing/stats")
+async def get_indexing_stats(
+    indexing_queue: Optional[IndexingQueue] = Depends(get_indexing_queue)
+):
+    """获取后台建索引队列统计"""
+    return {
+        "success": True,
+        "data": indexing_queue.get_stats() if indexing_queue is not None else None
+    }
+
+
+@router.get("/{image_id}/index-status")
+async def get_image_index_status(
+    image_id: int,
+    db: Session = Depends(get_db)
+):
+    """获取图片的建索引状态"""
+    try:
+        image = db.query(Image).filter(
+            Image.id == image_id,
+            Image.is_active == True
+        ).first()
+        
+        if not image:
+            raise HTTPException(status_code=404, detail="图片不存在")
+        
+        return {
+            "success": True,
+            "data": {
+                "image_id": image.id,
+                "index_status": image.index_status,
+                "index_attempts": image.index_attempts,
+                "index_error": image.index_error
+            }
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        api_logger.error(f"获取建索引状态失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取建索引状态失败: {str(e)}")
+
+
 @router.get("/{image_id}")
 async def get_image(
     image_id: int,
@@ -221,7 +316,8 @@ async def get_image(
 @router.delete("/{image_id}")
 async def delete_image(
     image_id: int,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    faiss_service: FaissService = Depends(get_faiss_service)
 ):
     """删除图片"""
     try:
@@ -233,16 +329,17 @@ async def delete_image(
         if not image:
             raise HTTPException(status_code=404, detail="图片不存在")
         
-        # 标记为删除（软删除）
+        # 先提交软删除再移除向量：后台索引任务此后写入的向量会在标记已索引时被补删
         image.is_active = False
         db.commit()
         
         # 从Faiss索引中移除图片特征
         try:
-            faiss_service.remove_image(image_id)
+            await faiss_service.remove_image(image_id)
+            image.faiss_id = None
+            db.commit()
         except Exception as e:
-            logger.warning(f"从索引中移除图片失败: {e}")
-        # await faiss_service.remove_vector(image_id)
+            api_logger.warning(f"从索引中移除图片失败: {e}")
         
         api_logger.info(f"图片删除成功: {image.filename}")
         
@@ -6,9 +6,11 @@
 from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form, Request
 from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from typing import List, Optional, Tuple, Union
+import asyncio
+import hashlib
 import time
-import httpx
+import numpy as np
 from PIL import Image as PILImage
 import io
 
@@ -17,6 +19,14 @@ from ...models.image import Image
 
 from ...services.model_service import ModelService
 from ...services.faiss_service import FaissService
+from ...services.feature_store import FeatureStore
+from ...services.embedding_cache import EmbeddingCache
+from ...services.result_cache import SearchResultCache
+from ...services.neighbor_table import NeighborTable
+from ...services.url_fetcher import FetchError, UrlFetcher
+from ...services.image_storage import (
+    FileTooLargeError, discard_temp_file, stream_to_temp_file
+)
 from ...core.config import get_settings
 from ...utils.logger import api_logger
 
@@ -38,16 +48,177 @@ def get_faiss_service(request: Request) -> FaissService:
     return request.app.state.faiss_service
 
 
+def get_feature_store(request: Request) -> Optional[FeatureStore]:
+    """获取特征存储（未启用时为None）"""
+    return getattr(request.app.state, 'feature_store', None)
+
+
+def get_embedding_cache(request: Request) -> Optional[EmbeddingCache]:
+    """获取特征向量缓存（未启用时为None）"""
+    return getattr(request.app.state, 'embedding_cache', None)
+
+
+def get_result_cache(request: Request) -> Optional[SearchResultCache]:
+    """获取搜索结果缓存（未启用时为None）"""
+    return getattr(request.app.state, 'result_cache', None)
+
+
+def get_url_fetcher(request: Request) -> UrlFetcher:
+    """获取图片URL下载服务"""
+    if not hasattr(request.app.state, 'url_fetcher'):
+        raise HTTPException(status_code=500, detail="下载服务未初始化")
+    return request.app.state.url_fetcher
+
+
+def get_neighbor_table(request: Request) -> Optional[NeighborTable]:
+    """获取预计算近邻表（未启用时为None）"""
+    return getattr(request.app.state, 'neighbor_table', None)
+
+
+async def extract_query_features(
+    image_input: Union[str, bytes],
+    db: Session,
+    model_service: ModelService,
+    embedding_cache: Optional[EmbeddingCache],
+    feature_store: Optional[FeatureStore],
+    content_hash: Optional[str] = None
+) -> np.ndarray:
+    """
+    提取查询图片特征
+    
+    相同内容的图片依次复用缓存中的向量、已入库图片的存储向量，都没有时才运行模型。
+    image_input 为文件路径时需同时传入 content_hash。
+    """
+    if embedding_cache is None and feature_store is None:
+        return await model_service.extract_features(image_input)
+    
+    content_hash = content_hash or hashlib.md5(image_input).hexdigest()
+    features = None
+    if embedding_cache is not None:
+        features = await embedding_cache.get(content_hash)
+        if features is not None:
+            return features
+    
+    # 查询图片与已入库图片内容相同时直接使用存储的向量（不依赖特征缓存是否启用）
+    if feature_store is not None:
+        existing_image = db.query(Image.id).filter(
+            Image.hash_value == content_hash,
+            Image.is_active == True
+        ).first()
+        if existing_image:
+            vectors, found = feature_store.get([existing_image.id])
+            if found[0]:
+                features = vectors[0]
+                if embedding_cache is not None:
+                    embedding_cache.record_store_hit()
+    
+    if features is None:
+        features = await model_service.extract_features(image_input)
+    
+    if embedding_cache is not None:
+        await embedding_cache.put(content_hash, features)
+    return features
+
+
+def build_search_results(db: Session, hits: List[Tuple[int, float]]) -> List[dict]:
+    """按搜索结果顺序查询图片详情，跳过已停用的图片"""
+    results = []
+    if not hits:
+        return results
+    
+    images = db.query(Image).filter(
+        Image.id.in_([image_id for image_id, _ in hits]),
+        Image.is_active == True
+    ).all()
+    
+    # 按搜索结果顺序排列
+    image_dict = {img.id: img for img in images}
+    for i, (image_id, similarity) in enumerate(hits):
+        if image_id in image_dict:
+            img = image_dict[image_id]
+            results.append({
+                "rank": i + 1,
+                "similarity": similarity,
+                "image": {
+                    "id": img.id,
+                    "filename": img.filename,
+                    "original_name": img.original_name,
+                    "url": img.url,
+                    "thumbnail_url": img.thumbnail_url,
+                    "width": img.width,
+                    "height": img.height,
+                    "file_size": img.file_size,
+                    "upload_time": img.upload_time.isoformat() if img.upload_time else None
+                }
+            })
+    return results
+
+
+async def search_by_content(
+    image_input: Union[str, bytes],
+    k: int,
+    nprobe: Optional[int],
+    ef_search: Optional[int],
+    db: Session,
+    model_service: ModelService,
+    faiss_service: FaissService,
+    embedding_cache: Optional[EmbeddingCache],
+    feature_store: Optional[FeatureStore],
+    result_cache: Optional[SearchResultCache],
+    content_hash: Optional[str] = None
+) -> Tuple[List[dict], bool]:
+    """
+    按图片内容搜索并组装结果
+    
+    相同内容、相同参数的查询在索引未变化时直接使用缓存的命中列表，跳过推理和Faiss搜索；
+    图片详情每次从数据库读取，修改或停用的图片不会以旧内容返回。
+    image_input 为文件路径时需同时传入 content_hash。
+    
+    Returns:
+        (结果列表, 是否命中结果缓存)
+    """
+    content_hash = content_hash or hashlib.md5(image_input).hexdigest()
+    cache_key = ("content", content_hash, k, nprobe, ef_search)
+    # 先读取索引版本再搜索，搜索期间索引发生变化时写入的条目随即失效
+    generation = faiss_service.generation
+    if result_cache is not None:
+        cached = result_cache.get(cache_key, generation)
+        if cached is not None:
+            return build_search_results(db, cached), True
+    
+    query_features = await extract_query_features(
+        image_input, db, model_service, embedding_cache, feature_store, content_hash
+    )
+    
+    # 执行搜索
+    api_logger.info(f"开始搜索相似图片，K={k}")
+    similarities, image_ids = await faiss_service.search(
+        query_features, k, nprobe=nprobe, ef_search=ef_search
+    )
+    
+    # 获取图片详情
+    hits = list(zip(image_ids, similarities))
+    if result_cache is not None:
+        result_cache.put(cache_key, generation, hits)
+    return build_search_results(db, hits), False
+
+
 @router.post("/by-upload")
 async def search_by_upload(
     file: UploadFile = File(...),
     k: int = Form(default=10),
+    nprobe: Optional[int] = Form(default=None),
+    ef_search: Optional[int] = Form(default=None),
     db: Session = Depends(get_db),
     model_service: ModelService = Depends(get_model_service),
-    faiss_service: FaissService = Depends(get_faiss_service)
+    faiss_service: FaissService = Depends(get_faiss_service),
+    embedding_cache: Optional[EmbeddingCache] = Depends(get_embedding_cache),
+    feature_store: Optional[FeatureStore] = Depends(get_feature_store),
+    result_cache: Optional[SearchResultCache] = Depends(get_result_cache)
 ):
-    """通过上传文件进行图片搜索"""
+    """通过上传文件进行图片搜索（文件分块写入临时文件并同时计算哈希，搜索完成后删除）"""
     start_time = time.time()
+    temp_path = None
     
     try:
         # 验证文件类型
@@ -57,50 +228,25 @@ async def search_by_upload(
         # 验证K值
         k = max(1, min(k, settings.search.max_k))
         
-        # 读取文件内容
-        file_content = await file.read()
+        # 分块接收文件，超过大小限制时立即中止
+        try:
+            temp_path, file_size, file_hash = await asyncio.get_event_loop().run_in_executor(
+                None, stream_to_temp_file, file.file, settings.storage.max_file_size
+            )
+        except FileTooLargeError:
+            raise HTTPException(status_code=400, detail="文件大小超过限制")
         
-        # 提取特征
+        # 提取特征并搜索
         api_logger.info(f"开始提取查询图片特征: {file.filename}")
-        query_features = await model_service.extract_features(file_content)
-        
-        # 执行搜索
-        api_logger.info(f"开始搜索相似图片，K={k}")
-        similarities, image_ids = await faiss_service.search(query_features, k)
-        
-        # 获取图片详情
-        results = []
-        if image_ids:
-            images = db.query(Image).filter(
-                Image.id.in_(image_ids),
-                Image.is_active == True
-            ).all()
-            
-            # 按搜索结果顺序排列
-            image_dict = {img.id: img for img in images}
-            for i, (image_id, similarity) in enumerate(zip(image_ids, similarities)):
-                if image_id in image_dict:
-                    img = image_dict[image_id]
-                    results.append({
-                        "rank": i + 1,
-                        "similarity": similarity,
-                        "image": {
-                            "id": img.id,
-                            "filename": img.filename,
-                            "original_name": img.original_name,
-                            "url": img.url,
-                            "thumbnail_url": img.thumbnail_url,
-                            "width": img.width,
-                            "height": img.height,
-                            "file_size": img.file_size,
-                            "upload_time": img.upload_time.isoformat() if img.upload_time else None
-                        }
-                    })
+        results, cache_hit = await search_by_content(
+            temp_path, k, nprobe, ef_search, db, model_service, faiss_service,
+            embedding_cache, feature_store, result_cache, file_hash
+        )
         
         # 计算搜索时间
         search_duration = time.time() - start_time
         
-
+        
         
         api_logger.info(f"搜索完成，返回{len(results)}个结果，耗时{search_duration:.3f}秒")
         
@@ -110,10 +256,13 @@ async def search_by_upload(
                 "query_info": {
                     "filename": file.filename,
                     "content_type": file.content_type,
-                    "size": len(file_content)
+                    "size": file_size
                 },
                 "search_params": {
                     "k": k,
+                    "nprobe": nprobe,
+                    "ef_search": ef_search,
+                    "cache_hit": cache_hit,
                     "duration": round(search_duration, 3)
                 },
                 "results": results,
@@ -126,87 +275,54 @@ async def search_by_upload(
     except Exception as e:
         api_logger.error(f"搜索失败: {e}")
         raise HTTPException(status_code=500, detail=f"搜索失败: {str(e)}")
+    finally:
+        discard_temp_file(temp_path)
 
 
 @router.post("/by-url")
 async def search_by_url(
     image_url: str = Form(...),
     k: int = Form(default=10),
+    nprobe: Optional[int] = Form(default=None),
+    ef_search: Optional[int] = Form(default=None),
     db: Session = Depends(get_db),
     model_service: ModelService = Depends(get_model_service),
-    faiss_service: FaissService = Depends(get_faiss_service)
+    faiss_service: FaissService = Depends(get_faiss_service),
+    embedding_cache: Optional[EmbeddingCache] = Depends(get_embedding_cache),
+    feature_store: Optional[FeatureStore] = Depends(get_feature_store),
+    result_cache: Optional[SearchResultCache] = Depends(get_result_cache),
+    url_fetcher: UrlFetcher = Depends(get_url_fetcher)
 ):
-    """通过图片URL进行搜索"""
+    """
+    通过图片URL进行搜索
+    
+    使用共享连接池流式下载到临时文件，超过大小限制或文件头不是图片时立即中止；
+    相同URL在缓存有效期内不重复下载。
+    """
     start_time = time.time()
     
     try:
         # 验证K值
         k = max(1, min(k, settings.search.max_k))
         
-        # 下载图片
+        # 下载图片并提取特征搜索，文件在搜索完成前不会被删除
         api_logger.info(f"开始下载图片: {image_url}")
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                response = await client.get(image_url)
-                if response.status_code != 200:
-                    raise HTTPException(status_code=400, detail=f"无法下载图片，状态码: {response.status_code}")
-                
-                content_type = response.headers.get('content-type', '')
-                if not content_type.startswith('image/'):
-                    raise HTTPException(status_code=400, detail="URL必须指向图片文件")
-                
-                image_content = response.content
-        except httpx.ConnectError as e:
-            api_logger.error(f"网络连接失败: {e}")
-            raise HTTPException(status_code=400, detail="网络连接失败，请检查URL或网络设置")
-        except httpx.TimeoutException as e:
-            api_logger.error(f"请求超时: {e}")
-            raise HTTPException(status_code=400, detail="请求超时，请稍后重试")
-        except Exception as e:
-            api_logger.error(f"下载图片失败: {e}")
-            raise HTTPException(status_code=400, detail=f"下载图片失败: {str(e)}")
-        
-        # 提取特征
-        api_logger.info("开始提取查询图片特征")
-        query_features = await model_service.extract_features(image_content)
-        
-        # 执行搜索
-        api_logger.info(f"开始搜索相似图片，K={k}")
-        similarities, image_ids = await faiss_service.search(query_features, k)
-        
-        # 获取图片详情
-        results = []
-        if image_ids:
-            images = db.query(Image).filter(
-                Image.id.in_(image_ids),
-                Image.is_active == True
-            ).all()
-            
-            # 按搜索结果顺序排列
-            image_dict = {img.id: img for img in images}
-            for i, (image_id, similarity) in enumerate(zip(image_ids, similarities)):
-                if image_id in image_dict:
-                    img = image_dict[image_id]
-                    results.append({
-                        "rank": i + 1,
-                        "similarity": similarity,
-                        "image": {
-                            "id": img.id,
-                            "filename": img.filename,
-                            "original_name": img.original_name,
-                            "url": img.url,
-                            "thumbnail_url": img.thumbnail_url,
-                            "width": img.width,
-                            "height": img.height,
-                            "file_size": img.file_size,
-                            "upload_time": img.upload_time.isoformat() if img.upload_time else None
-                        }
-                    })
+            async with url_fetcher.fetch(image_url) as fetched:
+                content_type, size = fetched["content_type"], fetched["size"]
+                api_logger.info("开始提取查询图片特征")
+                results, cache_hit = await search_by_content(
+                    fetched["path"], k, nprobe, ef_search, db, model_service, faiss_service,
+                    embedding_cache, feature_store, result_cache, fetched["content_hash"]
+                )
+        except FetchError as e:
+            api_logger.warning(f"下载图片失败: {image_url}, {e}")
+            raise HTTPException(status_code=400, detail=str(e))
         
         # 计算搜索时间
         search_duration = time.time() - start_time
         
-
+        
         
         api_logger.info(f"搜索完成，返回{len(results)}个结果，耗时{search_duration:.3f}秒")
         
@@ -216,10 +332,13 @@ async def search_by_url(
                 "query_info": {
                     "url": image_url,
                     "content_type": content_type,
-                    "size": len(image_content)
+                    "size": size
                 },
                 "search_params": {
                     "k": k,
+                    "nprobe": nprobe,
+                    "ef_search": ef_search,
+                    "cache_hit": cache_hit,
                     "duration": round(search_duration, 3)
                 },
                 "results": results,
@@ -238,9 +357,13 @@ async def search_by_url(
 async def search_by_image_id(
     image_id: int,
     k: int = Form(default=10),
+    nprobe: Optional[int] = Form(default=None),
+    ef_search: Optional[int] = Form(default=None),
     db: Session = Depends(get_db),
     model_service: ModelService = Depends(get_model_service),
-    faiss_service: FaissService = Depends(get_faiss_service)
+    faiss_service: FaissService = Depends(get_faiss_service),
+    result_cache: Optional[SearchResultCache] = Depends(get_result_cache),
+    neighbor_table: Optional[NeighborTable] = Depends(get_neighbor_table)
 ):
     """通过数据库中的图片ID进行搜索"""
     start_time = time.time()
@@ -258,71 +381,67 @@ async def search_by_image_id(
         if not query_image:
             raise HTTPException(status_code=404, detail="图片不存在")
         
-        # 提取特征
-        api_logger.info(f"开始提取查询图片特征: {query_image.filename}")
-        query_features = await model_service.extract_features(query_image.file_path)
-        
-        # 执行搜索
-        api_logger.info(f"开始搜索相似图片，K={k}")
-        similarities, image_ids = await faiss_service.search(query_features, k + 1)  # +1 排除自身
+        # 缓存的是命中的 (图像ID, 相似度) 列表，图片详情每次从数据库读取
+        cache_key = ("image", image_id, k, nprobe, ef_search)
+        generation = faiss_service.generation
+        cached = result_cache.get(cache_key, generation) if result_cache is not None else None
+        cache_hit = cached is not None
         
-        # 过滤掉查询图片本身
-        filtered_results = []
-        for img_id, similarity in zip(image_ids, similarities):
-            if img_id != image_id:
-                filtered_results.append((img_id, similarity))
-        
-        # 限制结果数量
-        filtered_results = filtered_results[:k]
+        if cache_hit:
+            hits, precomputed = cached
+        else:
+            # 使用默认搜索参数且k不超过近邻表的K时直接查表
+            hits = None
+            if neighbor_table is not None and nprobe is None and ef_search is None:
+                hits = neighbor_table.lookup(image_id, k)
+            precomputed = hits is not None
+            
+            if not precomputed:
+                # 直接取回已入库的向量，无需读取文件和重新推理
+                query_features = await faiss_service.get_vector(image_id)
+                if query_features is None:
+                    # 尚未写入索引的图片退回到模型提取
+                    api_logger.info(f"开始提取查询图片特征: {query_image.filename}")
+                    query_features = await model_service.extract_features(query_image.file_path)
+                
+                # 执行搜索，查询图片本身在Faiss内部排除
+                api_logger.info(f"开始搜索相似图片，K={k}")
+                similarities, image_ids = await faiss_service.search(
+                    query_features, k, nprobe=nprobe, ef_search=ef_search,
+                    exclude_image_ids=[image_id]
+                )
+                hits = list(zip(image_ids, similarities))
+            
+            # 查表结果只对应近邻表生成时的索引版本，表落后于当前版本时不缓存
+            if result_cache is not None and (not precomputed or neighbor_table.generation == generation):
+                result_cache.put(cache_key, generation, (hits, precomputed))
         
         # 获取图片详情
-        results = []
-        if filtered_results:
-            result_image_ids = [r[0] for r in filtered_results]
-            images = db.query(Image).filter(
-                Image.id.in_(result_image_ids),
-                Image.is_active == True
-            ).all()
-            
-            # 按搜索结果顺序排列
-            image_dict = {img.id: img for img in images}
-            for i, (img_id, similarity) in enumerate(filtered_results):
-                if img_id in image_dict:
-                    img = image_dict[img_id]
-                    results.append({
-                        "rank": i + 1,
-                        "similarity": similarity,
-                        "image": {
-                            "id": img.id,
-                            "filename": img.filename,
-                            "original_name": img.original_name,
-                            "url": img.url,
-                            "thumbnail_url": img.thumbnail_url,
-                            "width": img.width,
-                            "height": img.height,
-                            "file_size": img.file_size,
-                            "upload_time": img.upload_time.isoformat() if img.upload_time else None
-                        }
-                    })
+        results = build_search_results(db, hits)
+        query_info = {
+            "image_id": query_image.id,
+            "filename": query_image.filename,
+            "original_name": query_image.original_name,
+            "url": query_image.url
+        }
         
         # 计算搜索时间
         search_duration = time.time() - start_time
         
-
+        
         
         api_logger.info(f"搜索完成，返回{len(results)}个结果，耗时{search_duration:.3f}秒")
         
         return {
             "success": True,
             "data": {
-                "query_info": {
-                    "image_id": query_image.id,
-                    "filename": query_image.filename,
-                    "original_name": query_image.original_name,
-                    "url": query_image.url
-                },
+                "query_info": query_info,
                 "search_params": {
                     "k": k,
+                    "nprobe": nprobe,
+                    "ef_search": ef_search,
+                    "cache_hit": cache_hit,
+                    "precomputed": precomputed,
                     "duration": round(search_duration, 3)
                 },
                 "results": results,
@@ -41,6 +41,17 @@ class StorageConfig(BaseModel):
     max_file_size: int = 10485760  # 10MB
     allowed_extensions: List[str] = ["jpg", "jpeg", "png", "bmp", "webp"]
     thumbnail_size: List[int] = [256, 256]
+    shard_levels: int = 2  # 内容寻址存储按哈希前缀分层的目录层数
+
+
+class StaticFilesConfig(BaseModel):
+    """静态文件服务配置"""
+    immutable_max_age: int = 31536000  # 内容寻址原图的缓存时间（秒），URL与内容一一对应
+    derived_max_age: int = 86400  # 缩略图等派生文件的缓存时间（秒）
+    default_max_age: int = 3600  # 其他文件的缓存时间（秒）
+    precompressed: bool = True  # 客户端接受时返回同目录下的 .br / .gz 预压缩文件
+    sendfile_header: Optional[str] = None  # X-Accel-Redirect（nginx）或 X-Sendfile，由反向代理发送文件
+    accel_redirect_prefix: str = "/_protected_static"  # X-Accel-Redirect 使用的 nginx internal location
 
 
 class FaissConfig(BaseModel):
@@ -49,6 +60,101 @@ class FaissConfig(BaseModel):
     feature_dim: int = 2048
     index_type: str = "IndexFlatIP"
     nprobe: int = 10
+    load_mode: str = "memory"  # memory: 读入内存; mmap: 只读内存映射，多进程共享页缓存
+    # 并发：搜索持有读锁可并行执行，增删持有写锁串行执行，三类任务使用独立线程池
+    search_threads: int = 4  # 搜索线程数
+    mutation_threads: int = 1  # 增删线程数
+    persist_threads: int = 1  # 保存快照线程数
+    omp_threads: int = 0  # 单次搜索的OpenMP线程数，0 表示 CPU核数/搜索线程数
+    # 微批处理：合并并发到达的查询为一次批量搜索
+    search_batching: bool = True
+    search_batch_size: int = 64  # 每批最多查询数
+    search_batch_wait_ms: float = 2.0  # 第一个查询最长等待时间（毫秒）
+    # IVF索引配置
+    nlist: int = 0  # 倒排列表数量，0 表示按语料规模自动选择
+    ivf_min_train_vectors: int = 1000  # 向量数达到该值后才训练IVF，此前使用暴力搜索
+    ivf_train_sample_size: int = 100000  # 训练时最多采样的向量数
+    ivf_retrain_growth: float = 2.0  # 语料增长到训练时规模的N倍后自动重新训练
+    # 乘积量化（IndexIVFPQ / OPQ_IVFPQ）配置
+    pq_bytes_per_vector: int = 64  # 每个向量的压缩编码字节数（8bit子量化器个数）
+    rerank_factor: int = 0  # 重排序倍数，>1 时取 k*factor 个候选用全精度向量重新打分
+    # HNSW图索引（IndexHNSWFlat）配置
+    hnsw_m: int = 32  # 每个节点的邻居数
+    hnsw_ef_construction: int = 200  # 建图时的候选队列长度
+    hnsw_ef_search: int = 64  # 搜索时的候选队列长度，可按请求覆盖
+    hnsw_compact_ratio: float = 0.2  # 已删除向量占比超过该值时重建图以回收内存
+    # 持久化策略：累计变更达到N次、距上次保存超过T秒或服务关闭时落盘
+    save_every_n_adds: int = 1000
+    save_interval_seconds: float = 30.0
+    save_on_shutdown: bool = True
+    # 版本化快照：保存到 index_path 所在目录的 snapshots/ 下
+    snapshot_keep: int = 5  # 保留的快照数量
+    verify_checksums: bool = True  # 启动时校验快照SHA256（索引很大且使用mmap时可关闭）
+
+
+class FeatureStoreConfig(BaseModel):
+    """特征存储配置"""
+    enabled: bool = True
+    path: str = "data\\index\\image_features_raw"  # 存储文件路径前缀
+    dtype: str = "float32"  # float32 / float16（减半磁盘占用）
+
+
+class EmbeddingCacheConfig(BaseModel):
+    """特征向量缓存配置（以图片内容MD5为键）"""
+    enabled: bool = True
+    max_entries: int = 10000  # 内存层最大条目数
+    ttl_seconds: int = 3600  # 内存层过期时间
+    disk_enabled: bool = False  # 启用磁盘层，多个工作进程共享
+    disk_dir: str = "data\\cache\\embeddings"
+    disk_ttl_seconds: int = 86400  # 磁盘层过期时间
+
+
+class ResultCacheConfig(BaseModel):
+    """搜索结果缓存配置（索引任何变更后自动失效）"""
+    enabled: bool = True
+    max_entries: int = 5000
+    ttl_seconds: int = 300
+
+
+class NeighborTableConfig(BaseModel):
+    """预计算近邻表配置（以图搜图的k不超过K时直接查表）"""
+    enabled: bool = True
+    path: str = "data\\index\\neighbors"  # 存储文件路径前缀
+    k: int = 50  # 每张图像保存的近邻数量
+    chunk_size: int = 1024  # 每次批量搜索的图像数
+    workers: int = 2  # 同时占用的搜索线程数
+    build_on_startup: bool = True  # 启动时近邻表不存在则在后台生成
+    refresh_interval_seconds: float = 60.0  # 索引变更后增量刷新的检查间隔
+    full_rebuild_ratio: float = 0.2  # 变更行数超过该比例时全量重新生成
+
+
+class IngestConfig(BaseModel):
+    """图片导入配置"""
+    # 异步上传：先入库并返回 pending 状态，由后台队列批量建索引
+    async_upload: bool = False  # 上传接口的默认模式，可按请求覆盖
+    queue_workers: int = 2  # 后台建索引的工作协程数
+    queue_batch_size: int = 32  # 每批最多图片数
+    queue_batch_wait_ms: float = 50.0  # 第一张图片最长等待时间（毫秒）
+    queue_max_pending: int = 10000  # 内存队列长度，超出的图片由定期扫描补充入队
+    max_retries: int = 3  # 建索引失败的最大尝试次数
+    retry_delay_seconds: float = 5.0  # 首次重试延迟，之后指数退避
+    sweep_interval_seconds: float = 30.0  # 扫描数据库中 pending 图片的间隔
+    # 批量导入
+    bulk_batch_size: int = 256  # 每批导入的图片数
+    bulk_read_threads: int = 8  # 读取与哈希线程数
+    checkpoint_dir: str = "data\\ingest"  # 导入任务清单与断点目录
+    ingest_root: str = "data\\import"  # 只允许导入此目录内的图片目录、清单文件及清单中的路径
+
+
+class DerivativeConfig(BaseModel):
+    """派生图片配置（缩略图尺寸见 storage.thumbnail_size）"""
+    enabled: bool = True
+    thumbnail_quality: int = 80  # 缩略图 WebP 质量
+    analysis_size: int = 256  # 分析副本短边长度，不小于模型输入尺寸
+    analysis_quality: int = 90  # 分析副本 WebP 质量
+    workers: int = 2  # 生成线程数
+    backfill_on_startup: bool = True  # 启动时在后台补齐缺少派生文件的图片
+    backfill_batch_size: int = 500  # 回填时每批扫描的图片数
 
 
 class ModelConfig(BaseModel):
@@ -57,6 +163,24 @@ class ModelConfig(BaseModel):
     pretrained: bool = True
     device: str = "cuda"
     batch_size: int = 32
+    # 动态批处理：并发请求合并为一次前向推理
+    dynamic_batching: bool = True
+    batch_wait_ms: float = 5.0  # 第一个请求最长等待时间（毫秒）
+    preprocess_threads: int = 2  # 图像解码与预处理线程数
+    decode_workers: int = 2  # 解码进程数，0 表示在预处理线程中解码
+    decode_slots: int = 64  # 共享内存中可同时存放的已解码图像数
+    # 推理后端：eager / torchscript / onnx
+    backend: str = "eager"
+    quantization: str = "none"  # none; static: torchvision INT8 模型; dynamic: ONNX Runtime INT8（仅 onnx）
+    channels_last: bool = True
+    inference_mode: bool = True
+    onnx_threads: int = 0  # ONNX Runtime 算子内线程数，0 表示自动
+    export_dir: str = "data\\models"  # 导出的 ONNX 模型目录
+    # 与 fp32 eager 基线比较特征余弦偏差，超过阈值时回退到基线
+    drift_check: bool = True
+    drift_check_dir: str = ""  # 用于偏差检查的样例图片目录，为空时使用随机图像
+    drift_check_samples: int = 16
+    max_cosine_drift: float = 0.02
 
 
 class AuthConfig(BaseModel):
@@ -82,6 +206,17 @@ class SearchConfig(BaseModel):
     similarity_threshold: float = 0.5
 
 
+class UrlFetchConfig(BaseModel):
+    """按URL搜索的图片下载配置（大小上限使用 storage.max_file_size）"""
+    timeout_seconds: float = 10.0  # 连接和两次读取之间的超时（秒）
+    total_timeout_seconds: float = 30.0  # 单次下载的总时长上限（秒）
+    max_connections: int = 100  # 连接池大小
+    max_per_host: int = 4  # 同一主机的并发下载数
+    max_redirects: int = 5
+    cache_ttl_seconds: float = 300.0  # 下载结果缓存时间（秒），过期后按ETag重新验证，0表示不缓存
+    cache_max_entries: int = 256  # 缓存的图片数
+
+
 class AdminConfig(BaseModel):
     """管理员配置"""
     default_username: str = "admin"
@@ -93,11 +228,19 @@ class Settings(BaseModel):
     server: ServerConfig = ServerConfig()
     database: DatabaseConfig = DatabaseConfig()
     storage: StorageConfig = StorageConfig()
+    static_files: StaticFilesConfig = StaticFilesConfig()
     faiss: FaissConfig = FaissConfig()
+    feature_store: FeatureStoreConfig = FeatureStoreConfig()
+    embedding_cache: EmbeddingCacheConfig = EmbeddingCacheConfig()
+    result_cache: ResultCacheConfig = ResultCacheConfig()
+    neighbor_table: NeighborTableConfig = NeighborTableConfig()
+    ingest: IngestConfig = IngestConfig()
+    derivatives: DerivativeConfig = DerivativeConfig()
     model: ModelConfig = ModelConfig()
     auth: AuthConfig = AuthConfig()
     logging: LoggingConfig = LoggingConfig()
     search: SearchConfig = SearchConfig()
+    url_fetch: UrlFetchConfig = UrlFetchConfig()
     admin: AdminConfig = AdminConfig()
 
 
@@ -142,9 +285,30 @@ def get_settings() -> Settings:
     if 'storage' in yaml_config:
         config_dict['storage'] = StorageConfig(**yaml_config['storage'])
     
+    if 'static_files' in yaml_config:
+        config_dict['static_files'] = StaticFilesConfig(**yaml_config['static_files'])
+    
     if 'faiss' in yaml_config:
         config_dict['faiss'] = FaissConfig(**yaml_config['faiss'])
     
+    if 'feature_store' in yaml_config:
+        config_dict['feature_store'] = FeatureStoreConfig(**yaml_config['feature_store'])
+    
+    if 'embedding_cache' in yaml_config:
+        config_dict['embedding_cache'] = EmbeddingCacheConfig(**yaml_config['embedding_cache'])
+    
+    if 'result_cache' in yaml_config:
+        config_dict['result_cache'] = ResultCacheConfig(**yaml_config['result_cache'])
+    
+    if 'neighbor_table' in yaml_config:
+        config_dict['neighbor_table'] = NeighborTableConfig(**yaml_config['neighbor_table'])
+    
+    if 'ingest' in yaml_config:
+        config_dict['ingest'] = IngestConfig(**yaml_config['ingest'])
+    
+    if 'derivatives' in yaml_config:
+        config_dict['derivatives'] = DerivativeConfig(**yaml_config['derivatives'])
+    
     if 'model' in yaml_config:
         config_dict['model'] = ModelConfig(**yaml_config['model'])
     
@@ -157,6 +321,9 @@ def get_settings() -> Settings:
     if 'search' in yaml_config:
         config_dict['search'] = SearchConfig(**yaml_config['search'])
     
+    if 'url_fetch' in yaml_config:
+        config_dict['url_fetch'] = UrlFetchConfig(**yaml_config['url_fetch'])
+    
     if 'admin' in yaml_config:
         config_dict['admin'] = AdminConfig(**yaml_config['admin'])
     
@@ -8,6 +8,12 @@ from sqlalchemy.orm import relationship
 
 from ..core.database import Base
 
+# 索引状态：异步上传时先入库为 pending，后台建索引完成后为 indexed
+INDEX_STATUS_PENDING = "pending"
+INDEX_STATUS_INDEXING = "indexing"
+INDEX_STATUS_INDEXED = "indexed"
+INDEX_STATUS_FAILED = "failed"
+
 
 class Image(Base):
     """图片模型"""
@@ -28,6 +34,9 @@ class Image(Base):
     tags = Column(JSON, nullable=True)  # 标签信息
     description = Column(Text, nullable=True)  # 图片描述
     is_active = Column(Boolean, default=True, nullable=False)
+    index_status = Column(String(16), default=INDEX_STATUS_INDEXED, nullable=False, index=True)  # 索引状态
+    index_attempts = Column(Integer, default=0, nullable=False)  # 建索引失败次数
+    index_error = Column(String(500), nullable=True)  # 最近一次建索引失败原因
     
     # 关系
     uploader = relationship("User", backref="uploaded_images", foreign_keys=[upload_by])
@@ -52,6 +61,8 @@ class Image(Base):
             "tags": self.tags,
             "description": self.description,
             "is_active": self.is_active,
+            "index_status": self.index_status,
+            "index_error": self.index_error,
             "url": self.url,
             "thumbnail_url": self.thumbnail_url
         }
@@ -68,9 +79,9 @@ class Image(Base):
     
     @property
     def thumbnail_url(self) -> str:
-        """获取缩略图URL"""
-        name, ext = self.filename.rsplit('.', 1)
-        return f"/static/images/thumbnails/{name}_thumb.{ext}"
+        """获取缩略图URL（WebP格式，由派生图片服务生成）"""
+        name = self.filename.rsplit('.', 1)[0]
+        return f"/static/images/thumbnails/{name}_thumb.webp"
     
     def get_dimensions(self) -> tuple:
         """获取图片尺寸"""
@@ -0,0 +1,457 @@
+"""
+批量导入服务
+把目录或清单文件中的图片按流水线批量写入：并行流式复制到临时文件并计算哈希 -> 批量去重
+-> 批量提取特征 -> 移动到存储位置 -> 批量写入数据库、特征存储和索引 -> 生成缩略图和分析副本，支持断点续传
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from sqlalchemy.exc import IntegrityError
+
+from ..core.database import SessionLocal
+from ..models.image import Image, INDEX_STATUS_INDEXED, INDEX_STATUS_INDEXING, INDEX_STATUS_PENDING
+from ..utils.logger import LoggerMixin
+from .faiss_service import FaissService
+from .feature_store import FeatureStore
+from .derivatives import DerivativeService
+from .image_storage import (
+    FileTooLargeError, commit_temp_file, discard_temp_file, probe_image, stream_to_temp_file
+)
+from .model_service import ModelService
+
+
+class BulkIngestor(LoggerMixin):
+    """批量导入任务
+    
+    每个任务在 checkpoint_dir 下保存三个文件：
+    - `<job_id>.list`：待导入的文件路径（每行一个，创建任务时排序后固定）
+    - `<job_id>.json`：任务进度，offset 之前的文件都已处理完毕
+    - `<job_id>.failed`：读取或解码失败的文件路径
+    
+    相邻批次重叠执行：推理当前批次时，下一批次已在读取、哈希和去重。
+    文件分块复制到上传目录下的临时文件并同时计算哈希，批次中只保存路径和哈希，
+    内存占用与文件大小无关；入库时把临时文件原子地移动到存储位置。
+    中断后以相同 job_id 恢复时从 offset 继续。
+    
+    只能导入 ingest_root 目录内的文件：目录、清单文件和清单中的每个路径都按解析符号链接后的
+    真实路径检查，根目录之外的文件记为失败，不会被读取。
+    """
+    
+    def __init__(self, model_service: ModelService, faiss_service: FaissService,
+                 feature_store: Optional[FeatureStore], checkpoint_dir: str, ingest_root: str,
+                 batch_size: int = 256, read_threads: int = 8,
+                 allowed_extensions: Optional[List[str]] = None,
+                 max_file_size: Optional[int] = None,
+                 derivative_service: Optional[DerivativeService] = None):
+        self.model_service = model_service
+        self.faiss_service = faiss_service
+        self.feature_store = feature_store
+        self.checkpoint_dir = checkpoint_dir
+        self.ingest_root = os.path.realpath(ingest_root)
+        self.batch_size = max(1, batch_size)
+        self.read_threads = max(1, read_threads)
+        self.allowed_extensions = {ext.lower().lstrip('.') for ext in (allowed_extensions or [])}
+        self.max_file_size = max_file_size
+        self.derivative_service = derivative_service
+        
+        self._task: Optional[asyncio.Task] = None
+        self._cancel = asyncio.Event()
+        self._job: Optional[dict] = None
+    
+    def is_running(self) -> bool:
+        """是否有进行中的导入任务"""
+        return self._task is not None and not self._task.done()
+    
+    def _within_root(self, path: str) -> bool:
+        """路径解析符号链接后是否位于导入根目录内"""
+        real_path = os.path.realpath(path)
+        return real_path == self.ingest_root or real_path.startswith(os.path.join(self.ingest_root, ""))
+    
+    def _job_path(self, job_id: str, suffix: str) -> str:
+        return os.path.join(self.checkpoint_dir, f"{job_id}.{suffix}")
+    
+    async def start(self, source_dir: Optional[str] = None, manifest: Optional[str] = None,
+                    job_id: Optional[str] = None) -> dict:
+        """
+        启动或恢复导入任务
+        
+        Args:
+            source_dir: 图片目录（递归扫描允许的扩展名），必须位于 ingest_root 内
+            manifest: 清单文件，每行一个图片路径，# 开头为注释；清单文件和其中的路径都必须位于 ingest_root 内
+            job_id: 恢复已有任务，此时忽略 source_dir 和 manifest
+        
+        Returns:
+            任务进度
+        """
+        if self.is_running():
+            raise RuntimeError("批量导入任务正在进行中")
+        
+        loop = asyncio.get_event_loop()
+        if job_id:
+            job = await loop.run_in_executor(None, self._load_job, job_id)
+        else:
+            if bool(source_dir) == bool(manifest):
+                raise ValueError("需要且只能指定 source_dir 或 manifest 之一")
+            job = await loop.run_in_executor(None, self._create_job, source_dir, manifest)
+        
+        job.update({"status": "running", "error": None, "resumed_at": time.time()})
+        self._job = job
+        self._cancel.clear()
+        self._task = asyncio.create_task(self._run(job))
+        return self.get_status()
+    
+    def _create_job(self, source_dir: Optional[str], manifest: Optional[str]) -> dict:
+        path_arg = source_dir or manifest
+        if not self._within_root(path_arg):
+            raise ValueError(f"路径不在导入根目录内: {path_arg}")
+        
+        if source_dir:
+            if not os.path.isdir(source_dir):
+                raise ValueError(f"目录不存在: {source_dir}")
+            paths = [
+                os.path.join(root, name)
+                for root, _, files in os.walk(source_dir)
+                for name in files
+                if not self.allowed_extensions
+                or os.path.splitext(name)[1].lower().lstrip('.') in self.allowed_extensions
+            ]
+        else:
+            if not os.path.isfile(manifest):
+                raise ValueError(f"清单文件不存在: {manifest}")
+            base_dir = os.path.dirname(os.path.abspath(manifest))
+            with open(manifest, 'r', encoding='utf-8') as f:
+                lines = [line.strip() for line in f]
+            # 清单中的相对路径相对于清单文件所在目录
+            paths = [
+                line if os.path.isabs(line) else os.path.join(base_dir, line)
+                for line in lines if line and not line.startswith('#')
+            ]
+        # 目录中的符号链接和清单中的路径可能指向根目录之外
+        rejected = sorted({path for path in paths if not self._within_root(path)})
+        paths = sorted(set(paths).difference(rejected))
+        
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        job = {
+            "job_id": time.strftime("%Y%m%d%H%M%S") + "_" + uuid.uuid4().hex[:8],
+            "source_dir": source_dir,
+            "manifest": manifest,
+            "total": len(paths),
+            "offset": 0,
+            "ingested": 0,
+            "duplicates": 0,
+            "failed": len(rejected),
+            "created_at": time.time(),
+            "finished_at": None
+        }
+        with open(self._job_path(job["job_id"], "list"), 'w', encoding='utf-8') as f:
+            f.write("\n".join(paths))
+        if rejected:
+            self.logger.warning(f"忽略导入根目录之外的文件: {len(rejected)}个")
+            self._append_failed(job["job_id"], [(path, "不在导入根目录内") for path in rejected])
+        self._save_job(job)
+        return job
+    
+    def _load_job(self, job_id: str) -> dict:
+        if os.path.basename(job_id) != job_id or not os.path.exists(self._job_path(job_id, "json")):
+            raise ValueError(f"导入任务不存在: {job_id}")
+        with open(self._job_path(job_id, "json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def _save_job(self, job: dict):
+        """写入任务进度（先写临时文件再原子替换）"""
+        path = self._job_path(job["job_id"], "json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    
+    async def _run(self, job: dict):
+        """生产者准备批次、消费者推理和写入，两者通过长度为2的队列重叠执行"""
+        loop = asyncio.get_event_loop()
+        read_executor = ThreadPoolExecutor(max_workers=self.read_threads, thread_name_prefix="ingest-read")
+        batches: asyncio.Queue = asyncio.Queue(maxsize=2)
+        
+        async def produce():
+            with open(self._job_path(job["job_id"], "list"), 'r', encoding='utf-8') as f:
+                paths = f.read().splitlines()
+            for start in range(job["offset"], len(paths), self.batch_size):
+                if self._cancel.is_set():
+                    break
+                batch_paths = paths[start:start + self.batch_size]
+                items = await self._prepare(batch_paths, read_executor)
+                await batches.put((start + len(batch_paths), items))
+            await batches.put(None)
+        
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                batch = await batches.get()
+                if batch is None:
+                    break
+                end_offset, items = batch
+                await self._commit(items, job, read_executor)
+                job["offset"] = end_offset
+                await loop.run_in_executor(None, self._save_job, job)
+                if self._cancel.is_set():
+                    break
+            
+            job["status"] = "cancelled" if self._cancel.is_set() else "completed"
+            self.logger.info(
+                f"批量导入{job['status']}: {job['job_id']}, 导入{job['ingested']}, "
+                f"重复{job['duplicates']}, 失败{job['failed']}, 进度{job['offset']}/{job['total']}"
+            )
+        except Exception as e:
+            job.update({"status": "failed", "error": str(e)})
+            self.logger.error(f"批量导入失败: {job['job_id']}, {e}")
+        finally:
+            producer.cancel()
+            try:
+                await producer
+            except (asyncio.CancelledError, Exception):
+                pass
+            # 已准备好但未处理的批次留下的临时文件
+            while not batches.empty():
+                batch = batches.get_nowait()
+                if batch is not None:
+                    self._discard(batch[1]["items"])
+            if job["status"] == "running":
+                # 服务关闭时被中断，可用相同 job_id 恢复
+                job["status"] = "interrupted"
+            job["finished_at"] = time.time()
+            self._save_job(job)
+            read_executor.shutdown(wait=False)
+    
+    async def _prepare(self, paths: List[str], executor: ThreadPoolExecutor) -> dict:
+        """并行复制到临时文件并哈希，与数据库及批内已出现的哈希去重，重复文件的临时文件随即删除"""
+        loop = asyncio.get_event_loop()
+        results = await asyncio.gather(*[loop.run_in_executor(executor, self._read_file, p) for p in paths])
+        
+        items, failed, skipped, seen = [], [], [], set()
+        for path, result in zip(paths, results):
+            if isinstance(result, str):
+                failed.append((path, result))
+            elif result["hash"] in seen:
+                skipped.append(result)
+            else:
+                seen.add(result["hash"])
+                items.append(result)
+        
+        try:
+            existing = await loop.run_in_executor(None, self._existing_hashes, list(seen))
+        except BaseException:
+            self._discard(items + skipped)
+            raise
+        new_items = [item for item in items if item["hash"] not in existing]
+        skipped.extend(item for item in items if item["hash"] in existing)
+        self._discard(skipped)
+        return {"items": new_items, "failed": failed, "duplicates": len(skipped)}
+    
+    def _read_file(self, path: str):
+        """分块复制到临时文件，同时计算哈希并读取尺寸，失败时返回原因"""
+        # 创建任务后符号链接可能被修改，读取前再检查一次
+        if not self._within_root(path):
+            return "不在导入根目录内"
+        try:
+            with open(path, 'rb') as f:
+                temp_path, size, file_hash = stream_to_temp_file(f, self.max_file_size or sys.maxsize)
+        except FileTooLargeError:
+            return "文件大小超过限制"
+        except OSError as e:
+            return f"读取失败: {e}"
+        
+        width, height, format_name = probe_image(temp_path)
+        if width is None:
+            discard_temp_file(temp_path)
+            return "无法识别的图片格式"
+        return {
+            "path": path,
+            "temp_path": temp_path,
+            "hash": file_hash,
+            "width": width,
+            "height": height,
+            "format": format_name
+        }
+    
+    @staticmethod
+    def _discard(items: List[dict]):
+        """删除尚未移动到存储位置的临时文件"""
+        for item in items:
+            discard_temp_file(item.pop("temp_path", None))
+    
+    @staticmethod
+    def _existing_hashes(hashes: List[str]) -> set:
+        """一次查询批次中已入库的哈希（包括已删除的图片，哈希列有唯一约束）"""
+        if not hashes:
+            return set()
+        db = SessionLocal()
+        try:
+            rows = db.query(Image.hash_value).filter(Image.hash_value.in_(hashes)).all()
+            return {row.hash_value for row in rows}
+        finally:
+            db.close()
+    
+    async def _commit(self, prepared: dict, job: dict, executor: ThreadPoolExecutor):
+        """批量提取特征后保存文件，写入数据库、特征存储和索引"""
+        loop = asyncio.get_event_loop()
+        items, failed = prepared["items"], list(prepared["failed"])
+        job["duplicates"] += prepared["duplicates"]
+        
+        try:
+            if items:
+                features, mask = await self.model_service.extract_batch_features_masked(
+                    [item["temp_path"] for item in items]
+                )
+                failed.extend((item["path"], "图像解码失败") for item, ok in zip(items, mask) if not ok)
+                self._discard([item for item, ok in zip(items, mask) if not ok])
+                items = [item for item, ok in zip(items, mask) if ok]
+            
+            if items:
+                saved = await asyncio.gather(*[
+                    loop.run_in_executor(executor, commit_temp_file, item["temp_path"], item["hash"], item["path"])
+                    for item in items
+                ])
+                for item, (file_path, unique_filename) in zip(items, saved):
+                    item.update({"file_path": file_path, "filename": unique_filename})
+                    item.pop("temp_path")
+        finally:
+            # 推理或移动失败时删除剩余的临时文件
+            self._discard(items)
+        
+        if items:
+            # 文件按内容寻址存储，插入失败或被跳过时不删除：同一路径可能正被相同内容的其他记录引用，
+            # 重试时也会写入同一路径
+            image_ids = await loop.run_in_executor(None, self._insert_rows, items)
+            
+            # 插入时遇到并发上传的相同图片会被跳过
+            if len(image_ids) < len(items):
+                job["duplicates"] += len(items) - len(image_ids)
+            vectors = features[[i for i, item in enumerate(items) if item.get("image_id") is not None]]
+            
+            if image_ids:
+                try:
+                    if self.feature_store is not None:
+                        await self.feature_store.add(image_ids, vectors)
+                    await self.faiss_service.add_vectors(vectors, image_ids)
+                    await loop.run_in_executor(None, self._set_status, image_ids, INDEX_STATUS_INDEXED)
+                except Exception:
+                    # 记录已入库，交给后台建索引队列补做
+                    await loop.run_in_executor(None, self._set_status, image_ids, INDEX_STATUS_PENDING)
+                    raise
+            job["ingested"] += len(image_ids)
+            
+            if self.derivative_service is not None and image_ids:
+                await self.derivative_service.generate_many([
+                    (item["file_path"], item["filename"]) for item in items if item.get("image_id") is not None
+                ])
+        
+        if failed:
+            job["failed"] += len(failed)
+            await loop.run_in_executor(None, self._append_failed, job["job_id"], failed)
+    
+    def _insert_rows(self, items: List[dict]) -> List[int]:
+        """批量插入图片记录（状态为 indexing），返回图像ID"""
+        db = SessionLocal()
+        try:
+            records = self._build_records(items)
+            db.add_all(records)
+            try:
+                db.commit()
+            except IntegrityError:
+                # 与并发上传冲突时逐条插入，跳过已存在的哈希
+                db.rollback()
+                records = []
+                for record in self._build_records(items):
+                    db.add(record)
+                    try:
+                        db.commit()
+                        records.append(record)
+                    except IntegrityError:
+                        db.rollback()
+            
+            ids_by_hash = {record.hash_value: record.id for record in records}
+            for item in items:
+                item["image_id"] = ids_by_hash.get(item["hash"])
+            return [item["image_id"] for item in items if item["image_id"] is not None]
+        finally:
+            db.close()
+    
+    @staticmethod
+    def _build_records(items: List[dict]) -> List[Image]:
+        return [
+            Image(
+                filename=item["filename"],
+                original_name=os.path.basename(item["path"]),
+                file_path=item["file_path"],
+                file_size=os.path.getsize(item["file_path"]),
+                width=item["width"],
+                height=item["height"],
+                format=item["format"],
+                hash_value=item["hash"],
+                index_status=INDEX_STATUS_INDEXING
+            )
+            for item in items
+        ]
+    
+    @staticmethod
+    def _set_status(image_ids: List[int], status: str):
+        db = SessionLocal()
+        try:
+            values = {Image.index_status: status}
+            if status == INDEX_STATUS_INDEXED:
+                values[Image.faiss_id] = Image.id
+            db.query(Image).filter(Image.id.in_(image_ids)).update(values, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+    
+    def _append_failed(self, job_id: str, failed: List[tuple]):
+        with open(self._job_path(job_id, "failed"), 'a', encoding='utf-8') as f:
+            for path, reason in failed:
+                f.write(f"{path}\t{reason}\n")
+    
+    def cancel(self) -> bool:
+        """取消进行中的任务，当前批次完成后停止，可用相同 job_id 恢复"""
+        if not self.is_running():
+            return False
+        self._cancel.set()
+        return True
+    
+    def get_status(self) -> dict:
+        """获取当前（或最近一次）导入任务的进度"""
+        if self._job is None:
+            return {"status": "idle"}
+        status = dict(self._job)
+        if status.get("total"):
+            status["progress"] = round(status["offset"] / status["total"], 4)
+        return status
+    
+    def list_jobs(self) -> List[dict]:
+        """列出全部导入任务的进度记录"""
+        if not os.path.isdir(self.checkpoint_dir):
+            return []
+        jobs = []
+        for name in sorted(os.listdir(self.checkpoint_dir), reverse=True):
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(self.checkpoint_dir, name), 'r', encoding='utf-8') as f:
+                        jobs.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return jobs
+    
+    async def cleanup(self):
+        """停止进行中的任务，进度已写入检查点"""
+        if self.is_running():
+            self._cancel.set()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
\ No newline at end of file
@@ -0,0 +1,174 @@
+"""
+派生图片服务
+入库时在后台为新图片生成缩略图和分析副本，并补齐历史图片缺少的派生文件
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Set, Tuple
+
+from ..core.database import SessionLocal
+from ..models.image import Image
+from ..utils.logger import LoggerMixin
+from .image_storage import analysis_filename, generate_derivatives, storage_path, thumbnail_filename
+
+
+class DerivativeService(LoggerMixin):
+    """缩略图和分析副本生成服务
+    
+    - 上传和批量导入提交的新图片在独立线程池中生成，不阻塞请求
+    - 回填任务按图像ID分批扫描数据库，只为缺少派生文件的图片生成
+    - 派生文件的写入是原子的，重复生成同一张图片是安全的
+    """
+    
+    def __init__(self, thumbnail_size: Tuple[int, int], analysis_size: int = 256,
+                 thumbnail_quality: int = 80, analysis_quality: int = 90,
+                 workers: int = 2, backfill_batch_size: int = 500):
+        self.thumbnail_size = tuple(thumbnail_size)
+        self.analysis_size = analysis_size
+        self.thumbnail_quality = thumbnail_quality
+        self.analysis_quality = analysis_quality
+        self.workers = max(1, workers)
+        self.backfill_batch_size = max(1, backfill_batch_size)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="derivatives")
+        
+        self._pending: Set[asyncio.Future] = set()
+        self._backfill_task: Optional[asyncio.Task] = None
+        self._backfill_status = {"status": "idle"}
+        
+        # 统计信息
+        self._generated = 0
+        self._failed = 0
+    
+    def submit(self, file_path: str, stored_filename: str):
+        """提交一张新图片，在后台生成派生文件"""
+        future = asyncio.get_event_loop().run_in_executor(
+            self.executor, self._generate_sync, file_path, stored_filename
+        )
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+    
+    async def generate_many(self, items: List[Tuple[str, str]]) -> int:
+        """
+        为一批 (文件路径, 存储文件名) 生成派生文件并等待完成，调用方据此形成背压
+        
+        Returns:
+            新生成的数量（失败的图片由回填任务补齐）
+        """
+        loop = asyncio.get_event_loop()
+        results = await asyncio.gather(*[
+            loop.run_in_executor(self.executor, self._generate_sync, file_path, stored_filename)
+            for file_path, stored_filename in items
+        ])
+        return sum(1 for result in results if result)
+    
+    def _generate_sync(self, file_path: str, stored_filename: str) -> Optional[bool]:
+        """生成派生文件，返回是否生成了新文件，失败时返回None"""
+        try:
+            generated = generate_derivatives(
+                file_path, stored_filename, self.thumbnail_size, self.analysis_size,
+                thumbnail_quality=self.thumbnail_quality, analysis_quality=self.analysis_quality
+            )
+            if generated:
+                self._generated += 1
+            return generated
+        except Exception as e:
+            self._failed += 1
+            self.logger.warning(f"生成派生图片失败: {file_path}, {e}")
+            return None
+    
+    def is_backfilling(self) -> bool:
+        """是否有回填任务正在执行"""
+        return self._backfill_task is not None and not self._backfill_task.done()
+    
+    def start_backfill(self) -> dict:
+        """
+        启动后台回填任务
+        
+        Raises:
+            RuntimeError: 已有回填任务正在执行
+        """
+        if self.is_backfilling():
+            raise RuntimeError("派生图片回填任务正在执行")
+        self._backfill_status = {"status": "running", "last_id": 0, "scanned": 0, "generated": 0, "failed": 0}
+        self._backfill_task = asyncio.create_task(self._backfill())
+        return self.get_backfill_status()
+    
+    async def _backfill(self):
+        loop = asyncio.get_event_loop()
+        status = self._backfill_status
+        try:
+            while True:
+                rows = await loop.run_in_executor(
+                    None, self._load_batch_sync, status["last_id"], self.backfill_batch_size
+                )
+                if not rows:
+                    break
+                status["last_id"] = rows[-1][0]
+                status["scanned"] += len(rows)
+                
+                results = await asyncio.gather(*[
+                    loop.run_in_executor(self.executor, self._backfill_one_sync, file_path, filename)
+                    for _, file_path, filename in rows
+                ])
+                status["generated"] += sum(1 for result in results if result)
+                status["failed"] += sum(1 for result in results if result is None)
+            
+            status["status"] = "completed"
+            self.logger.info(
+                f"派生图片回填完成: 扫描{status['scanned']}张, 生成{status['generated']}张, 失败{status['failed']}张"
+            )
+        except asyncio.CancelledError:
+            status["status"] = "cancelled"
+            raise
+        except Exception as e:
+            status.update({"status": "failed", "error": str(e)})
+            self.logger.error(f"派生图片回填失败: {e}")
+    
+    def _backfill_one_sync(self, file_path: str, stored_filename: str) -> Optional[bool]:
+        # 只检查文件是否存在，已生成的图片不重复解码
+        if (os.path.exists(storage_path(thumbnail_filename(stored_filename)))
+                and os.path.exists(storage_path(analysis_filename(stored_filename)))):
+            return False
+        if not os.path.exists(file_path):
+            return False
+        return self._generate_sync(file_path, stored_filename)
+    
+    @staticmethod
+    def _load_batch_sync(last_id: int, limit: int) -> List[Tuple[int, str, str]]:
+        db = SessionLocal()
+        try:
+            rows = db.query(Image.id, Image.file_path, Image.filename).filter(
+                Image.id > last_id,
+                Image.is_active == True
+            ).order_by(Image.id).limit(limit).all()
+            return [(row.id, row.file_path, row.filename) for row in rows]
+        finally:
+            db.close()
+    
+    def get_backfill_status(self) -> dict:
+        """获取回填任务进度"""
+        return dict(self._backfill_status)
+    
+    def get_stats(self) -> dict:
+        """获取统计信息"""
+        return {
+            "workers": self.workers,
+            "thumbnail_size": list(self.thumbnail_size),
+            "analysis_size": self.analysis_size,
+            "pending": len(self._pending),
+            "generated": self._generated,
+            "failed": self._failed,
+            "backfill": self.get_backfill_status()
+        }
+    
+    async def cleanup(self):
+        """停止回填任务并关闭线程池"""
+        if self._backfill_task is not None:
+            self._backfill_task.cancel()
+            try:
+                await self._backfill_task
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=False)
\ No newline at end of file
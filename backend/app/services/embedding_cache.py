@@ -0,0 +1,168 @@
+"""
+特征向量缓存
+以图片内容哈希为键缓存特征向量，重复查询相同图片时跳过模型推理
+"""
+
+import asyncio
+import os
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import Optional
+
+from ..utils.logger import LoggerMixin
+
+
+class EmbeddingCache(LoggerMixin):
+    """两级特征向量缓存
+    
+    - 内存层：进程内LRU，按条目数和TTL淘汰
+    - 磁盘层（可选）：`<disk_dir>/<namespace>/<哈希前两位>/<哈希>.npy`，先写临时文件再原子替换，
+      多个工作进程共享；按文件修改时间判断是否过期
+    
+    键为图片内容的MD5（与 Image.hash_value 一致），返回的向量为只读数组。
+    磁盘层在进程重启后仍然有效，namespace 取模型服务的 fingerprint，
+    切换模型、推理后端或量化方式后不会读到旧模型的向量。
+    """
+    
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 3600,
+                 disk_dir: Optional[str] = None, disk_ttl_seconds: float = 86400,
+                 namespace: str = "default"):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.disk_root = disk_dir
+        self.namespace = namespace
+        self.disk_dir = os.path.join(disk_dir, namespace) if disk_dir else None
+        self.disk_ttl_seconds = disk_ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # 键 -> (向量, 过期时间)
+        self._lock = threading.Lock()
+        
+        # 统计信息
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._store_hits = 0
+        self._misses = 0
+        self._evictions = 0
+    
+    async def get(self, key: str) -> Optional[np.ndarray]:
+        """读取缓存的向量，依次查找内存层和磁盘层"""
+        vector = self._get_memory(key)
+        if vector is not None:
+            self._memory_hits += 1
+            return vector
+        
+        if self.disk_dir:
+            vector = await asyncio.get_event_loop().run_in_executor(None, self._read_disk, key)
+            if vector is not None:
+                self._disk_hits += 1
+                self._put_memory(key, vector)
+                return vector
+        
+        self._misses += 1
+        return None
+    
+    async def put(self, key: str, vector: np.ndarray):
+        """写入缓存"""
+        vector = np.array(vector, dtype=np.float32).reshape(-1)
+        vector.setflags(write=False)
+        self._put_memory(key, vector)
+        
+        if self.disk_dir:
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self._write_disk, key, vector)
+            except OSError as e:
+                self.logger.warning(f"写入磁盘特征缓存失败: {e}")
+    
+    def record_store_hit(self):
+        """记录一次缓存未命中、但由已入库图片的存储向量满足的查询"""
+        self._store_hits += 1
+    
+    def _get_memory(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            vector, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return vector
+    
+    def _put_memory(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self._entries[key] = (vector, time.time() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+    
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.npy")
+    
+    def _read_disk(self, key: str) -> Optional[np.ndarray]:
+        """读取磁盘层，过期或损坏的文件直接删除"""
+        path = self._disk_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.disk_ttl_seconds:
+                os.remove(path)
+                return None
+            vector = np.load(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"读取磁盘特征缓存失败，已丢弃: {path}, {e}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        
+        vector.setflags(write=False)
+        return vector
+    
+    def _write_disk(self, key: str, vector: np.ndarray):
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, vector)
+        os.replace(tmp_path, path)
+    
+    def clear(self, include_disk: bool = False) -> int:
+        """清空缓存，返回清除的内存条目数"""
+        with self._lock:
+            cleared = len(self._entries)
+            self._entries.clear()
+        
+        # 清理全部命名空间，包括旧模型留下的文件
+        if include_disk and self.disk_root and os.path.isdir(self.disk_root):
+            for root, _, files in os.walk(self.disk_root):
+                for name in files:
+                    if name.endswith('.npy'):
+                        try:
+                            os.remove(os.path.join(root, name))
+                        except OSError:
+                            pass
+        return cleared
+    
+    def get_stats(self) -> dict:
+        """获取缓存统计信息"""
+        hits = self._memory_hits + self._disk_hits
+        lookups = hits + self._misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "disk_enabled": bool(self.disk_dir),
+            "namespace": self.namespace,
+            "memory_hits": self._memory_hits,
+            "disk_hits": self._disk_hits,
+            "store_hits": self._store_hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0,
+            # 缓存未命中但由已入库图片的向量满足，同样跳过了模型推理
+            "inference_skip_rate": round((hits + self._store_hits) / lookups, 4) if lookups else 0
+        }
\ No newline at end of file
@@ -6,33 +6,107 @@ Faiss服务
 import faiss
 import numpy as np
 import os
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Iterable
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
+import json
 import pickle
+import threading
+import time
 
 from ..core.config import get_settings
-from ..core.database import get_db
-from ..models.image import Image
+from ..core.database import SessionLocal
+from ..models.image import Image, INDEX_STATUS_INDEXED, INDEX_STATUS_PENDING
 from ..models.faiss_index import FaissIndexInfo
 from ..utils.logger import LoggerMixin
+from ..utils.rwlock import RWLock
+from ..utils.batcher import MicroBatcher
+from .id_mapping import IdMapping
+from .index_snapshot import SnapshotManager, SNAPSHOT_INDEX_FILE, SNAPSHOT_MAPPING_FILE
+from .feature_store import FeatureStore
 
 settings = get_settings()
 
+# 需要训练的倒排索引类型
+IVF_INDEX_TYPES = ("IndexIVFFlat", "IndexIVFPQ", "OPQ_IVFPQ")
+# 乘积量化压缩索引类型
+PQ_INDEX_TYPES = ("IndexIVFPQ", "OPQ_IVFPQ")
+# 8bit乘积量化每个子空间有256个聚类中心，每个中心至少需要39个训练样本
+PQ_MIN_TRAIN_VECTORS = 256 * 39
+# 支持的索引类型
+SUPPORTED_INDEX_TYPES = ("IndexFlatIP", "IndexFlatL2", "IndexHNSWFlat") + IVF_INDEX_TYPES
+
 
 class FaissService(LoggerMixin):
-    """Faiss索引服务类"""
+    """Faiss索引服务类
+    
+    索引中的向量使用显式的64位ID存储，faiss_id 即 images.id，
+    因此删除向量时可以直接按ID从索引中移除，不会留下墓碑数据。
+    HNSW图不支持删除节点，删除的ID在搜索时通过ID选择器排除，
+    占比过高时重建图回收内存。
+    """
     
-    def __init__(self):
+    def __init__(self, feature_store: Optional[FeatureStore] = None):
         self.index = None
         self.index_path = settings.faiss.index_path
         self.feature_dim = settings.faiss.feature_dim
         self.index_type = settings.faiss.index_type
-        self.executor = ThreadPoolExecutor(max_workers=2)
-        self.id_mapping = {}  # faiss_id -> image_id 的映射
-        self.reverse_mapping = {}  # image_id -> faiss_id 的映射
-        self.next_faiss_id = 0
+        self.load_mode = settings.faiss.load_mode
+        self._mmap_index = None  # 以内存映射方式加载的只读索引，首次写入前复制到内存
+        # 搜索、增删、持久化使用独立线程池，慢速保存或大批量写入不会占满搜索线程
+        self.search_executor = ThreadPoolExecutor(
+            max_workers=settings.faiss.search_threads, thread_name_prefix="faiss-search"
+        )
+        self.mutation_executor = ThreadPoolExecutor(
+            max_workers=settings.faiss.mutation_threads, thread_name_prefix="faiss-mutation"
+        )
+        self.persist_executor = ThreadPoolExecutor(
+            max_workers=settings.faiss.persist_threads, thread_name_prefix="faiss-persist"
+        )
+        self.id_mapping = IdMapping()  # faiss_id -> image_id 的映射
+        
+        # IVF训练状态：未训练前向量暂存在暴力搜索索引中
+        self._trained_ntotal = 0  # 最近一次训练时的语料规模
+        self._training_task: Optional[asyncio.Task] = None
+        
+        # HNSW已删除ID，搜索时排除，重建图后清空
+        self._deleted_ids = set()
+        self._deleted_selector = None
+        self._compaction_task: Optional[asyncio.Task] = None
+        self._index_epoch = 0  # 索引整体替换次数，用于检测后台重建期间的并发替换
+        self._generation = 0  # 索引内容版本，每次增删或替换递增，用于判断搜索结果缓存是否过期
+        self._insert_generation = 0  # 最近一次写入向量或整体替换索引时的内容版本
+        
+        # 特征存储（由应用统一管理），用于重新训练、重建图和压缩索引的重排序
+        self.feature_store = feature_store
         
+        # 在线重建状态
+        self._rebuild_task: Optional[asyncio.Task] = None
+        self._rebuild_cancel = threading.Event()
+        self._rebuild_status = {"status": "idle"}
+        
+        # 版本化快照：每次保存写入新目录，CURRENT 指针原子切换
+        self.snapshots = SnapshotManager(
+            os.path.join(os.path.dirname(self.index_path), "snapshots")
+        )
+        self._snapshot_version: Optional[str] = None
+        
+        # 持久化状态：变更只标记脏数据，由检查点任务按策略统一落盘
+        self._omp_threads = None
+        # 并发查询合并为一次批量搜索，按搜索参数分组
+        self._search_batcher = MicroBatcher(
+            self._run_search_batch,
+            max_batch_size=settings.faiss.search_batch_size,
+            max_wait_ms=settings.faiss.search_batch_wait_ms,
+            name="faiss-search"
+        )
+        self._rwlock = RWLock()  # 搜索和保存持有读锁，索引变更持有写锁
+        self._save_lock = threading.Lock()  # 串行化快照保存
+        self._dirty = False
+        self._pending_changes = 0
+        self._last_save_time = time.time()
+        self._checkpoint_task: Optional[asyncio.Task] = None
+    
     async def initialize(self):
         """初始化Faiss索引"""
         try:
@@ -43,94 +117,891 @@ class FaissService(LoggerMixin):
             if not os.path.exists(index_dir):
                 os.makedirs(index_dir, exist_ok=True)
             
+            self._configure_omp_threads()
+            
             # 在线程池中加载或创建索引
             await asyncio.get_event_loop().run_in_executor(
-                self.executor, self._load_or_create_index
+                self.mutation_executor, self._load_or_create_index
             )
             
-            self.logger.info(f"Faiss索引初始化完成，当前向量数量: {self.index.ntotal}, 下一个faiss_id: {self.next_faiss_id}")
+            # 启动后台检查点任务
+            self._checkpoint_task = asyncio.create_task(self._checkpoint_loop())
             
+            # 配置为IVF但尚未训练（或语料已显著增长）时，在后台训练
+            self._schedule_training()
+            
+            self.logger.info(f"Faiss索引初始化完成，当前向量数量: {self.index.ntotal}")
+        
         except Exception as e:
             self.logger.error(f"Faiss索引初始化失败: {e}")
             raise
     
+    def _configure_omp_threads(self):
+        """设置Faiss的OpenMP线程数，避免多个搜索线程各自占满全部核心造成过度订阅"""
+        omp_threads = settings.faiss.omp_threads
+        if omp_threads <= 0:
+            omp_threads = max(1, (os.cpu_count() or 1) // max(1, settings.faiss.search_threads))
+        faiss.omp_set_num_threads(omp_threads)
+        self._omp_threads = omp_threads
+        self.logger.info(
+            f"Faiss线程配置: 搜索线程={settings.faiss.search_threads}, OpenMP线程={omp_threads}"
+        )
+    
     def _load_or_create_index(self):
         """加载或创建索引（在线程池中执行）"""
+        # 优先加载校验通过的快照，CURRENT 损坏时回退到更早的快照
+        for version in self.snapshots.load_candidates():
+            if not self.snapshots.verify(version, settings.faiss.verify_checksums):
+                continue
+            try:
+                self._apply_snapshot(version, *self._read_snapshot(version))
+                self.logger.info(f"加载索引快照: {version} (模式: {self.load_mode})")
+                return
+            except Exception as e:
+                self.logger.warning(f"加载快照 {version} 失败: {e}")
+        
         if os.path.exists(self.index_path):
-            # 加载现有索引
-            self.logger.info(f"加载现有索引: {self.index_path}")
-            self.index = faiss.read_index(self.index_path)
+            # 加载旧版单文件索引，首次保存时转换为快照
+            self.logger.info(f"加载现有索引: {self.index_path} (模式: {self.load_mode})")
+            self.index, mmapped = self._read_index()
+            self._mmap_index = self.index if mmapped else None
+            
+            if not self._is_id_mapped(self.index):
+                # 旧版本索引使用位置ID，需要迁移为显式ID
+                self._migrate_legacy_index()
+                return
             
             # 加载ID映射
-            mapping_path = self.index_path.replace('.index', '_mapping.pkl')
-            if os.path.exists(mapping_path):
-                with open(mapping_path, 'rb') as f:
-                    mapping_data = pickle.load(f)
-                    self.id_mapping = mapping_data.get('id_mapping', {})
-                    self.reverse_mapping = mapping_data.get('reverse_mapping', {})
-                    self.next_faiss_id = mapping_data.get('next_faiss_id', 0)
+            if os.path.exists(self._mapping_path()):
+                self._load_mapping()
+            elif os.path.exists(self._legacy_mapping_path()):
+                # 旧版pickle映射，下次保存时转换为数组格式
+                self._load_legacy_pickle_mapping()
             else:
-                # 如果没有映射文件，从数据库重建映射
-                self._rebuild_mapping_from_db()
+                # 如果没有映射文件，直接从索引中的ID重建映射
+                self._rebuild_mapping_from_index()
+            
+            if self._is_ivf(self.index) and not self._trained_ntotal:
+                self._trained_ntotal = self.index.ntotal
         else:
             # 创建新索引
             self.logger.info(f"创建新索引: {self.index_type}")
-            if self.index_type == "IndexFlatIP":
-                # 内积索引（适合归一化后的向量）
-                self.index = faiss.IndexFlatIP(self.feature_dim)
-            elif self.index_type == "IndexFlatL2":
-                # L2距离索引
-                self.index = faiss.IndexFlatL2(self.feature_dim)
-            elif self.index_type == "IndexIVFFlat":
-                # IVF索引（倒排文件索引）
-                quantizer = faiss.IndexFlatIP(self.feature_dim)
-                self.index = faiss.IndexIVFFlat(quantizer, self.feature_dim, 100)
-            else:
-                # 默认使用内积索引
-                self.index = faiss.IndexFlatIP(self.feature_dim)
+            self.index = self._create_index()
+    
+    def _read_index(self, index_path: Optional[str] = None) -> Tuple[object, bool]:
+        """按配置的加载方式读取索引文件，返回 (索引, 是否为只读内存映射)
+        
+        只读取文件，不修改服务状态：读取的索引在持有写锁替换当前索引时才登记为映射索引。
+        """
+        index_path = index_path or self.index_path
+        if self.load_mode != "mmap":
+            return faiss.read_index(index_path), False
+        
+        # 只读映射，启动耗时与索引大小无关，页面由操作系统按需加载并在进程间共享
+        index = faiss.read_index(
+            index_path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+        )
+        return index, True
+    
+    def _ensure_writable(self):
+        """写入前将内存映射的只读索引复制到内存（需持有写锁）
+        
+        映射的数据不能原地修改，直接写入会导致Faiss断言失败终止进程。
+        """
+        if self._mmap_index is None or self.index is not self._mmap_index:
+            self._mmap_index = None
+            return
+        
+        self.logger.info("索引首次写入，从内存映射复制到内存...")
+        self.index = faiss.deserialize_index(faiss.serialize_index(self._mmap_index))
+        self._mmap_index = None
+    
+    def _create_index(self, index_type: Optional[str] = None):
+        """根据配置创建空索引
+        
+        Flat类索引本身只支持位置ID，需要用 IndexIDMap2 包装以支持
+        add_with_ids / remove_ids / 按ID重建向量。
+        IVF索引需要先训练，训练前向量暂存在内积暴力索引中，
+        达到 ivf_min_train_vectors 后由 _train_index_sync 迁移。
+        """
+        index_type = index_type or self.index_type
+        if index_type == "IndexFlatL2":
+            # L2距离索引
+            return faiss.IndexIDMap2(faiss.IndexFlatL2(self.feature_dim))
+        elif index_type == "IndexHNSWFlat":
+            # HNSW图索引，无需训练即可持续写入
+            hnsw_index = faiss.IndexHNSWFlat(
+                self.feature_dim, settings.faiss.hnsw_m, faiss.METRIC_INNER_PRODUCT
+            )
+            hnsw_index.hnsw.efConstruction = settings.faiss.hnsw_ef_construction
+            hnsw_index.hnsw.efSearch = settings.faiss.hnsw_ef_search
+            return faiss.IndexIDMap2(hnsw_index)
+        else:
+            # 内积索引（适合归一化后的向量），也是默认索引
+            return faiss.IndexIDMap2(faiss.IndexFlatIP(self.feature_dim))
+    
+    def _create_ivf_index(self, nlist: int, index_type: Optional[str] = None):
+        """创建未训练的IVF索引"""
+        index_type = index_type or self.index_type
+        quantizer = faiss.IndexFlatIP(self.feature_dim)
+        if index_type not in PQ_INDEX_TYPES:
+            return faiss.IndexIVFFlat(quantizer, self.feature_dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        
+        # 乘积量化：每个向量压缩为 pq_m 个字节
+        pq_m = self._choose_pq_m()
+        index = faiss.IndexIVFPQ(
+            quantizer, self.feature_dim, nlist, pq_m, 8, faiss.METRIC_INNER_PRODUCT
+        )
+        if index_type == "OPQ_IVFPQ":
+            # OPQ旋转使各子空间方差均衡，降低量化误差
+            index = faiss.IndexPreTransform(faiss.OPQMatrix(self.feature_dim, pq_m), index)
+        return index
+    
+    def _choose_pq_m(self) -> int:
+        """根据每向量字节预算选择子量化器个数（需整除特征维度）"""
+        budget = max(1, min(settings.faiss.pq_bytes_per_vector, self.feature_dim))
+        for pq_m in range(budget, 0, -1):
+            if self.feature_dim % pq_m == 0:
+                return pq_m
+        return 1
+    
+    def _min_train_vectors(self, index_type: Optional[str] = None) -> int:
+        """训练所需的最少向量数"""
+        if (index_type or self.index_type) in PQ_INDEX_TYPES:
+            return max(settings.faiss.ivf_min_train_vectors, PQ_MIN_TRAIN_VECTORS)
+        return settings.faiss.ivf_min_train_vectors
+    
+    def _reconstruct_vectors(self, faiss_ids: np.ndarray) -> np.ndarray:
+        """按ID取回向量，优先读取特征存储，其次从索引重建"""
+        if self.feature_store is None:
+            return self.index.reconstruct_batch(faiss_ids)
+        
+        vectors, found = self.feature_store.get(faiss_ids)
+        if not found.all():
+            vectors[~found] = self.index.reconstruct_batch(faiss_ids[~found])
+        return vectors
+    
+    def _choose_nlist(self, ntotal: int) -> int:
+        """根据语料规模选择倒排列表数量
+        
+        经验值为 4*sqrt(N)，同时保证每个聚类中心至少有39个训练样本。
+        """
+        if settings.faiss.nlist > 0:
+            nlist = settings.faiss.nlist
+        else:
+            nlist = int(4 * np.sqrt(ntotal))
+        return max(1, min(nlist, ntotal // 39))
+    
+    @staticmethod
+    def _is_ivf(index) -> bool:
+        """判断索引是否为IVF索引"""
+        return index is not None and faiss.try_extract_index_ivf(index) is not None
+    
+    def _needs_training(self) -> bool:
+        """判断当前索引是否需要（重新）训练"""
+        if self.index_type not in IVF_INDEX_TYPES or self.index is None:
+            return False
+        
+        ntotal = self.index.ntotal
+        if not self._is_ivf(self.index):
+            # 仍处于暴力搜索阶段，语料足够时开始训练
+            return ntotal >= self._min_train_vectors()
+        
+        # 语料增长超过阈值后重新训练，使nlist与语料规模匹配
+        return self._trained_ntotal > 0 and ntotal >= self._trained_ntotal * settings.faiss.ivf_retrain_growth
+    
+    def _schedule_training(self):
+        """需要时在后台启动训练任务，避免阻塞写入请求"""
+        if self._training_task is not None and not self._training_task.done():
+            return
+        if self.is_rebuilding():
+            return
+        if self._needs_training():
+            self._training_task = asyncio.create_task(self._train_index())
+    
+    async def _train_index(self):
+        """在独立线程中训练IVF索引，不占用搜索线程池"""
+        try:
+            trained = await asyncio.get_event_loop().run_in_executor(
+                None, self._train_index_sync
+            )
+            if trained:
+                await self._mark_dirty(self.index.ntotal)
+        except Exception as e:
+            self.logger.error(f"训练IVF索引失败: {e}")
+    
+    def _train_index_sync(self) -> bool:
+        """同步训练IVF索引并迁移全部向量
+        
+        先在读锁内采样训练数据，聚类训练在锁外进行，不阻塞写入；
+        再分块在读锁内取回向量写入新索引，最后在写锁内补齐期间的增删并整体替换，
+        期间旧索引继续提供搜索。
+        """
+        with self._rwlock.read():
+            if not self._needs_training():
+                return False
+            
+            epoch = self._index_epoch
+            faiss_ids = self.id_mapping.faiss_ids
+            nlist = self._choose_nlist(len(faiss_ids))
+            self.logger.info(f"开始训练IVF索引: 向量数={len(faiss_ids)}, nlist={nlist}")
             
-            # 为新索引从数据库重建映射
-            self._rebuild_mapping_from_db()
+            # 采样训练数据
+            sample_size = min(len(faiss_ids), max(settings.faiss.ivf_train_sample_size, nlist * 39))
+            rng = np.random.default_rng()
+            sample_ids = np.sort(rng.choice(faiss_ids, size=sample_size, replace=False))
+            train_vectors = self._reconstruct_vectors(sample_ids)
+        
+        new_index = self._create_ivf_index(nlist)
+        new_index.train(train_vectors)
+        # 哈希直接映射支持按ID重建和删除向量
+        faiss.extract_index_ivf(new_index).set_direct_map_type(faiss.DirectMap.Hashtable)
+        
+        # 分块迁移向量，避免一次性重建全部向量占用过多内存
+        with self._rwlock.read():
+            snapshot_ids = self.id_mapping.faiss_ids
+        chunk_size = 65536
+        for start in range(0, len(snapshot_ids), chunk_size):
+            chunk_ids = snapshot_ids[start:start + chunk_size]
+            with self._rwlock.read():
+                if self._index_epoch != epoch:
+                    return False
+                vectors = self._reconstruct_vectors(chunk_ids)
+            new_index.add_with_ids(vectors, chunk_ids)
+        
+        with self._rwlock.write():
+            if self._index_epoch != epoch:
+                # 训练期间索引已被整体替换（如在线重建），放弃本次结果
+                return False
+            
+            # 迁移期间可能有新增或删除，以当前映射为准补齐
+            faiss_ids = self.id_mapping.faiss_ids
+            added_ids = np.setdiff1d(faiss_ids, snapshot_ids)
+            removed_ids = np.setdiff1d(snapshot_ids, faiss_ids)
+            if len(added_ids):
+                new_index.add_with_ids(self._reconstruct_vectors(added_ids), added_ids)
+            if len(removed_ids):
+                new_index.remove_ids(removed_ids)
+            
+            self.index = new_index
+            self._index_epoch += 1
+            self._generation += 1
+            self._insert_generation = self._generation
+            self._trained_ntotal = len(faiss_ids)
+            self.logger.info(f"IVF索引训练完成: nlist={nlist}")
+            return True
     
-    def _rebuild_mapping_from_db(self):
-        """从数据库重建ID映射"""
+    @staticmethod
+    def _get_hnsw(index):
+        """返回索引内部的HNSW索引，非HNSW索引返回None"""
+        if index is None:
+            return None
+        if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            index = index.index
+        index = faiss.downcast_index(index)
+        return index if isinstance(index, faiss.IndexHNSW) else None
+    
+    def _needs_compaction(self) -> bool:
+        """判断HNSW图中已删除节点是否过多"""
+        if not self._deleted_ids or self._get_hnsw(self.index) is None:
+            return False
+        return len(self._deleted_ids) >= self.index.ntotal * settings.faiss.hnsw_compact_ratio
+    
+    def _schedule_compaction(self):
+        """需要时在后台重建HNSW图"""
+        if self._compaction_task is not None and not self._compaction_task.done():
+            return
+        if self.is_rebuilding():
+            return
+        if self._needs_compaction():
+            self._compaction_task = asyncio.create_task(self._compact_index())
+    
+    async def _compact_index(self):
+        """在独立线程中重建HNSW图"""
         try:
-            from sqlalchemy.orm import sessionmaker
-            from sqlalchemy import create_engine
+            compacted = await asyncio.get_event_loop().run_in_executor(
+                None, self._compact_index_sync
+            )
+            if compacted:
+                await self._mark_dirty(self.index.ntotal)
+        except Exception as e:
+            self.logger.error(f"重建HNSW图失败: {e}")
+    
+    def _compact_index_sync(self) -> bool:
+        """同步重建HNSW图，丢弃已删除节点
+        
+        按块在读锁内读取存活向量、在锁外插入新图，
+        最后在写锁内补齐重建期间的增删并整体替换。
+        """
+        with self._rwlock.read():
+            if not self._needs_compaction():
+                return False
+            epoch = self._index_epoch
+            snapshot_ids = self.id_mapping.faiss_ids
+            self.logger.info(
+                f"开始重建HNSW图: 存活向量={len(snapshot_ids)}, 已删除={len(self._deleted_ids)}"
+            )
+        
+        new_index = self._create_index()
+        chunk_size = 65536
+        for start in range(0, len(snapshot_ids), chunk_size):
+            chunk_ids = snapshot_ids[start:start + chunk_size]
+            with self._rwlock.read():
+                if self._index_epoch != epoch:
+                    return False
+                vectors = self._reconstruct_vectors(chunk_ids)
+            new_index.add_with_ids(vectors, chunk_ids)
+        
+        with self._rwlock.write():
+            if self._index_epoch != epoch:
+                # 重建期间索引已被整体替换，放弃本次结果
+                return False
             
-            # 创建数据库连接
-            engine = create_engine(settings.database.url)
-            SessionLocal = sessionmaker(bind=engine)
-            db = SessionLocal()
+            current_ids = self.id_mapping.faiss_ids
+            added_ids = np.setdiff1d(current_ids, snapshot_ids)
+            if len(added_ids):
+                new_index.add_with_ids(self._reconstruct_vectors(added_ids), added_ids)
             
-            try:
-                # 查询所有有效的图片记录
-                images = db.query(Image).filter(
-                    Image.is_active == True,
-                    Image.faiss_id.isnot(None)
-                ).order_by(Image.faiss_id).all()
-                
-                # 重建映射
-                for image in images:
-                    self.id_mapping[image.faiss_id] = image.id
-                    self.reverse_mapping[image.id] = image.faiss_id
-                
-                # 设置下一个可用的faiss_id
-                if images:
-                    max_faiss_id = max(image.faiss_id for image in images)
-                    self.next_faiss_id = max_faiss_id + 1
+            self.index = new_index
+            self._index_epoch += 1
+            self._generation += 1
+            # 重建期间删除的向量仍在新图中，继续作为墓碑排除
+            self._set_deleted_ids(set(np.setdiff1d(snapshot_ids, current_ids).tolist()))
+            self.logger.info(f"HNSW图重建完成，当前节点数: {new_index.ntotal}")
+            return True
+    
+    def _rebuild_hnsw_locked(self, exclude_ids: set):
+        """在写锁内同步重建HNSW图（用于重复写入已存在的ID）"""
+        exclude_ids = np.fromiter(exclude_ids, dtype=np.int64)
+        live_ids = self.id_mapping.faiss_ids
+        live_ids = live_ids[~np.isin(live_ids, exclude_ids)]
+        new_index = self._create_index()
+        if len(live_ids):
+            new_index.add_with_ids(self._reconstruct_vectors(live_ids), live_ids)
+        
+        self.id_mapping.remove(exclude_ids)
+        
+        self.index = new_index
+        self._index_epoch += 1
+        self._generation += 1
+        self._set_deleted_ids(set())
+    
+    def _set_deleted_ids(self, deleted_ids: set):
+        """更新已删除ID集合并使缓存的选择器失效"""
+        self._deleted_ids = deleted_ids
+        self._deleted_selector = None
+    
+    def _get_deleted_selector(self):
+        """构造排除已删除ID的选择器（缓存复用）"""
+        if not self._deleted_ids:
+            return None
+        
+        if self._deleted_selector is None:
+            batch = faiss.IDSelectorBatch(np.fromiter(self._deleted_ids, dtype=np.int64))
+            # 同时保存内部选择器的引用，避免被垃圾回收
+            self._deleted_selector = (faiss.IDSelectorNot(batch), batch)
+        return self._deleted_selector[0]
+    
+    def is_rebuilding(self) -> bool:
+        """是否有进行中的在线重建"""
+        return self._rebuild_task is not None and not self._rebuild_task.done()
+    
+    def get_rebuild_status(self) -> dict:
+        """获取在线重建进度"""
+        status = dict(self._rebuild_status)
+        if status.get("total"):
+            status["progress"] = round(status.get("processed", 0) / status["total"], 4)
+        return status
+    
+    async def start_rebuild(self, index_type: Optional[str] = None) -> dict:
+        """
+        在后台启动在线重建索引
+        
+        从数据库读取有效图像、从特征存储读取向量构建影子索引，
+        构建期间旧索引继续提供搜索，完成后整体替换。
+        
+        Args:
+            index_type: 目标索引类型，默认使用当前配置
+        
+        Returns:
+            重建进度
+        """
+        if self.is_rebuilding():
+            raise RuntimeError("索引重建任务正在进行中")
+        
+        index_type = index_type or settings.faiss.index_type
+        if index_type not in SUPPORTED_INDEX_TYPES:
+            raise ValueError(f"不支持的索引类型: {index_type}，可选: {SUPPORTED_INDEX_TYPES}")
+        
+        self._rebuild_cancel.clear()
+        self._rebuild_status = {
+            "status": "running",
+            "stage": "pending",
+            "index_type": index_type,
+            "total": 0,
+            "processed": 0,
+            "missing": 0,
+            "started_at": time.time(),
+            "finished_at": None,
+            "version_id": None,
+            "error": None
+        }
+        self._rebuild_task = asyncio.create_task(self._rebuild_index(index_type))
+        return self.get_rebuild_status()
+    
+    async def _rebuild_index(self, index_type: str):
+        """在独立线程中执行重建，不阻塞事件循环"""
+        try:
+            version_id = await asyncio.get_event_loop().run_in_executor(
+                None, self._rebuild_index_sync, index_type
+            )
+            self._rebuild_status.update({
+                "status": "completed",
+                "stage": "done",
+                "version_id": version_id,
+                "finished_at": time.time()
+            })
+            self.logger.info(f"索引重建完成: {index_type}, 当前向量数量: {self.index.ntotal}")
+            self._schedule_training()
+        except Exception as e:
+            self.logger.error(f"重建索引失败: {e}")
+            self._rebuild_status.update({
+                "status": "failed",
+                "error": str(e),
+                "finished_at": time.time()
+            })
+    
+    def _rebuild_index_sync(self, index_type: str) -> Optional[int]:
+        """同步重建索引（在线程中执行），返回新的索引版本记录ID"""
+        status = self._rebuild_status
+        status["stage"] = "loading"
+        image_ids = self._load_active_image_ids()
+        status["total"] = len(image_ids)
+        
+        with self._rwlock.read():
+            # 记录开始时的映射，替换时据此补齐重建期间的增删
+            snapshot_ids = self.id_mapping.faiss_ids
+        
+        is_ivf = index_type in IVF_INDEX_TYPES and len(image_ids) >= self._min_train_vectors(index_type)
+        if is_ivf:
+            status["stage"] = "training"
+            nlist = self._choose_nlist(len(image_ids))
+            sample_size = min(len(image_ids), max(settings.faiss.ivf_train_sample_size, nlist * 39))
+            sample_ids = np.random.default_rng().choice(image_ids, size=sample_size, replace=False)
+            train_vectors = np.vstack([
+                vectors for _, vectors in self._iter_rebuild_vectors(sample_ids)
+            ])
+            new_index = self._create_ivf_index(nlist, index_type)
+            new_index.train(train_vectors)
+            faiss.extract_index_ivf(new_index).set_direct_map_type(faiss.DirectMap.Hashtable)
+        else:
+            # IVF类型语料不足时同样先使用暴力索引，达到规模后自动训练
+            new_index = self._create_index(index_type)
+        
+        status["stage"] = "building"
+        built = []
+        for ids, vectors in self._iter_rebuild_vectors(image_ids):
+            new_index.add_with_ids(vectors, ids)
+            built.append(ids)
+            status["processed"] += len(ids)
+        built_ids = np.sort(np.concatenate(built)) if built else np.empty(0, dtype=np.int64)
+        status["missing"] = len(image_ids) - len(built_ids)
+        if status["missing"]:
+            self.logger.warning(f"重建索引时有{status['missing']}张图像缺少特征向量，已跳过")
+        
+        status["stage"] = "swapping"
+        with self._rwlock.write():
+            live_ids = self.id_mapping.faiss_ids
+            # 重建期间新增的向量补写入新索引，删除的向量从新索引移除
+            added_ids = np.setdiff1d(np.setdiff1d(live_ids, snapshot_ids), built_ids)
+            removed_ids = np.intersect1d(built_ids, np.setdiff1d(snapshot_ids, live_ids))
+            if len(added_ids):
+                new_index.add_with_ids(self._reconstruct_vectors(added_ids), added_ids)
+            
+            deleted_ids = set()
+            if len(removed_ids):
+                if self._get_hnsw(new_index) is not None:
+                    deleted_ids = set(removed_ids.tolist())
                 else:
-                    self.next_faiss_id = 0
-                
-                self.logger.info(f"从数据库重建映射完成，下一个可用faiss_id: {self.next_faiss_id}")
-                
-            finally:
-                db.close()
-                
+                    new_index.remove_ids(removed_ids)
+            
+            final_ids = np.union1d(np.setdiff1d(built_ids, removed_ids), added_ids)
+            self.index = new_index
+            self.index_type = index_type
+            self._index_epoch += 1
+            self._generation += 1
+            self._insert_generation = self._generation
+            self.id_mapping = IdMapping.from_pairs(final_ids, final_ids)
+            self._set_deleted_ids(deleted_ids)
+            self._trained_ntotal = len(final_ids) if is_ivf else 0
+            self._dirty = True
+        
+        status["stage"] = "saving"
+        version_id = self._save_index_sync()
+        self._update_db_faiss_ids(final_ids.tolist())
+        return version_id
+    
+    def _iter_rebuild_vectors(self, image_ids: np.ndarray, batch_size: int = 65536):
+        """分批读取重建所需的向量：优先顺序读取特征存储，缺失的从当前索引取回"""
+        found = []
+        if self.feature_store is not None:
+            for ids, vectors in self.feature_store.iter_batches(image_ids, batch_size):
+                self._check_rebuild_cancelled()
+                found.append(ids)
+                yield ids, vectors
+        
+        remaining = np.setdiff1d(image_ids, np.concatenate(found)) if found else np.unique(image_ids)
+        for start in range(0, len(remaining), batch_size):
+            self._check_rebuild_cancelled()
+            chunk_ids = remaining[start:start + batch_size]
+            with self._rwlock.read():
+                chunk_ids = chunk_ids[self.id_mapping.contains(chunk_ids)]
+                if not len(chunk_ids):
+                    continue
+                vectors = self.index.reconstruct_batch(chunk_ids)
+            yield chunk_ids, vectors
+    
+    def _check_rebuild_cancelled(self):
+        """服务关闭时中止重建"""
+        if self._rebuild_cancel.is_set():
+            raise RuntimeError("索引重建已取消")
+    
+    def _load_active_image_ids(self) -> np.ndarray:
+        """从数据库读取全部有效图像ID"""
+        db = SessionLocal()
+        try:
+            rows = db.query(Image.id).filter(Image.is_active == True).all()
+            return np.unique(np.array([row.id for row in rows], dtype=np.int64))
+        finally:
+            db.close()
+    
+    def _record_index_version(self, index_path: str, total_vectors: int,
+                              index_type: str) -> Optional[int]:
+        """在 faiss_index_info 中把指定快照标记为当前版本（不存在时新增记录）"""
+        db = SessionLocal()
+        try:
+            db.query(FaissIndexInfo).filter(FaissIndexInfo.is_current == True).update(
+                {FaissIndexInfo.is_current: False}, synchronize_session=False
+            )
+            index_info = db.query(FaissIndexInfo).filter(
+                FaissIndexInfo.index_path == index_path
+            ).order_by(FaissIndexInfo.id.desc()).first()
+            if index_info is None:
+                index_info = FaissIndexInfo(
+                    index_path=index_path,
+                    total_vectors=total_vectors,
+                    feature_dim=self.feature_dim,
+                    index_type=index_type
+                )
+                db.add(index_info)
+            index_info.is_current = True
+            db.commit()
+            return index_info.id
+        except Exception as e:
+            db.rollback()
+            self.logger.error(f"记录索引版本失败: {e}")
+            return None
+        finally:
+            db.close()
+    
+    def _forget_index_versions(self) -> int:
+        """删除已被清理的快照对应的 faiss_index_info 记录，表中只保留磁盘上仍存在的快照"""
+        existing = [self.snapshots.path(version) for version in self.snapshots.list_versions()]
+        db = SessionLocal()
+        try:
+            removed = db.query(FaissIndexInfo).filter(
+                FaissIndexInfo.is_current == False,
+                FaissIndexInfo.index_path.startswith(self.snapshots.path(""), autoescape=True),
+                ~FaissIndexInfo.index_path.in_(existing)
+            ).delete(synchronize_session=False)
+            db.commit()
+            return removed
+        except Exception as e:
+            db.rollback()
+            self.logger.error(f"清理索引版本记录失败: {e}")
+            return 0
+        finally:
+            db.close()
+    
+    def _read_snapshot(self, version: str):
+        """读取快照，返回 (索引, 是否内存映射, ID映射, 清单)，数量与清单不符时抛出异常"""
+        snapshot_dir = self.snapshots.path(version)
+        manifest = self.snapshots.load_manifest(version)
+        index, mmapped = self._read_index(os.path.join(snapshot_dir, SNAPSHOT_INDEX_FILE))
+        id_mapping = IdMapping.load(
+            os.path.join(snapshot_dir, SNAPSHOT_MAPPING_FILE), mmap=self.load_mode == "mmap"
+        )
+        
+        if index.ntotal != manifest.get("total_vectors") or len(id_mapping) != manifest.get("mapping_count"):
+            raise ValueError(
+                f"向量数量与清单不符: 索引{index.ntotal}/{manifest.get('total_vectors')}, "
+                f"映射{len(id_mapping)}/{manifest.get('mapping_count')}"
+            )
+        return index, mmapped, id_mapping, manifest
+    
+    def _apply_snapshot(self, version: str, index, mmapped: bool, id_mapping: IdMapping, manifest: dict):
+        """将读取的快照设为当前索引（运行中调用时需持有写锁）"""
+        index_type = manifest.get("index_type", self.index_type)
+        if index_type != self.index_type:
+            self.logger.warning(f"快照索引类型 {index_type} 与配置 {self.index_type} 不同，沿用快照类型")
+        
+        self.index = index
+        # 与索引在同一把写锁内切换，写入方不会看到新旧状态交错
+        self._mmap_index = index if mmapped else None
+        self.index_type = index_type
+        self.id_mapping = id_mapping
+        self._trained_ntotal = manifest.get("trained_ntotal", 0)
+        self._set_deleted_ids(set(manifest.get("deleted_ids", [])))
+        self._snapshot_version = version
+        self._index_epoch += 1
+        self._generation += 1
+        self._insert_generation = self._generation
+    
+    def list_snapshots(self) -> List[dict]:
+        """列出全部快照及其清单信息（从新到旧）"""
+        snapshots = []
+        for version in reversed(self.snapshots.list_versions()):
+            try:
+                manifest = self.snapshots.load_manifest(version)
+            except Exception:
+                manifest = {}
+            snapshots.append({
+                "version": version,
+                "is_current": version == self._snapshot_version,
+                "index_type": manifest.get("index_type"),
+                "total_vectors": manifest.get("total_vectors"),
+                "created_at": manifest.get("created_at")
+            })
+        return snapshots
+    
+    async def rollback(self, version: Optional[str] = None) -> dict:
+        """
+        回滚到指定快照，默认回滚到当前快照的上一个版本
+        
+        快照之后的增删不在回滚后的索引中，随后对照数据库修正：快照之后入库的图片重置为 pending
+        交给建索引队列补做，快照之后停用的图片从索引中再次移除。
+        """
+        if self.is_rebuilding():
+            raise RuntimeError("索引重建任务正在进行中，无法回滚")
+        
+        loop = asyncio.get_event_loop()
+        result = await loop.run_in_executor(None, self._rollback_sync, version)
+        
+        try:
+            inactive_ids, reset = await loop.run_in_executor(None, self._reconcile_after_rollback_sync)
+            removed = await self.remove_images(inactive_ids) if inactive_ids else 0
+            result.update({"reset_to_pending": reset, "removed_inactive": removed})
+            self.logger.info(f"回滚后重置{reset}张图片为待建索引，移除{removed}个已停用图片的向量")
+        except Exception as e:
+            self.logger.error(f"回滚后同步数据库索引状态失败，请执行在线重建: {e}")
+            result["reconcile_error"] = str(e)
+        return result
+    
+    def _reconcile_after_rollback_sync(self, chunk_size: int = 1000) -> Tuple[List[int], int]:
+        """
+        对照回滚后的ID映射修正数据库中的索引状态
+        
+        Returns:
+            (仍在索引中的已停用图像ID, 重置为 pending 的图片数量)
+        """
+        db = SessionLocal()
+        try:
+            image_ids, active, indexed = [], [], []
+            for row in db.query(Image.id, Image.is_active, Image.index_status).yield_per(10000):
+                image_ids.append(row.id)
+                active.append(bool(row.is_active))
+                indexed.append(row.index_status == INDEX_STATUS_INDEXED)
+            image_ids = np.asarray(image_ids, dtype=np.int64)
+            active = np.asarray(active, dtype=bool)
+            indexed = np.asarray(indexed, dtype=bool)
+            with self._rwlock.read():
+                in_index = self.id_mapping.contains(image_ids)
+            
+            # 标记为已索引但不在回滚后索引中的图片
+            missing = image_ids[active & indexed & ~in_index].tolist()
+            for start in range(0, len(missing), chunk_size):
+                db.query(Image).filter(Image.id.in_(missing[start:start + chunk_size])).update(
+                    {Image.index_status: INDEX_STATUS_PENDING, Image.faiss_id: None},
+                    synchronize_session=False
+                )
+            db.commit()
+            return image_ids[~active & in_index].tolist(), len(missing)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+    
+    def _rollback_sync(self, version: Optional[str] = None) -> dict:
+        """同步回滚（在线程中执行）"""
+        versions = self.snapshots.list_versions()
+        if version is not None:
+            if version not in versions:
+                raise ValueError(f"快照不存在: {version}")
+            candidates = [version]
+        else:
+            current = self._snapshot_version
+            candidates = [v for v in reversed(versions) if current is None or v < current]
+        
+        for candidate in candidates:
+            if not self.snapshots.verify(candidate, check_checksums=True):
+                continue
+            try:
+                index, mmapped, id_mapping, manifest = self._read_snapshot(candidate)
+            except Exception as e:
+                self.logger.warning(f"读取快照 {candidate} 失败: {e}")
+                continue
+            
+            with self._rwlock.write():
+                self._apply_snapshot(candidate, index, mmapped, id_mapping, manifest)
+                self.snapshots.promote(candidate)
+                # 未保存的变更随回滚一并丢弃
+                self._dirty = False
+                self._pending_changes = 0
+            
+            self._record_index_version(
+                self.snapshots.path(candidate), index.ntotal, manifest.get("index_type", self.index_type)
+            )
+            self.logger.warning(f"索引已回滚到快照: {candidate}, 向量数量: {index.ntotal}")
+            return {
+                "version": candidate,
+                "index_type": self.index_type,
+                "total_vectors": index.ntotal
+            }
+        
+        raise ValueError("没有可回滚的有效快照")
+    
+    @staticmethod
+    def _is_id_mapped(index) -> bool:
+        """判断索引是否支持显式ID"""
+        return isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)) or FaissService._is_ivf(index)
+    
+    def _mapping_path(self) -> str:
+        """ID映射文件路径（int64数组）"""
+        return self.index_path.replace('.index', '_mapping.npy')
+    
+    def _state_path(self) -> str:
+        """索引状态文件路径（训练规模、已删除ID）"""
+        return self.index_path.replace('.index', '_state.json')
+    
+    def _legacy_mapping_path(self) -> str:
+        """旧版pickle映射文件路径"""
+        return self.index_path.replace('.index', '_mapping.pkl')
+    
+    def _load_mapping(self):
+        """加载数组格式的ID映射和索引状态"""
+        # mmap 模式下映射同样按需换页，启动时不读入整个文件
+        self.id_mapping = IdMapping.load(self._mapping_path(), mmap=self.load_mode == "mmap")
+        
+        state_path = self._state_path()
+        if os.path.exists(state_path):
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            self._trained_ntotal = state.get('trained_ntotal', 0)
+            self._deleted_ids = set(state.get('deleted_ids', []))
+    
+    def _load_legacy_pickle_mapping(self):
+        """加载旧版pickle格式的ID映射"""
+        with open(self._legacy_mapping_path(), 'rb') as f:
+            mapping_data = pickle.load(f)
+        
+        id_mapping = mapping_data.get('id_mapping', {})
+        self.id_mapping = IdMapping.from_pairs(id_mapping.keys(), id_mapping.values())
+        self._trained_ntotal = mapping_data.get('trained_ntotal', 0)
+        self._deleted_ids = set(mapping_data.get('deleted_ids', []))
+        # 标记为脏数据，由检查点转换为数组格式保存
+        self._dirty = True
+    
+    def _rebuild_mapping_from_index(self):
+        """从索引中存储的ID重建映射"""
+        if isinstance(self.index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            faiss_ids = faiss.vector_to_array(self.index.id_map)
+        else:
+            faiss_ids = self._collect_ivf_ids(self.index)
+        
+        # faiss_id 即图像ID
+        self.id_mapping = IdMapping.from_pairs(faiss_ids, faiss_ids)
+        
+        self.logger.info(f"从索引重建映射完成，共{len(self.id_mapping)}条")
+    
+    @staticmethod
+    def _collect_ivf_ids(index) -> np.ndarray:
+        """收集IVF索引中全部倒排列表的ID"""
+        ivf = faiss.extract_index_ivf(index)
+        invlists = ivf.invlists
+        ids = []
+        for list_no in range(ivf.nlist):
+            list_size = invlists.list_size(list_no)
+            if list_size == 0:
+                continue
+            ids.append(faiss.rev_swig_ptr(invlists.get_ids(list_no), list_size).copy())
+        return np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+    
+    def _migrate_legacy_index(self):
+        """将旧版位置ID索引迁移为以图像ID为键的索引
+        
+        旧索引中第 i 个向量对应 id_mapping[i]，迁移后向量以图像ID重新写入，
+        同时把数据库中的 faiss_id 更新为图像ID。
+        """
+        self.logger.info("检测到旧版位置ID索引，开始迁移为显式ID索引...")
+        legacy_mapping = {}
+        mapping_path = self._legacy_mapping_path()
+        if os.path.exists(mapping_path):
+            with open(mapping_path, 'rb') as f:
+                legacy_mapping = pickle.load(f).get('id_mapping', {})
+        else:
+            legacy_mapping = self._load_legacy_mapping_from_db()
+        
+        legacy_index = self.index
+        positions = [pos for pos in sorted(legacy_mapping) if 0 <= pos < legacy_index.ntotal]
+        
+        self.index = self._create_index()
+        self.id_mapping = IdMapping()
+        
+        if positions:
+            vectors = np.vstack([legacy_index.reconstruct(int(pos)) for pos in positions])
+            image_ids = [legacy_mapping[pos] for pos in positions]
+            if self.feature_store is not None:
+                # 旧版本没有特征存储，迁移时一并回填
+                self.feature_store.append(image_ids, vectors)
+            self._add_vectors_sync(vectors, image_ids)
+            self._update_db_faiss_ids(image_ids)
+        
+        self._save_index_sync()
+        self.logger.info(f"旧版索引迁移完成，共迁移{len(positions)}个向量")
+    
+    def _load_legacy_mapping_from_db(self) -> dict:
+        """从数据库读取旧版 位置ID -> 图像ID 映射"""
+        db = SessionLocal()
+        try:
+            images = db.query(Image).filter(
+                Image.is_active == True,
+                Image.faiss_id.isnot(None)
+            ).all()
+            return {image.faiss_id: image.id for image in images}
+        except Exception as e:
+            self.logger.error(f"从数据库读取旧版映射失败: {e}")
+            return {}
+        finally:
+            db.close()
+    
+    def _update_db_faiss_ids(self, image_ids: List[int]):
+        """迁移后将数据库中的faiss_id统一为图像ID"""
+        db = SessionLocal()
+        try:
+            # 先清空再回填，避免逐行更新时触发唯一约束冲突
+            db.query(Image).filter(Image.faiss_id.isnot(None)).update(
+                {Image.faiss_id: None}, synchronize_session=False
+            )
+            db.query(Image).filter(Image.id.in_(image_ids)).update(
+                {Image.faiss_id: Image.id}, synchronize_session=False
+            )
+            db.commit()
         except Exception as e:
-            self.logger.error(f"重建映射失败: {e}")
-            # 如果重建失败，至少确保不会从0开始
-            self.next_faiss_id = 1000
+            db.rollback()
+            self.logger.error(f"更新数据库faiss_id失败: {e}")
+        finally:
+            db.close()
     
     async def add_vector(self, feature_vector: np.ndarray, image_id: int) -> int:
         """
@@ -141,128 +1012,581 @@ class FaissService(LoggerMixin):
             image_id: 图像ID
             
         Returns:
-            Faiss索引中的ID
+            Faiss索引中的ID（与图像ID相同）
+        """
+        faiss_ids = await self.add_vectors(feature_vector, [image_id])
+        return faiss_ids[0]
+    
+    async def add_vectors(self, feature_matrix: np.ndarray, image_ids: List[int]) -> List[int]:
+        """
+        批量添加特征向量到索引
+        
+        向量写入内存索引后只标记为脏数据，由持久化策略决定何时落盘，
+        因此单次写入的开销与索引规模无关。
+        
+        Args:
+            feature_matrix: 特征矩阵，形状为 (N, feature_dim)
+            image_ids: 与每一行对应的图像ID
+        
+        Returns:
+            Faiss索引中的ID列表（与图像ID相同）
         """
         try:
-            faiss_id = await asyncio.get_event_loop().run_in_executor(
-                self.executor, self._add_vector_sync, feature_vector, image_id
+            faiss_ids = await asyncio.get_event_loop().run_in_executor(
+                self.mutation_executor, self._add_vectors_sync, feature_matrix, list(image_ids)
             )
             
-            # 保存索引
-            await self._save_index()
+            await self._mark_dirty(len(faiss_ids))
+            self._schedule_training()
             
-            return faiss_id
+            return faiss_ids
         except Exception as e:
             self.logger.error(f"添加向量失败: {e}")
             raise
     
-    def _add_vector_sync(self, feature_vector: np.ndarray, image_id: int) -> int:
+    def _add_vectors_sync(self, feature_vectors: np.ndarray, image_ids: List[int]) -> List[int]:
         """同步添加向量（在线程池中执行）"""
         # 确保向量是二维的
-        if feature_vector.ndim == 1:
-            feature_vector = feature_vector.reshape(1, -1)
+        if feature_vectors.ndim == 1:
+            feature_vectors = feature_vectors.reshape(1, -1)
         
         # 检查向量维度
-        if feature_vector.shape[1] != self.feature_dim:
-            raise ValueError(f"特征向量维度不匹配: 期望{self.feature_dim}, 实际{feature_vector.shape[1]}")
+        if feature_vectors.shape[1] != self.feature_dim:
+            raise ValueError(f"特征向量维度不匹配: 期望{self.feature_dim}, 实际{feature_vectors.shape[1]}")
+        
+        if feature_vectors.shape[0] != len(image_ids):
+            raise ValueError(f"向量数量与图像ID数量不一致: {feature_vectors.shape[0]} != {len(image_ids)}")
+        
+        # faiss_id 直接使用图像ID
+        faiss_ids = np.asarray(image_ids, dtype=np.int64)
+        
+        with self._rwlock.write():
+            self._ensure_writable()
+            
+            # 已存在的ID先移除，保证同一图像只有一个向量
+            if self._get_hnsw(self.index) is not None:
+                # HNSW无法删除节点，同一ID重复写入时需重建图
+                existing = set(faiss_ids[self.id_mapping.contains(faiss_ids)].tolist())
+                existing |= self._deleted_ids.intersection(faiss_ids.tolist())
+                if existing:
+                    self._rebuild_hnsw_locked(existing)
+            else:
+                existing = faiss_ids[self.id_mapping.contains(faiss_ids)]
+                if len(existing):
+                    self.index.remove_ids(existing)
+            
+            # 添加到索引
+            self.index.add_with_ids(
+                np.ascontiguousarray(feature_vectors, dtype=np.float32), faiss_ids
+            )
+            
+            # 更新映射
+            self.id_mapping.add(faiss_ids, faiss_ids)
+            self._generation += 1
+            self._insert_generation = self._generation
+        
+        return faiss_ids.tolist()
+    
+    async def remove_vectors(self, faiss_ids: Iterable[int]) -> int:
+        """
+        从索引中批量移除向量
+        
+        Args:
+            faiss_ids: 要移除的Faiss ID列表
+        
+        Returns:
+            实际移除的向量数量
+        """
+        faiss_ids = [int(faiss_id) for faiss_id in faiss_ids]
+        if not faiss_ids:
+            return 0
+        
+        try:
+            removed = await asyncio.get_event_loop().run_in_executor(
+                self.mutation_executor, self._remove_vectors_sync, faiss_ids
+            )
+            
+            if removed:
+                await self._mark_dirty(removed)
+                self._schedule_compaction()
+            
+            return removed
+        except Exception as e:
+            self.logger.error(f"移除向量失败: {e}")
+            raise
+    
+    def _remove_vectors_sync(self, faiss_ids: List[int]) -> int:
+        """同步移除向量（在线程池中执行）"""
+        with self._rwlock.write():
+            present = self.id_mapping.remove(faiss_ids)
+            if not len(present):
+                return 0
+            self._generation += 1
+            
+            if self._get_hnsw(self.index) is not None:
+                # HNSW记录为已删除，搜索时由选择器排除，不占用k
+                self._set_deleted_ids(self._deleted_ids | set(present.tolist()))
+                removed = len(present)
+            else:
+                # 按ID真正从索引中删除，释放扫描时间和内存
+                self._ensure_writable()
+                removed = self.index.remove_ids(present)
+        
+        return int(removed)
+    
+    async def remove_images(self, image_ids: Iterable[int]) -> int:
+        """
+        按图像ID批量移除向量
         
-        # 分配Faiss ID
-        faiss_id = self.next_faiss_id
-        self.next_faiss_id += 1
+        Args:
+            image_ids: 图像ID列表
         
-        # 更新映射
-        self.id_mapping[faiss_id] = image_id
-        self.reverse_mapping[image_id] = faiss_id
+        Returns:
+            实际移除的向量数量
+        """
+        return await self.remove_vectors(self._present_ids(image_ids).tolist())
+    
+    async def remove_image(self, image_id: int) -> bool:
+        """按图像ID移除向量，返回是否有向量被移除"""
+        return await self.remove_images([image_id]) > 0
+    
+    async def get_vector(self, image_id: int) -> Optional[np.ndarray]:
+        """按图像ID取回已入库的向量（优先读取特征存储，其次从索引重建），不存在时返回None"""
+        return await asyncio.get_event_loop().run_in_executor(
+            self.search_executor, self._get_vector_sync, image_id
+        )
+    
+    def _get_vector_sync(self, image_id: int) -> Optional[np.ndarray]:
+        with self._rwlock.read():
+            faiss_ids = self._present_ids([image_id])
+            if not len(faiss_ids):
+                return None
+            return np.asarray(self._reconstruct_vectors(faiss_ids[:1])[0], dtype=np.float32)
+    
+    def _present_ids(self, image_ids: Iterable[int]) -> np.ndarray:
+        """返回其中在索引中的图像ID，即对应的 faiss_id（二者相同，无需按图像ID反查映射）"""
+        image_ids = np.asarray(list(image_ids), dtype=np.int64)
+        return image_ids[self.id_mapping.contains(image_ids)]
+    
+    def indexed_image_ids(self) -> np.ndarray:
+        """当前索引中全部图像ID（升序）"""
+        return np.unique(self.id_mapping.image_ids)
+    
+    @property
+    def scores_descending(self) -> bool:
+        """搜索得分是否越大越相似（内积为True，L2距离为False）"""
+        return self.index.metric_type == faiss.METRIC_INNER_PRODUCT
+    
+    def contains_images(self, image_ids: Iterable[int]) -> np.ndarray:
+        """批量判断图像是否在索引中，返回布尔掩码"""
+        return self.id_mapping.contains(np.asarray(list(image_ids), dtype=np.int64))
+    
+    async def search_neighbors(self, image_ids: Iterable[int],
+                               k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        以已入库的向量批量搜索每张图像的k近邻（不含自身），用于预计算近邻表
         
-        # 添加到索引
-        self.index.add(feature_vector.astype(np.float32))
+        Returns:
+            (有向量的图像ID, (n, k) 近邻图像ID矩阵, (n, k) 相似度矩阵)，不足k个时以-1和0填充
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            self.search_executor, self._search_neighbors_sync, image_ids, k
+        )
+    
+    def _search_neighbors_sync(self, image_ids: Iterable[int],
+                               k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        with self._rwlock.read():
+            query_ids, faiss_ids = self._lookup_indexed(image_ids)
+            if not len(faiss_ids):
+                return query_ids, np.empty((0, k), dtype=np.int64), np.empty((0, k), dtype=np.float32)
+            # 多取一个结果，去掉查询图像本身
+            results = self._search_locked(self._reconstruct_vectors(faiss_ids), [k + 1] * len(faiss_ids))
         
-        return faiss_id
+        neighbors = np.full((len(query_ids), k + 1), -1, dtype=np.int64)
+        scores = np.zeros((len(query_ids), k + 1), dtype=np.float32)
+        for row, (row_scores, row_ids) in enumerate(results):
+            neighbors[row, :len(row_ids)] = row_ids
+            scores[row, :len(row_scores)] = row_scores
+        return self._drop_self_neighbors(query_ids, neighbors, scores, k)
     
-    async def search(self, query_vector: np.ndarray, k: int = 10) -> Tuple[List[float], List[int]]:
+    async def search_among(self, image_ids: Iterable[int], candidate_image_ids: Iterable[int],
+                           k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        以已入库的向量在指定候选图像中精确搜索k近邻（不含自身），用于增量刷新近邻表
+        
+        Returns:
+            与 search_neighbors 相同
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            self.search_executor, self._search_among_sync, image_ids, candidate_image_ids, k
+        )
+    
+    def _search_among_sync(self, image_ids: Iterable[int], candidate_image_ids: Iterable[int],
+                           k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        with self._rwlock.read():
+            query_ids, faiss_ids = self._lookup_indexed(image_ids)
+            candidate_ids, candidate_faiss_ids = self._lookup_indexed(candidate_image_ids)
+            if not len(faiss_ids) or not len(candidate_faiss_ids):
+                return (query_ids, np.full((len(query_ids), k), -1, dtype=np.int64),
+                        np.zeros((len(query_ids), k), dtype=np.float32))
+            query_vectors = self._reconstruct_vectors(faiss_ids)
+            candidate_vectors = self._reconstruct_vectors(candidate_faiss_ids)
+            metric_type = self.index.metric_type
+        
+        # 候选通常很少，临时建立暴力索引
+        candidate_index = faiss.IndexFlat(self.feature_dim, metric_type)
+        candidate_index.add(np.ascontiguousarray(candidate_vectors, dtype=np.float32))
+        search_k = min(k + 1, len(candidate_ids))
+        found_scores, rows = candidate_index.search(np.ascontiguousarray(query_vectors, dtype=np.float32), search_k)
+        
+        neighbors = np.full((len(query_ids), k + 1), -1, dtype=np.int64)
+        scores = np.zeros((len(query_ids), k + 1), dtype=np.float32)
+        neighbors[:, :search_k] = np.where(rows >= 0, candidate_ids[rows], -1)
+        scores[:, :search_k] = found_scores
+        return self._drop_self_neighbors(query_ids, neighbors, scores, k)
+    
+    def _lookup_indexed(self, image_ids: Iterable[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """返回在索引中的图像ID（去重）及对应的 faiss_id"""
+        faiss_ids = self._present_ids(np.unique(np.asarray(list(image_ids), dtype=np.int64)))
+        return faiss_ids, faiss_ids
+    
+    @staticmethod
+    def _drop_self_neighbors(query_ids: np.ndarray, neighbors: np.ndarray, scores: np.ndarray,
+                             k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """从 (n, k+1) 的结果中去掉查询图像本身，保留前k列"""
+        # 稳定排序把自身和填充位移到末尾，其余保持相似度顺序
+        order = np.argsort((neighbors == query_ids[:, None]) | (neighbors < 0), axis=1, kind='stable')[:, :k]
+        neighbors = np.take_along_axis(neighbors, order, axis=1)
+        scores = np.take_along_axis(scores, order, axis=1)
+        neighbors[neighbors == query_ids[:, None]] = -1
+        scores[neighbors < 0] = 0
+        return query_ids, neighbors, scores
+    
+    async def search(self, query_vector: np.ndarray, k: int = 10,
+                     nprobe: Optional[int] = None,
+                     ef_search: Optional[int] = None,
+                     exclude_image_ids: Optional[Iterable[int]] = None) -> Tuple[List[float], List[int]]:
         """
         搜索最相似的向量
         
         Args:
             query_vector: 查询向量
             k: 返回的结果数量
-            
+            nprobe: IVF索引探测的倒排列表数量，默认使用 FaissConfig.nprobe
+            ef_search: HNSW搜索候选队列长度，默认使用 FaissConfig.hnsw_ef_search
+            exclude_image_ids: 在Faiss内部排除的图像ID（如以图搜图时的查询图片本身），不占用k
+        
         Returns:
             (相似度得分列表, 图像ID列表)
         """
         try:
+            # 确保查询向量是一维的，维度错误在入队前拒绝，不影响同批的其他查询
+            query_vector = np.atleast_2d(np.asarray(query_vector, dtype=np.float32))[0]
+            if query_vector.shape[0] != self.feature_dim:
+                raise ValueError(f"查询向量维度不匹配: 期望{self.feature_dim}, 实际{query_vector.shape[0]}")
+            
+            # 带排除条件的查询各自使用独立的选择器，不参与合并
+            exclude_image_ids = list(exclude_image_ids) if exclude_image_ids else None
+            if (settings.faiss.search_batching and settings.faiss.search_batch_size > 1
+                    and not exclude_image_ids):
+                return await self._search_batcher.submit((query_vector, k), key=(nprobe, ef_search))
+            
             similarities, image_ids = await asyncio.get_event_loop().run_in_executor(
-                self.executor, self._search_sync, query_vector, k
+                self.search_executor, self._search_sync, query_vector, k, nprobe, ef_search,
+                exclude_image_ids
             )
             return similarities, image_ids
         except Exception as e:
             self.logger.error(f"搜索失败: {e}")
             raise
     
-    def _search_sync(self, query_vector: np.ndarray, k: int) -> Tuple[List[float], List[int]]:
-        """同步搜索（在线程池中执行）"""
-        if self.index.ntotal == 0:
-            return [], []
-        
-        # 确保查询向量是二维的
-        if query_vector.ndim == 1:
-            query_vector = query_vector.reshape(1, -1)
+    async def _run_search_batch(self, key: tuple,
+                                queries: List[Tuple[np.ndarray, int]]) -> List[Tuple[List[float], List[int]]]:
+        """执行一批合并后的查询（由微批处理器调用）"""
+        nprobe, ef_search = key
+        query_matrix = np.stack([query for query, _ in queries])
+        ks = [k for _, k in queries]
+        return await asyncio.get_event_loop().run_in_executor(
+            self.search_executor, self._search_batch_sync, query_matrix, ks, nprobe, ef_search
+        )
+    
+    def _search_sync(self, query_vector: np.ndarray, k: int,
+                     nprobe: Optional[int] = None,
+                     ef_search: Optional[int] = None,
+                     exclude_image_ids: Optional[List[int]] = None) -> Tuple[List[float], List[int]]:
+        """同步搜索单个查询（在线程池中执行）"""
+        query_matrix = np.asarray(query_vector, dtype=np.float32).reshape(1, -1)
+        return self._search_batch_sync(query_matrix, [k], nprobe, ef_search, exclude_image_ids)[0]
+    
+    def _search_batch_sync(self, query_matrix: np.ndarray, ks: List[int],
+                           nprobe: Optional[int] = None,
+                           ef_search: Optional[int] = None,
+                           exclude_image_ids: Optional[List[int]] = None) -> List[Tuple[List[float], List[int]]]:
+        """同步批量搜索（在线程池中执行），持有读锁，多个搜索可并行"""
+        with self._rwlock.read():
+            return self._search_locked(query_matrix, ks, nprobe, ef_search, exclude_image_ids)
+    
+    def _search_locked(self, query_matrix: np.ndarray, ks: List[int],
+                       nprobe: Optional[int] = None,
+                       ef_search: Optional[int] = None,
+                       exclude_image_ids: Optional[List[int]] = None) -> List[Tuple[List[float], List[int]]]:
+        """在读锁内执行批量搜索，每行查询返回各自k个结果"""
+        index = self.index
+        if index.ntotal == 0:
+            return [([], []) for _ in ks]
         
         # 检查向量维度
-        if query_vector.shape[1] != self.feature_dim:
-            raise ValueError(f"查询向量维度不匹配: 期望{self.feature_dim}, 实际{query_vector.shape[1]}")
+        if query_matrix.shape[1] != self.feature_dim:
+            raise ValueError(f"查询向量维度不匹配: 期望{self.feature_dim}, 实际{query_matrix.shape[1]}")
+        
+        # 整批以最大的k搜索，再按各自的k截断
+        k = min(max(ks), index.ntotal)
+        query_matrix = np.ascontiguousarray(query_matrix, dtype=np.float32)
         
-        # 限制k值
-        k = min(k, self.index.ntotal)
+        # 压缩索引先取 k*rerank_factor 个候选，再用全精度向量重排序
+        rerank = self._should_rerank(index)
+        search_k = min(k * settings.faiss.rerank_factor, index.ntotal) if rerank else k
         
         # 执行搜索
-        scores, faiss_indices = self.index.search(query_vector.astype(np.float32), k)
+        exclude_ids = self._present_ids(exclude_image_ids) if exclude_image_ids else None
+        params = self._search_params(index, search_k, nprobe, ef_search, exclude_ids)
+        all_scores, all_indices = index.search(query_matrix, search_k, params=params)
         
-        # 转换Faiss索引为图像ID
-        similarities = []
-        image_ids = []
+        results = []
+        for row, row_k in enumerate(ks):
+            row_k = min(row_k, index.ntotal)
+            if rerank:
+                scores, faiss_indices = self._rerank(
+                    query_matrix[row], all_scores[row], all_indices[row], row_k
+                )
+            else:
+                scores, faiss_indices = all_scores[row][:row_k], all_indices[row][:row_k]
+            
+            # 转换Faiss ID为图像ID（结果不足k个时Faiss以-1填充，一并过滤）
+            image_ids, valid = self.id_mapping.translate(faiss_indices)
+            results.append((scores[valid].astype(float).tolist(), image_ids[valid].tolist()))
+        
+        return results
+    
+    def _should_rerank(self, index) -> bool:
+        """仅对已训练的压缩索引进行重排序"""
+        return (
+            self.feature_store is not None
+            and settings.faiss.rerank_factor > 1
+            and self.index_type in PQ_INDEX_TYPES
+            and self._is_ivf(index)
+        )
+    
+    def _rerank(self, query: np.ndarray, scores: np.ndarray, faiss_ids: np.ndarray,
+                k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """用磁盘上的全精度向量重新计算内积并取前k个"""
+        valid = faiss_ids >= 0
+        faiss_ids = faiss_ids[valid]
+        scores = scores[valid].copy()
+        
+        # 缺少全精度向量的候选保留量化得分
+        vectors, found = self.feature_store.get(faiss_ids)
+        scores[found] = vectors[found] @ query
+        
+        order = np.argsort(-scores, kind='stable')[:k]
+        return scores[order], faiss_ids[order]
+    
+    def _search_params(self, index, k: int, nprobe: Optional[int] = None,
+                       ef_search: Optional[int] = None,
+                       exclude_ids: Optional[np.ndarray] = None):
+        """构造单次搜索参数，不修改共享索引的状态"""
+        is_hnsw = self._get_hnsw(index) is not None
+        selector = self._get_deleted_selector() if is_hnsw else None
+        selector_refs = []
+        if exclude_ids is not None and len(exclude_ids):
+            # 排除指定ID，与HNSW的已删除选择器取交集
+            exclude_batch = faiss.IDSelectorBatch(np.asarray(exclude_ids, dtype=np.int64))
+            exclude_selector = faiss.IDSelectorNot(exclude_batch)
+            selector_refs = [exclude_batch, exclude_selector]
+            if selector is not None:
+                selector = faiss.IDSelectorAnd(selector, exclude_selector)
+                selector_refs.append(selector)
+            else:
+                selector = exclude_selector
         
-        for i, (score, faiss_idx) in enumerate(zip(scores[0], faiss_indices[0])):
-            if faiss_idx in self.id_mapping:
-                image_id = self.id_mapping[faiss_idx]
-                similarities.append(float(score))
-                image_ids.append(image_id)
+        if is_hnsw:
+            # efSearch 不能小于k，否则返回结果不足
+            ef_search = ef_search or settings.faiss.hnsw_ef_search
+            params = faiss.SearchParametersHNSW(efSearch=max(ef_search, k))
+        elif self._is_ivf(index):
+            nlist = faiss.extract_index_ivf(index).nlist
+            nprobe = nprobe or settings.faiss.nprobe
+            params = faiss.SearchParametersIVF(nprobe=max(1, min(nprobe, nlist)))
+        elif selector is not None:
+            params = faiss.SearchParameters()
+        else:
+            return None
         
-        return similarities, image_ids
+        if selector is not None:
+            params.sel = selector
+            # 参数对象只持有选择器的裸指针，需保留Python引用直到搜索结束
+            params.selector_refs = selector_refs
+        return params
+    
+    async def _mark_dirty(self, changes: int):
+        """记录索引变更，累计变更数达到阈值时立即落盘"""
+        self._dirty = True
+        self._pending_changes += changes
+        
+        if self._pending_changes >= settings.faiss.save_every_n_adds:
+            await self._save_index()
+    
+    async def _checkpoint_loop(self):
+        """后台检查点任务：定期把脏索引写入磁盘"""
+        interval = settings.faiss.save_interval_seconds
+        while True:
+            try:
+                await asyncio.sleep(interval)
+                if self._dirty and time.time() - self._last_save_time >= interval:
+                    await self._save_index()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.logger.error(f"索引检查点失败: {e}")
+    
+    async def flush(self):
+        """立即保存未落盘的索引变更"""
+        if self._dirty:
+            await self._save_index()
     
     async def _save_index(self):
         """保存索引到文件"""
         try:
             await asyncio.get_event_loop().run_in_executor(
-                self.executor, self._save_index_sync
+                self.persist_executor, self._save_index_sync
             )
         except Exception as e:
             self.logger.error(f"保存索引失败: {e}")
     
-    def _save_index_sync(self):
-        """同步保存索引（在线程池中执行）"""
-        # 保存Faiss索引
-        faiss.write_index(self.index, self.index_path)
-        
-        # 保存ID映射
-        mapping_path = self.index_path.replace('.index', '_mapping.pkl')
-        mapping_data = {
-            'id_mapping': self.id_mapping,
-            'reverse_mapping': self.reverse_mapping,
-            'next_faiss_id': self.next_faiss_id
-        }
-        with open(mapping_path, 'wb') as f:
-            pickle.dump(mapping_data, f)
+    def _save_index_sync(self) -> Optional[int]:
+        """同步保存索引快照（在线程池中执行），返回索引版本记录ID
+        
+        保存只读取索引，持有读锁即可，期间搜索照常进行，只有写入需要等待。
+        """
+        with self._save_lock, self._rwlock.read():
+            # 先清除脏标记，保存期间之后到达的变更会重新标记
+            pending_changes = self._pending_changes
+            self._dirty = False
+            self._pending_changes = 0
+            
+            try:
+                # 写入新的快照目录，清单记录校验和与向量数量，完成后原子切换 CURRENT
+                manifest = {
+                    "index_type": self.index_type,
+                    "feature_dim": self.feature_dim,
+                    "total_vectors": int(self.index.ntotal),
+                    "mapping_count": len(self.id_mapping),
+                    "trained_ntotal": self._trained_ntotal,
+                    "deleted_ids": sorted(self._deleted_ids)
+                }
+                version = self.snapshots.create(self._write_snapshot_files, manifest)
+                self.snapshots.promote(version)
+                self._snapshot_version = version
+            except Exception:
+                self._dirty = True
+                self._pending_changes += pending_changes
+                raise
+            
+            self._last_save_time = time.time()
+        
+        # 数据库记录和清理旧文件不阻塞写入
+        version_id = self._record_index_version(
+            self.snapshots.path(version), manifest["total_vectors"], manifest["index_type"]
+        )
+        self.snapshots.prune(settings.faiss.snapshot_keep, protect={version})
+        self._forget_index_versions()
+        self._remove_legacy_files()
+        return version_id
+    
+    def _write_snapshot_files(self, snapshot_dir: str):
+        """向快照目录写入索引和ID映射"""
+        faiss.write_index(self.index, os.path.join(snapshot_dir, SNAPSHOT_INDEX_FILE))
+        self.id_mapping.save(os.path.join(snapshot_dir, SNAPSHOT_MAPPING_FILE))
+    
+    def _remove_legacy_files(self):
+        """删除已转换为快照的旧版单文件索引"""
+        for path in (self.index_path, self._mapping_path(), self._state_path(), self._legacy_mapping_path()):
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                    self.logger.info(f"已删除旧版索引文件: {path}")
+                except OSError as e:
+                    self.logger.warning(f"删除旧版索引文件失败: {path}, {e}")
     
     def get_index_info(self) -> dict:
         """获取索引信息"""
-        return {
+        info = {
             "total_vectors": self.index.ntotal if self.index else 0,
             "feature_dim": self.feature_dim,
             "index_type": self.index_type,
             "index_path": self.index_path,
-            "is_trained": self.index.is_trained if self.index else False
+            "snapshot_version": self._snapshot_version,
+            "generation": self._generation,
+            "is_trained": self.index.is_trained if self.index else False,
+            "stored_vectors": len(self.feature_store) if self.feature_store is not None else 0,
+            "rebuilding": self.is_rebuilding(),
+            "load_mode": self.load_mode,
+            "mmapped": self._mmap_index is not None and self.index is self._mmap_index,
+            "search_threads": settings.faiss.search_threads,
+            "omp_threads": self._omp_threads,
+            "active_readers": self._rwlock.readers,
+            "search_batching": self._search_batcher.get_stats(),
+            "dirty": self._dirty,
+            "pending_changes": self._pending_changes,
+            "last_save_time": self._last_save_time
         }
+        
+        if self.index_type in IVF_INDEX_TYPES:
+            ivf = faiss.try_extract_index_ivf(self.index) if self.index else None
+            info.update({
+                # 未达到训练规模前使用暴力搜索
+                "is_trained": ivf is not None,
+                "nlist": ivf.nlist if ivf is not None else 0,
+                "nprobe": settings.faiss.nprobe,
+                "trained_vectors": self._trained_ntotal,
+                "training": self._training_task is not None and not self._training_task.done()
+            })
+        
+        hnsw_index = self._get_hnsw(self.index)
+        if hnsw_index is not None:
+            info.update({
+                # 图中仍保留已删除节点，实际可检索的向量数需扣除
+                "total_vectors": self.index.ntotal - len(self._deleted_ids),
+                "hnsw_m": settings.faiss.hnsw_m,
+                "ef_construction": hnsw_index.hnsw.efConstruction,
+                "ef_search": settings.faiss.hnsw_ef_search,
+                "max_level": hnsw_index.hnsw.max_level,
+                "graph_nodes": self.index.ntotal,
+                "deleted_vectors": len(self._deleted_ids),
+                "compacting": self._compaction_task is not None and not self._compaction_task.done()
+            })
+        
+        if self.index_type in PQ_INDEX_TYPES:
+            pq_m = self._choose_pq_m()
+            info.update({
+                "opq": self.index_type == "OPQ_IVFPQ",
+                "pq_m": pq_m,
+                "bytes_per_vector": pq_m,
+                "compression_ratio": round(self.feature_dim * 4 / pq_m, 1),
+                "rerank_factor": settings.faiss.rerank_factor,
+            })
+        
+        return info
+    
+    @property
+    def generation(self) -> int:
+        """索引内容版本，任何增删或整体替换后都会变化"""
+        return self._generation
+    
+    @property
+    def insert_generation(self) -> int:
+        """最近一次写入向量或整体替换索引时的内容版本（只有删除时不变）"""
+        return self._insert_generation
     
     def is_initialized(self) -> bool:
         """检查索引是否已初始化"""
@@ -273,13 +1597,30 @@ class FaissService(LoggerMixin):
         try:
             self.logger.info("正在清理Faiss服务资源...")
             
-            # 保存索引
-            if self.index is not None:
-                await self._save_index()
+            # 中止在线重建，等待进行中的训练和图重建完成
+            self._rebuild_cancel.set()
+            for task in (self._rebuild_task, self._training_task, self._compaction_task):
+                if task is not None and not task.done():
+                    await task
+            
+            # 停止检查点任务
+            if self._checkpoint_task is not None:
+                self._checkpoint_task.cancel()
+                try:
+                    await self._checkpoint_task
+                except asyncio.CancelledError:
+                    pass
+            
+            # 处理已排队的查询
+            await self._search_batcher.drain()
+            
+            # 保存未落盘的变更
+            if self.index is not None and settings.faiss.save_on_shutdown:
+                await self.flush()
             
             # 关闭线程池
-            if hasattr(self, 'executor'):
-                self.executor.shutdown(wait=True)
+            for executor in (self.search_executor, self.mutation_executor, self.persist_executor):
+                executor.shutdown(wait=True)
             
             self.logger.info("Faiss服务资源清理完成")
         except Exception as e:
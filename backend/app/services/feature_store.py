@@ -0,0 +1,193 @@
+"""
+特征存储服务
+在磁盘上以追加方式持久化每张图像的原始特征向量，
+供重建索引、重新训练和重排序直接读取，无需重新运行模型推理
+"""
+
+import asyncio
+import json
+import os
+import threading
+import numpy as np
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from ..utils.logger import LoggerMixin
+from .id_mapping import IdMapping
+
+# 支持的存储精度
+SUPPORTED_DTYPES = ("float32", "float16")
+
+
+class FeatureStore(LoggerMixin):
+    """特征向量存储
+    
+    向量按行追加写入 `<path>.vec`（连续的 float32/float16 矩阵），
+    对应的图像ID追加写入 `<path>.ids`（int64），存储精度和维度记录在 `<path>.meta.json`。
+    读取时通过内存映射按行访问，同一图像重复写入时以最后一次为准。
+    """
+    
+    def __init__(self, path: str, dim: int, dtype: str = "float32"):
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"不支持的特征存储精度: {dtype}，可选: {SUPPORTED_DTYPES}")
+        
+        self.path = path
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.vec_path = f"{path}.vec"
+        self.ids_path = f"{path}.ids"
+        self.meta_path = f"{path}.meta.json"
+        self._rows = IdMapping()  # image_id -> 行号
+        self._num_rows = 0
+        self._mmap = None
+        self._lock = threading.Lock()
+    
+    async def initialize(self):
+        """初始化特征存储"""
+        await asyncio.get_event_loop().run_in_executor(None, self.open)
+    
+    def open(self):
+        """打开存储文件并加载行索引"""
+        store_dir = os.path.dirname(self.path)
+        if store_dir and not os.path.exists(store_dir):
+            os.makedirs(store_dir, exist_ok=True)
+        
+        self._load_meta()
+        for file_path in (self.vec_path, self.ids_path):
+            if not os.path.exists(file_path):
+                open(file_path, 'wb').close()
+        
+        ids = np.fromfile(self.ids_path, dtype=np.int64)
+        row_bytes = self.dim * self.dtype.itemsize
+        # 以两个文件中较短者为准，截掉崩溃时写了一半的行，保证后续追加对齐
+        self._num_rows = min(len(ids), os.path.getsize(self.vec_path) // row_bytes)
+        os.truncate(self.vec_path, self._num_rows * row_bytes)
+        os.truncate(self.ids_path, self._num_rows * ids.itemsize)
+        self._rows = IdMapping.from_pairs(ids[:self._num_rows], np.arange(self._num_rows))
+        self._mmap = None
+        
+        self.logger.info(
+            f"特征存储已加载: {self.path}, 共{len(self._rows)}个向量 ({self.dtype.name})"
+        )
+    
+    def _load_meta(self):
+        """读取或写入存储元数据，已有数据以文件记录的精度为准"""
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            
+            if meta.get('dim') != self.dim:
+                raise ValueError(f"特征存储维度不匹配: 文件为{meta.get('dim')}, 配置为{self.dim}")
+            if meta.get('dtype') != self.dtype.name:
+                self.logger.warning(
+                    f"特征存储精度与配置不一致，沿用文件中的 {meta.get('dtype')}"
+                )
+                self.dtype = np.dtype(meta['dtype'])
+            return
+        
+        if os.path.exists(self.vec_path) and os.path.getsize(self.vec_path) > 0:
+            # 早期版本未记录元数据，均为 float32
+            self.dtype = np.dtype(np.float32)
+        
+        with open(self.meta_path, 'w', encoding='utf-8') as f:
+            json.dump({'dim': self.dim, 'dtype': self.dtype.name}, f)
+    
+    async def add(self, image_ids: List[int], vectors: np.ndarray):
+        """异步追加写入一批向量"""
+        await asyncio.get_event_loop().run_in_executor(None, self.append, image_ids, vectors)
+    
+    def append(self, image_ids: List[int], vectors: np.ndarray):
+        """追加写入一批向量"""
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype).reshape(-1, self.dim)
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        if len(image_ids) != vectors.shape[0]:
+            raise ValueError(f"向量数量与图像ID数量不一致: {vectors.shape[0]} != {len(image_ids)}")
+        
+        with self._lock:
+            # 先写向量再写ID，保证ID文件中的每一行都有完整的向量
+            with open(self.vec_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self.ids_path, 'ab') as f:
+                f.write(image_ids.tobytes())
+            
+            self._rows.add(image_ids, np.arange(self._num_rows, self._num_rows + len(image_ids)))
+            self._num_rows += len(image_ids)
+            self._mmap = None
+    
+    def get(self, image_ids: Iterable[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        按图像ID读取向量
+        
+        Returns:
+            (float32 向量矩阵, 是否找到的布尔掩码)，未找到的行填充为0
+        """
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        rows, found = self._rows.translate(image_ids)
+        vectors = np.zeros((len(image_ids), self.dim), dtype=np.float32)
+        if found.any():
+            vectors[found] = self._get_mmap()[rows[found]]
+        return vectors, found
+    
+    def iter_batches(self, image_ids: Optional[Iterable[int]] = None,
+                     batch_size: int = 65536) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        按磁盘顺序分批读取向量，用于构建索引
+        
+        Args:
+            image_ids: 需要读取的图像ID，为空时读取全部；未存储的ID被跳过
+            batch_size: 每批向量数量
+        
+        Yields:
+            (图像ID数组, float32 向量矩阵)
+        """
+        rows_mapping = self._rows
+        if image_ids is None:
+            pairs = rows_mapping.pairs()
+            ids, rows = pairs[:, 0], pairs[:, 1]
+        else:
+            ids = np.unique(np.asarray(list(image_ids), dtype=np.int64))
+            rows, found = rows_mapping.translate(ids)
+            ids, rows = ids[found], rows[found]
+        
+        # 按行号排序后顺序读取，充分利用磁盘顺序读带宽
+        order = np.argsort(rows, kind='stable')
+        ids, rows = ids[order], rows[order]
+        
+        vectors_mmap = self._get_mmap()
+        for start in range(0, len(rows), batch_size):
+            batch_rows = rows[start:start + batch_size]
+            yield ids[start:start + batch_size], np.asarray(vectors_mmap[batch_rows], dtype=np.float32)
+    
+    def contains(self, image_id: int) -> bool:
+        """判断是否存有该图像的向量"""
+        return int(image_id) in self._rows
+    
+    def _get_mmap(self) -> np.ndarray:
+        """获取向量文件的内存映射（写入后重新映射）"""
+        with self._lock:
+            if self._mmap is None or self._mmap.shape[0] != self._num_rows:
+                if self._num_rows == 0:
+                    return np.empty((0, self.dim), dtype=self.dtype)
+                self._mmap = np.memmap(
+                    self.vec_path, dtype=self.dtype, mode='r',
+                    shape=(self._num_rows, self.dim)
+                )
+            return self._mmap
+    
+    def get_stats(self) -> dict:
+        """获取存储统计信息"""
+        return {
+            "path": self.path,
+            "dtype": self.dtype.name,
+            "feature_dim": self.dim,
+            "stored_vectors": len(self._rows),
+            "total_rows": self._num_rows,
+            "file_size": self._num_rows * self.dim * self.dtype.itemsize
+        }
+    
+    async def cleanup(self):
+        """释放内存映射"""
+        with self._lock:
+            self._mmap = None
+    
+    def __len__(self) -> int:
+        return len(self._rows)
\ No newline at end of file
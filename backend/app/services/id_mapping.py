@@ -0,0 +1,207 @@
+"""
+ID映射
+以连续的int64数组保存 faiss_id -> image_id 映射，支持内存映射加载和向量化转换
+"""
+
+import math
+import os
+import numpy as np
+from typing import Iterable, Tuple
+
+# 增量部分合并进主数组的最小行数
+MIN_MERGE_ROWS = 1024
+
+
+def _empty_rows() -> np.ndarray:
+    return np.empty((0, 2), dtype=np.int64)
+
+
+def _locate(keys: np.ndarray, faiss_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """返回每个 faiss_id 在升序数组 keys 中的位置及是否存在"""
+    rows = np.searchsorted(keys, faiss_ids)
+    if len(keys) == 0:
+        return rows, np.zeros(len(faiss_ids), dtype=bool)
+    
+    rows = np.minimum(rows, len(keys) - 1)
+    return rows, keys[rows] == faiss_ids
+
+
+class IdMapping:
+    """faiss_id -> image_id 映射
+    
+    数据由一个 (主数组, 增量, 已删除ID) 元组表示，变更时整体替换：
+    - 主数组：按 faiss_id 排序的 (n, 2) int64 数组，每行 [faiss_id, image_id]，可以是内存映射的只读数组
+    - 增量：最近写入的行，同样按 faiss_id 排序，与主数组中仍有效的ID不相交
+    - 已删除ID：主数组中已删除或被增量覆盖的 faiss_id（升序）
+    
+    单次写入只复制较小的增量和已删除ID，二者累计超过 sqrt(n) 量级后才与主数组合并一次，
+    写入的均摊开销与映射规模基本无关。查找和批量转换均为向量化的二分查找；
+    读取方只读取一次当前元组，进行中的搜索和内存映射的主数组不受变更影响。
+    """
+    
+    def __init__(self, data: np.ndarray = None):
+        if data is None:
+            data = _empty_rows()
+        self._state = (data, _empty_rows(), np.empty(0, dtype=np.int64))
+        self._merged = None  # (状态, 合并后的数组)，需要完整数组时惰性构建
+        self._reverse_index = None  # (合并后的数组, 按 image_id 排序的行号)，反查时惰性构建
+    
+    @classmethod
+    def from_pairs(cls, faiss_ids: Iterable[int], image_ids: Iterable[int]) -> "IdMapping":
+        """由ID对构建映射，重复的 faiss_id 以最后一次为准"""
+        return cls(cls._dedupe(faiss_ids, image_ids))
+    
+    @classmethod
+    def load(cls, path: str, mmap: bool = False) -> "IdMapping":
+        """从 .npy 文件加载映射"""
+        data = np.load(path, mmap_mode='r' if mmap else None)
+        return cls(data.reshape(-1, 2))
+    
+    def save(self, path: str):
+        """保存映射（先写临时文件再原子替换）"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.pairs()))
+        os.replace(tmp_path, path)
+    
+    @property
+    def faiss_ids(self) -> np.ndarray:
+        """全部 faiss_id（升序）"""
+        return self.pairs()[:, 0]
+    
+    @property
+    def image_ids(self) -> np.ndarray:
+        """与 faiss_ids 对应的图像ID"""
+        return self.pairs()[:, 1]
+    
+    def pairs(self) -> np.ndarray:
+        """当前全部 [faiss_id, image_id] 行（按 faiss_id 排序）的快照，后续变更不影响已返回的数组"""
+        state = self._state
+        merged = self._merged
+        if merged is None or merged[0] is not state:
+            merged = (state, self._merge_state(state))
+            self._merged = merged
+        return merged[1]
+    
+    def __len__(self) -> int:
+        base, delta, removed = self._state
+        return base.shape[0] - len(removed) + delta.shape[0]
+    
+    def __contains__(self, faiss_id: int) -> bool:
+        return bool(self.contains([faiss_id])[0])
+    
+    @staticmethod
+    def _dedupe(faiss_ids: Iterable[int], image_ids: Iterable[int]) -> np.ndarray:
+        """按 faiss_id 排序去重（重复时保留最后一次），返回 (n, 2) 数组"""
+        faiss_ids = np.asarray(list(faiss_ids), dtype=np.int64)
+        image_ids = np.asarray(list(image_ids), dtype=np.int64)
+        if len(faiss_ids) != len(image_ids):
+            raise ValueError(f"faiss_id数量与图像ID数量不一致: {len(faiss_ids)} != {len(image_ids)}")
+        
+        unique_ids, last = np.unique(faiss_ids[::-1], return_index=True)
+        return np.column_stack([unique_ids, image_ids[::-1][last]]).astype(np.int64, copy=False)
+    
+    @staticmethod
+    def _lookup(state: tuple, faiss_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """在给定状态中查找，返回 (图像ID数组, 是否存在的布尔掩码)"""
+        base, delta, removed = state
+        delta_rows, in_delta = _locate(delta[:, 0], faiss_ids)
+        base_rows, in_base = _locate(base[:, 0], faiss_ids)
+        if len(removed):
+            in_base &= ~_locate(removed, faiss_ids)[1]
+        
+        image_ids = np.zeros(len(faiss_ids), dtype=np.int64)
+        if in_base.any():
+            image_ids[in_base] = base[base_rows[in_base], 1]
+        if in_delta.any():
+            image_ids[in_delta] = delta[delta_rows[in_delta], 1]
+        return image_ids, in_delta | in_base
+    
+    @staticmethod
+    def _merge_state(state: tuple) -> np.ndarray:
+        """把增量和已删除ID合并进主数组，返回新的完整数组"""
+        base, delta, removed = state
+        if len(removed):
+            base = np.delete(base, np.searchsorted(base[:, 0], removed), axis=0)
+        if len(delta):
+            base = np.insert(base, np.searchsorted(base[:, 0], delta[:, 0]), delta, axis=0)
+        return base
+    
+    def contains(self, faiss_ids: Iterable[int]) -> np.ndarray:
+        """批量判断 faiss_id 是否存在，返回布尔掩码"""
+        return self._lookup(self._state, np.asarray(faiss_ids, dtype=np.int64))[1]
+    
+    def translate(self, faiss_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        批量将 faiss_id 转换为图像ID
+        
+        Returns:
+            (图像ID数组, 是否有效的布尔掩码)，Faiss填充的-1及已删除的ID均视为无效
+        """
+        # 只读取一次当前状态，并发变更时结果仍然自洽
+        return self._lookup(self._state, np.asarray(faiss_ids, dtype=np.int64))
+    
+    def lookup_faiss_ids(self, image_ids: Iterable[int]) -> np.ndarray:
+        """按图像ID反查 faiss_id，不存在的图像ID被忽略（需要完整数组和按图像ID的排序，适合低频调用）"""
+        image_ids = np.asarray(list(image_ids), dtype=np.int64)
+        if len(self) == 0 or len(image_ids) == 0:
+            return np.empty(0, dtype=np.int64)
+        
+        # 排序结果与生成它的数组绑定，变更后自动失效
+        data = self.pairs()
+        if self._reverse_index is None or self._reverse_index[0] is not data:
+            self._reverse_index = (data, np.argsort(data[:, 1], kind='stable'))
+        order = self._reverse_index[1]
+        sorted_image_ids = data[order, 1]
+        
+        pos = np.minimum(np.searchsorted(sorted_image_ids, image_ids), len(order) - 1)
+        found = sorted_image_ids[pos] == image_ids
+        return data[order[pos[found]], 0]
+    
+    def add(self, faiss_ids: Iterable[int], image_ids: Iterable[int]):
+        """批量添加映射，已存在的 faiss_id 被覆盖"""
+        rows = self._dedupe(faiss_ids, image_ids)
+        if len(rows) == 0:
+            return
+        
+        base, delta, removed = self._state
+        unique_ids = rows[:, 0]
+        # 主数组中仍有效的同一ID标记为已删除，由增量中的新行覆盖
+        base_hits = unique_ids[_locate(base[:, 0], unique_ids)[1]]
+        if len(base_hits):
+            removed = np.union1d(removed, base_hits)
+        
+        delta = self._drop_rows(delta, unique_ids)
+        delta = np.insert(delta, np.searchsorted(delta[:, 0], unique_ids), rows, axis=0)
+        self._set_state(base, delta, removed)
+    
+    def remove(self, faiss_ids: Iterable[int]) -> np.ndarray:
+        """批量移除映射，返回实际移除的 faiss_id"""
+        faiss_ids = np.unique(np.asarray(list(faiss_ids), dtype=np.int64))
+        state = self._state
+        present = faiss_ids[self._lookup(state, faiss_ids)[1]]
+        if not len(present):
+            return present
+        
+        base, delta, removed = state
+        base_hits = present[_locate(base[:, 0], present)[1]]
+        if len(base_hits):
+            removed = np.union1d(removed, base_hits)
+        self._set_state(base, self._drop_rows(delta, present), removed)
+        return present
+    
+    @staticmethod
+    def _drop_rows(rows: np.ndarray, faiss_ids: np.ndarray) -> np.ndarray:
+        """返回去掉指定 faiss_id 后的增量数组"""
+        positions, found = _locate(rows[:, 0], faiss_ids)
+        if not found.any():
+            return rows
+        return np.delete(rows, positions[found], axis=0)
+    
+    def _set_state(self, base: np.ndarray, delta: np.ndarray, removed: np.ndarray):
+        """替换当前状态，增量累计过多时合并进主数组"""
+        state = (base, delta, removed)
+        threshold = max(MIN_MERGE_ROWS, 8 * math.isqrt(base.shape[0]))
+        if delta.shape[0] + len(removed) > threshold:
+            state = (self._merge_state(state), _empty_rows(), np.empty(0, dtype=np.int64))
+        self._state = state
\ No newline at end of file
@@ -0,0 +1,140 @@
+"""
+图像解码服务
+在独立进程中完成图像解码和缩放，结果以 uint8 数组写入共享内存供推理阶段直接读取
+"""
+
+import asyncio
+import io
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Optional, Tuple, Union
+
+from PIL import Image
+
+from ..utils.logger import LoggerMixin
+
+# 模型输入边长
+MODEL_INPUT_SIZE = 224
+
+# 子进程内的共享内存视图，由进程池初始化函数设置
+_worker_shm = None
+_worker_buffer = None
+
+
+def decode_image(image_input: Union[str, bytes, Image.Image], size: int = MODEL_INPUT_SIZE) -> np.ndarray:
+    """
+    解码图像并缩放为模型输入尺寸
+    
+    JPEG 通过 draft 直接以缩小的比例解码（不小于目标尺寸），
+    大图无需先解码出全分辨率像素。
+    
+    Returns:
+        (size, size, 3) 的 uint8 RGB 数组
+    """
+    if isinstance(image_input, str):
+        image = Image.open(image_input)
+    elif isinstance(image_input, bytes):
+        image = Image.open(io.BytesIO(image_input))
+    elif isinstance(image_input, Image.Image):
+        image = image_input
+    else:
+        raise ValueError(f"不支持的图像输入类型: {type(image_input)}")
+    
+    image.draft('RGB', (size, size))
+    image = image.convert('RGB').resize((size, size), Image.BILINEAR)
+    return np.asarray(image, dtype=np.uint8)
+
+
+def _init_worker(shm_name: str, slots: int, size: int):
+    """子进程初始化：映射父进程创建的共享内存"""
+    global _worker_shm, _worker_buffer
+    # 共享内存由父进程创建和释放，子进程只映射
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_buffer = np.ndarray((slots, size, size, 3), dtype=np.uint8, buffer=_worker_shm.buf)
+
+
+def _decode_into_slot(image_input: Union[str, bytes], slot: int, size: int):
+    """在子进程中解码图像并写入共享内存槽位"""
+    _worker_buffer[slot] = decode_image(image_input, size)
+
+
+class DecodePool(LoggerMixin):
+    """多进程图像解码池
+    
+    父进程创建 slots 个 (size, size, 3) 槽位的共享内存，子进程解码后直接写入
+    分配到的槽位，父进程通过 numpy 视图读取，解码结果不经过进程间序列化。
+    调用方使用完槽位后必须调用 `release` 归还。
+    """
+    
+    def __init__(self, workers: int, slots: int, size: int = MODEL_INPUT_SIZE):
+        self.workers = max(1, workers)
+        self.slots = max(1, slots)
+        self.size = size
+        self._shm: Optional[shared_memory.SharedMemory] = None
+        self.buffer: Optional[np.ndarray] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._free_slots: Optional[asyncio.Queue] = None
+    
+    def start(self):
+        """创建共享内存并启动解码进程"""
+        slot_bytes = self.size * self.size * 3
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slots * slot_bytes)
+        self.buffer = np.ndarray(
+            (self.slots, self.size, self.size, 3), dtype=np.uint8, buffer=self._shm.buf
+        )
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(self._shm.name, self.slots, self.size)
+        )
+        self._free_slots = asyncio.Queue()
+        for slot in range(self.slots):
+            self._free_slots.put_nowait(slot)
+        
+        self.logger.info(f"图像解码进程池已启动: 进程数={self.workers}, 槽位数={self.slots}")
+    
+    async def decode(self, image_input: Union[str, bytes, Image.Image]) -> Tuple[int, np.ndarray]:
+        """
+        解码一张图像
+        
+        Returns:
+            (槽位号, 槽位的 uint8 数组视图)
+        """
+        slot = await self._free_slots.get()
+        try:
+            loop = asyncio.get_event_loop()
+            if isinstance(image_input, Image.Image):
+                # 已解码的图像对象无需跨进程传递，在线程中缩放
+                self.buffer[slot] = await loop.run_in_executor(None, decode_image, image_input, self.size)
+            else:
+                await loop.run_in_executor(
+                    self._executor, _decode_into_slot, image_input, slot, self.size
+                )
+        except BaseException:
+            self.release(slot)
+            raise
+        return slot, self.buffer[slot]
+    
+    def release(self, slot: int):
+        """归还槽位"""
+        self._free_slots.put_nowait(slot)
+    
+    def get_stats(self) -> dict:
+        """获取解码池统计信息"""
+        return {
+            "workers": self.workers,
+            "slots": self.slots,
+            "free_slots": self._free_slots.qsize() if self._free_slots is not None else 0
+        }
+    
+    def shutdown(self):
+        """关闭解码进程并释放共享内存"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._shm is not None:
+            self.buffer = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
\ No newline at end of file
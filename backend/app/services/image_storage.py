@@ -0,0 +1,293 @@
+"""
+图片文件存储
+负责计算文件哈希、读取图片基本信息和保存图片文件，供上传接口和批量导入共用
+
+图片按内容寻址存储：以文件哈希为键，按哈希前缀分层建目录（如 ab/cd/abcd....jpg），
+单个目录内的文件数保持在较小规模，相同内容只保存一份。所有写入都先写临时文件再原子重命名，
+读取方不会看到写了一半的文件。
+
+每张图片另有两个派生文件：供结果列表显示的 WebP 缩略图（thumbnails/），
+以及供离线分析使用的小尺寸分析副本（analysis/），由 DerivativeService 生成。
+建索引和搜索的特征始终从原图提取：分析副本异步生成，若按是否已生成来选择输入，
+同一内容得到的向量会随时机不同而不同，也会与按内容哈希缓存的向量不一致。
+"""
+
+import hashlib
+import io
+import math
+import os
+import tempfile
+from typing import BinaryIO, Optional, Tuple, Union
+
+from PIL import Image as PILImage, ImageOps
+
+from ..core.config import get_settings
+
+settings = get_settings()
+
+# 流式接收上传文件时每次读取的块大小
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# 上传目录下存放未完成上传的临时文件的子目录（与最终文件同一文件系统，移动是原子的）
+INCOMING_DIR_NAME = ".incoming"
+# 每层分片目录名取哈希的字符数
+SHARD_WIDTH = 2
+# 派生文件所在的子目录
+THUMBNAIL_DIR_NAME = "thumbnails"
+ANALYSIS_DIR_NAME = "analysis"
+# 识别图片格式需要的文件头字节数
+SNIFF_BYTES = 12
+# 文件扩展名对应的图片格式
+EXTENSION_FORMATS = {"jpg": "jpeg", "jpeg": "jpeg", "png": "png", "gif": "gif", "bmp": "bmp", "webp": "webp"}
+
+
+class FileTooLargeError(ValueError):
+    """上传文件超过大小限制"""
+
+
+def calculate_file_hash(file_content: bytes) -> str:
+    """计算文件MD5哈希值"""
+    return hashlib.md5(file_content).hexdigest()
+
+
+def probe_image(image_input: Union[str, bytes]) -> Tuple[Optional[int], Optional[int], str]:
+    """
+    只解析文件头读取图片尺寸和格式，不解码像素
+    
+    Args:
+        image_input: 文件路径或文件内容
+    
+    Returns:
+        (宽, 高, 格式)，无法识别时为 (None, None, 'unknown')
+    """
+    try:
+        source = io.BytesIO(image_input) if isinstance(image_input, bytes) else image_input
+        with PILImage.open(source) as img:
+            width, height = img.size
+            format_name = img.format.lower() if img.format else 'unknown'
+        return width, height, format_name
+    except Exception:
+        return None, None, 'unknown'
+
+
+def sniff_image_format(head: bytes) -> Optional[str]:
+    """根据文件头的魔数识别图片格式，无法识别时返回None（至少需要 SNIFF_BYTES 字节）"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if head.startswith(b"BM"):
+        return "bmp"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def content_filename(file_hash: str, filename: str) -> str:
+    """
+    生成内容寻址的存储文件名（相对上传目录，使用 / 分隔，可直接拼接为访问URL）
+    
+    Args:
+        file_hash: 文件哈希
+        filename: 原始文件名，只取扩展名
+    """
+    file_ext = os.path.splitext(filename)[1].lower()
+    shards = [
+        file_hash[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH]
+        for i in range(settings.storage.shard_levels)
+    ]
+    return "/".join(shards + [f"{file_hash}{file_ext}"])
+
+
+def storage_path(stored_filename: str) -> str:
+    """存储文件名对应的磁盘路径"""
+    return os.path.join(settings.storage.upload_dir, *stored_filename.split("/"))
+
+
+def _incoming_dir() -> str:
+    incoming_dir = os.path.join(settings.storage.upload_dir, INCOMING_DIR_NAME)
+    os.makedirs(incoming_dir, exist_ok=True)
+    return incoming_dir
+
+
+def _place(temp_path: str, file_hash: str, filename: str) -> Tuple[str, str]:
+    """把写完的临时文件原子地移动到内容寻址位置，已存在相同内容时直接复用"""
+    unique_filename = content_filename(file_hash, filename)
+    file_path = storage_path(unique_filename)
+    if os.path.exists(file_path):
+        discard_temp_file(temp_path)
+    else:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        os.replace(temp_path, file_path)
+    return file_path, unique_filename
+
+
+def save_uploaded_file(file_content: bytes, filename: str,
+                       file_hash: Optional[str] = None) -> Tuple[str, str]:
+    """
+    保存上传的文件
+    
+    Returns:
+        (文件路径, 存储文件名)
+    """
+    fd, temp_path = tempfile.mkstemp(suffix=".part", dir=_incoming_dir())
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(file_content)
+            f.flush()
+            os.fsync(f.fileno())
+        return _place(temp_path, file_hash or calculate_file_hash(file_content), filename)
+    except BaseException:
+        discard_temp_file(temp_path)
+        raise
+
+
+def stream_to_temp_file(source: BinaryIO, max_size: int,
+                        chunk_size: int = UPLOAD_CHUNK_SIZE) -> Tuple[str, int, str]:
+    """
+    分块把上传内容写入临时文件，同时增量计算MD5（阻塞调用，应在线程池中执行）
+    
+    内存占用只有一个块，与文件大小无关；累计大小超过 max_size 时立即中止并删除临时文件。
+    
+    Returns:
+        (临时文件路径, 文件大小, MD5)
+    
+    Raises:
+        FileTooLargeError: 文件超过大小限制
+    """
+    fd, temp_path = tempfile.mkstemp(suffix=".part", dir=_incoming_dir())
+    
+    hasher = hashlib.md5()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise FileTooLargeError(f"文件大小超过限制: {max_size}字节")
+                hasher.update(chunk)
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        discard_temp_file(temp_path)
+        raise
+    return temp_path, size, hasher.hexdigest()
+
+
+def commit_temp_file(temp_path: str, file_hash: str, filename: str) -> Tuple[str, str]:
+    """
+    把临时文件原子地移动为正式的图片文件
+    
+    Returns:
+        (文件路径, 存储文件名)
+    """
+    return _place(temp_path, file_hash, filename)
+
+
+def migrate_file(file_path: str, file_hash: Optional[str], filename: str) -> Tuple[str, str, str]:
+    """
+    把旧的平铺存储文件移动到内容寻址位置（同一文件系统内重命名，不复制数据）
+    
+    Args:
+        file_path: 现有文件路径
+        file_hash: 文件哈希，为空时读取文件计算
+        filename: 用于确定扩展名的文件名
+    
+    Returns:
+        (新文件路径, 存储文件名, 文件哈希)
+    """
+    if not file_hash:
+        hasher = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        file_hash = hasher.hexdigest()
+    
+    unique_filename = content_filename(file_hash, filename)
+    new_path = storage_path(unique_filename)
+    if os.path.abspath(new_path) != os.path.abspath(file_path):
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.replace(file_path, new_path)
+    return new_path, unique_filename, file_hash
+
+
+def thumbnail_filename(stored_filename: str) -> str:
+    """缩略图的存储文件名（与 Image.thumbnail_url 对应）"""
+    name = os.path.splitext(stored_filename)[0]
+    return f"{THUMBNAIL_DIR_NAME}/{name}_thumb.webp"
+
+
+def analysis_filename(stored_filename: str) -> str:
+    """分析副本的存储文件名"""
+    name = os.path.splitext(stored_filename)[0]
+    return f"{ANALYSIS_DIR_NAME}/{name}.webp"
+
+
+def _save_atomic(image: PILImage.Image, dest_path: str, **params):
+    """编码到临时文件后原子地移动到目标位置"""
+    fd, temp_path = tempfile.mkstemp(suffix=".part", dir=_incoming_dir())
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, **params)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        os.replace(temp_path, dest_path)
+    except BaseException:
+        discard_temp_file(temp_path)
+        raise
+
+
+def generate_derivatives(file_path: str, stored_filename: str, thumbnail_size: Tuple[int, int],
+                         analysis_size: int, thumbnail_quality: int = 80,
+                         analysis_quality: int = 90, overwrite: bool = False) -> bool:
+    """
+    从原图生成缩略图和分析副本（阻塞调用，应在线程池中执行）
+    
+    原图只解码一次：JPEG 通过 draft 直接按两种派生文件都够用的比例缩小解码。
+    分析副本保持宽高比，短边缩放到 analysis_size（不放大），且不做 EXIF 旋转，
+    与直接读取原图提取特征时看到的像素方向一致；缩略图按 EXIF 方向旋转后缩放到 thumbnail_size 以内。
+    
+    Returns:
+        是否生成了新文件（两个文件都已存在且不覆盖时返回False）
+    """
+    thumb_path = storage_path(thumbnail_filename(stored_filename))
+    analysis_path = storage_path(analysis_filename(stored_filename))
+    need_thumb = overwrite or not os.path.exists(thumb_path)
+    need_analysis = overwrite or not os.path.exists(analysis_path)
+    if not need_thumb and not need_analysis:
+        return False
+    
+    with PILImage.open(file_path) as img:
+        width, height = img.size
+        scale = min(analysis_size / min(width, height), 1.0)
+        analysis_dims = (max(1, round(width * scale)), max(1, round(height * scale)))
+        thumb_scale = min(thumbnail_size[0] / width, thumbnail_size[1] / height, 1.0)
+        img.draft('RGB', (
+            max(analysis_dims[0], math.ceil(width * thumb_scale)),
+            max(analysis_dims[1], math.ceil(height * thumb_scale))
+        ))
+        has_alpha = img.mode in ('RGBA', 'LA') or 'transparency' in img.info
+        rgb = img.convert('RGB')
+        
+        if need_analysis:
+            analysis = rgb if rgb.size == analysis_dims else rgb.resize(analysis_dims, PILImage.BILINEAR)
+            _save_atomic(analysis, analysis_path, format='WEBP', quality=analysis_quality, method=4)
+        
+        if need_thumb:
+            thumb = ImageOps.exif_transpose(img.convert('RGBA') if has_alpha else rgb)
+            thumb.thumbnail(tuple(thumbnail_size), PILImage.LANCZOS)
+            _save_atomic(thumb, thumb_path, format='WEBP', quality=thumbnail_quality, method=4)
+    return True
+
+
+def discard_temp_file(temp_path: Optional[str]):
+    """删除临时文件（已移动或不存在时忽略）"""
+    if temp_path:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
\ No newline at end of file
@@ -0,0 +1,190 @@
+"""
+索引快照管理
+每次保存写入一个带版本号的快照目录，通过 CURRENT 指针文件原子切换当前版本
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Callable, List, Optional
+
+from ..utils.logger import LoggerMixin
+
+# 快照目录内的文件名
+SNAPSHOT_INDEX_FILE = "index.faiss"
+SNAPSHOT_MAPPING_FILE = "mapping.npy"
+SNAPSHOT_MANIFEST_FILE = "manifest.json"
+CURRENT_POINTER_FILE = "CURRENT"
+
+
+def _fsync_dir(path: str):
+    """刷新目录项，保证重命名在掉电后仍然生效（Windows不支持打开目录，跳过）"""
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _file_sha256(path: str) -> str:
+    """流式计算文件SHA256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SnapshotManager(LoggerMixin):
+    """索引快照管理器
+    
+    目录结构::
+        
+        <root>/v000001/index.faiss
+        <root>/v000001/mapping.npy
+        <root>/v000001/manifest.json
+        <root>/CURRENT            # 当前版本号
+    
+    快照先写入临时目录并刷盘，生成带校验和的清单后整体重命名为正式目录，
+    再原子替换 CURRENT 完成切换。写入中途崩溃只会留下被忽略的临时目录。
+    """
+    
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+    
+    def path(self, version: str) -> str:
+        """快照目录路径"""
+        return os.path.join(self.root_dir, version)
+    
+    def list_versions(self) -> List[str]:
+        """全部已完成的快照版本（升序）"""
+        if not os.path.isdir(self.root_dir):
+            return []
+        return sorted(
+            name for name in os.listdir(self.root_dir)
+            if name.startswith('v') and os.path.isdir(self.path(name))
+        )
+    
+    def current_version(self) -> Optional[str]:
+        """CURRENT 指向的版本"""
+        pointer = os.path.join(self.root_dir, CURRENT_POINTER_FILE)
+        if not os.path.exists(pointer):
+            return None
+        with open(pointer, 'r', encoding='utf-8') as f:
+            version = f.read().strip()
+        return version or None
+    
+    def _next_version(self) -> str:
+        versions = self.list_versions()
+        last = int(versions[-1][1:]) if versions else 0
+        return f"v{last + 1:06d}"
+    
+    def create(self, write_files: Callable[[str], None], manifest: dict) -> str:
+        """
+        写入一个新快照
+        
+        Args:
+            write_files: 向给定目录写入快照文件的回调
+            manifest: 写入清单的附加信息（向量数量等）
+        
+        Returns:
+            新快照的版本号
+        """
+        os.makedirs(self.root_dir, exist_ok=True)
+        version = self._next_version()
+        tmp_dir = self.path(f".tmp-{version}")
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        
+        try:
+            write_files(tmp_dir)
+            
+            files = {}
+            for name in sorted(os.listdir(tmp_dir)):
+                file_path = os.path.join(tmp_dir, name)
+                with open(file_path, 'rb+') as f:
+                    os.fsync(f.fileno())
+                files[name] = {
+                    "size": os.path.getsize(file_path),
+                    "sha256": _file_sha256(file_path)
+                }
+            
+            manifest = dict(manifest, version=version, created_at=time.time(), files=files)
+            with open(os.path.join(tmp_dir, SNAPSHOT_MANIFEST_FILE), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            _fsync_dir(tmp_dir)
+            
+            os.rename(tmp_dir, self.path(version))
+            _fsync_dir(self.root_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        
+        return version
+    
+    def promote(self, version: str):
+        """原子地将 CURRENT 指向指定版本"""
+        pointer = os.path.join(self.root_dir, CURRENT_POINTER_FILE)
+        tmp_path = f"{pointer}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, pointer)
+        _fsync_dir(self.root_dir)
+    
+    def load_manifest(self, version: str) -> dict:
+        """读取快照清单"""
+        with open(os.path.join(self.path(version), SNAPSHOT_MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def verify(self, version: str, check_checksums: bool = True) -> bool:
+        """校验快照文件是否完整（大小，及可选的SHA256）"""
+        try:
+            manifest = self.load_manifest(version)
+            for name, expected in manifest.get("files", {}).items():
+                file_path = os.path.join(self.path(version), name)
+                if os.path.getsize(file_path) != expected["size"]:
+                    raise ValueError(f"{name} 大小不一致")
+                if check_checksums and _file_sha256(file_path) != expected["sha256"]:
+                    raise ValueError(f"{name} 校验和不一致")
+            return True
+        except Exception as e:
+            self.logger.warning(f"快照 {version} 校验失败: {e}")
+            return False
+    
+    def load_candidates(self) -> List[str]:
+        """按加载优先级排列的快照：CURRENT 优先，其次更早的版本（从新到旧），
+        最后是 CURRENT 之后的版本（通常是回滚前被放弃的快照）"""
+        versions = list(reversed(self.list_versions()))
+        current = self.current_version()
+        if current not in versions:
+            return versions
+        
+        older = [v for v in versions if v < current]
+        newer = [v for v in versions if v > current]
+        return [current] + older + newer
+    
+    def prune(self, keep: int, protect: Optional[set] = None) -> List[str]:
+        """删除较旧的快照，保留最近 keep 个及受保护的版本"""
+        protect = set(protect or ())
+        protect.add(self.current_version())
+        versions = self.list_versions()
+        removed = []
+        for version in versions[:max(0, len(versions) - keep)]:
+            if version in protect:
+                continue
+            try:
+                shutil.rmtree(self.path(version))
+                removed.append(version)
+            except OSError as e:
+                # 仍被内存映射时（Windows）无法删除，下次再清理
+                self.logger.warning(f"删除快照 {version} 失败: {e}")
+        return removed
\ No newline at end of file
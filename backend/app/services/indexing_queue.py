@@ -0,0 +1,325 @@
+"""
+后台建索引队列
+异步上传的图片先以 pending 状态入库，由后台工作协程批量提取特征并写入索引
+"""
+
+import asyncio
+import time
+import numpy as np
+from typing import Dict, List, Optional, Set, Tuple
+
+from ..core.database import SessionLocal
+from ..models.image import (
+    Image, INDEX_STATUS_PENDING, INDEX_STATUS_INDEXING, INDEX_STATUS_INDEXED, INDEX_STATUS_FAILED
+)
+from ..utils.logger import LoggerMixin
+from .embedding_cache import EmbeddingCache
+from .faiss_service import FaissService
+from .feature_store import FeatureStore
+from .model_service import ModelService
+
+
+class IndexingQueue(LoggerMixin):
+    """后台建索引队列
+    
+    - 队列有界，满时图片保持 pending 状态，由定期扫描补充入队，上传请求不会被阻塞
+    - 每个工作协程最多等待 batch_wait_ms 凑满一批，整批提取特征、写入特征存储和索引
+    - 失败的图片按指数退避重试，超过 max_retries 次后标记为 failed
+    - 启动时把上次未完成的 indexing 状态恢复为 pending 重新处理
+    """
+    
+    def __init__(self, model_service: ModelService, faiss_service: FaissService,
+                 feature_store: Optional[FeatureStore] = None,
+                 embedding_cache: Optional[EmbeddingCache] = None,
+                 workers: int = 2, batch_size: int = 32, batch_wait_ms: float = 50.0,
+                 max_pending: int = 10000, max_retries: int = 3,
+                 retry_delay_seconds: float = 5.0, sweep_interval_seconds: float = 30.0):
+        self.model_service = model_service
+        self.faiss_service = faiss_service
+        self.feature_store = feature_store
+        self.embedding_cache = embedding_cache
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait_ms / 1000.0
+        self.max_pending = max(1, max_pending)
+        self.max_retries = max(1, max_retries)
+        self.retry_delay_seconds = retry_delay_seconds
+        self.sweep_interval_seconds = sweep_interval_seconds
+        
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: Set[int] = set()  # 已在队列中或正在处理的图像
+        self._delayed: Set[int] = set()  # 等待退避重试的图像
+        self._tasks: List[asyncio.Task] = []
+        
+        # 统计信息
+        self._indexed = 0
+        self._failed = 0
+        self._retried = 0
+        self._batches = 0
+        self._processed = 0
+        self._total_latency = 0.0
+    
+    async def start(self):
+        """恢复中断的任务并启动工作协程"""
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        recovered = await asyncio.get_event_loop().run_in_executor(None, self._recover_sync)
+        if recovered:
+            self.logger.info(f"恢复{recovered}张未完成建索引的图片")
+        
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweep_loop()))
+        await self._sweep()
+        self.logger.info(f"建索引队列已启动: 工作协程={self.workers}, 批大小={self.batch_size}")
+    
+    def _recover_sync(self) -> int:
+        db = SessionLocal()
+        try:
+            recovered = db.query(Image).filter(Image.index_status == INDEX_STATUS_INDEXING).update(
+                {Image.index_status: INDEX_STATUS_PENDING}, synchronize_session=False
+            )
+            db.commit()
+            return recovered
+        finally:
+            db.close()
+    
+    def submit(self, image_id: int) -> bool:
+        """
+        提交一张 pending 状态的图片
+        
+        Returns:
+            是否已入队；队列已满时返回False，图片由定期扫描补充入队
+        """
+        if self._queue is None or image_id in self._queued:
+            return image_id in self._queued
+        try:
+            self._queue.put_nowait((image_id, time.time()))
+        except asyncio.QueueFull:
+            return False
+        self._queued.add(image_id)
+        return True
+    
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval_seconds)
+            try:
+                await self._sweep()
+            except Exception as e:
+                self.logger.error(f"扫描待建索引图片失败: {e}")
+    
+    async def _sweep(self):
+        """把数据库中未入队的 pending 图片补充到队列"""
+        room = self._queue.maxsize - self._queue.qsize()
+        if room <= 0:
+            return
+        skip = self._queued | self._delayed
+        image_ids = await asyncio.get_event_loop().run_in_executor(
+            None, self._load_pending_sync, room + len(skip)
+        )
+        for image_id in image_ids:
+            if image_id not in skip and not self.submit(image_id):
+                break
+    
+    def _load_pending_sync(self, limit: int) -> List[int]:
+        db = SessionLocal()
+        try:
+            rows = db.query(Image.id).filter(
+                Image.index_status == INDEX_STATUS_PENDING,
+                Image.is_active == True
+            ).order_by(Image.id).limit(limit).all()
+            return [row.id for row in rows]
+        finally:
+            db.close()
+    
+    async def _worker(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            image_ids = [image_id for image_id, _ in batch]
+            try:
+                await self._process(image_ids)
+                self._processed += len(batch)
+                self._total_latency += sum(time.time() - queued_at for _, queued_at in batch)
+            except Exception as e:
+                self.logger.error(f"批量建索引失败: {e}")
+            finally:
+                self._queued.difference_update(image_ids)
+    
+    async def _process(self, image_ids: List[int]):
+        """整批提取特征并写入索引"""
+        loop = asyncio.get_event_loop()
+        claimed = await loop.run_in_executor(None, self._claim_sync, image_ids)
+        if not claimed:
+            return
+        
+        failed: Dict[int, str] = {}
+        try:
+            # 与近期搜索过的图片内容相同时直接复用缓存的向量
+            features = {}
+            if self.embedding_cache is not None:
+                for image_id, _, file_hash in claimed:
+                    cached = await self.embedding_cache.get(file_hash) if file_hash else None
+                    if cached is not None:
+                        features[image_id] = cached
+            
+            remaining = [(image_id, file_path) for image_id, file_path, _ in claimed if image_id not in features]
+            if remaining:
+                matrix, mask = await self.model_service.extract_batch_features_masked(
+                    [file_path for _, file_path in remaining]
+                )
+                rows = iter(matrix)
+                for (image_id, _), ok in zip(remaining, mask):
+                    if ok:
+                        features[image_id] = next(rows)
+                    else:
+                        failed[image_id] = "图像解码失败"
+            
+            if features:
+                indexed_ids = list(features)
+                vectors = np.stack([features[image_id] for image_id in indexed_ids])
+                if self.feature_store is not None:
+                    await self.feature_store.add(indexed_ids, vectors)
+                await self.faiss_service.add_vectors(vectors, indexed_ids)
+                deleted = await loop.run_in_executor(None, self._mark_indexed_sync, indexed_ids)
+                if deleted:
+                    # 处理期间被删除的图片，删除时索引中还没有向量，在这里补删
+                    await self.faiss_service.remove_images(deleted)
+                self._indexed += len(indexed_ids) - len(deleted)
+        except Exception as e:
+            for image_id, _, _ in claimed:
+                if image_id not in failed:
+                    failed[image_id] = str(e)
+            raise
+        finally:
+            self._batches += 1
+            if failed:
+                await self._handle_failures(failed)
+    
+    def _claim_sync(self, image_ids: List[int]) -> List[Tuple[int, str, Optional[str]]]:
+        """把仍为 pending 的图片标记为 indexing，返回 (图像ID, 原图路径, 哈希)
+        
+        特征始终从原图提取，与按内容哈希缓存的向量、同步上传和批量导入得到的向量一致。
+        """
+        db = SessionLocal()
+        try:
+            rows = db.query(Image).filter(
+                Image.id.in_(image_ids),
+                Image.index_status == INDEX_STATUS_PENDING,
+                Image.is_active == True
+            ).all()
+            for row in rows:
+                row.index_status = INDEX_STATUS_INDEXING
+            db.commit()
+            return [(row.id, row.file_path, row.hash_value) for row in rows]
+        finally:
+            db.close()
+    
+    def _mark_indexed_sync(self, image_ids: List[int]) -> List[int]:
+        """把仍有效的图片标记为已索引，返回处理期间已被删除的图像ID"""
+        db = SessionLocal()
+        try:
+            db.query(Image).filter(
+                Image.id.in_(image_ids),
+                Image.is_active == True
+            ).update({
+                Image.faiss_id: Image.id,
+                Image.index_status: INDEX_STATUS_INDEXED,
+                Image.index_error: None
+            }, synchronize_session=False)
+            db.commit()
+            rows = db.query(Image.id).filter(
+                Image.id.in_(image_ids),
+                Image.is_active == False
+            ).all()
+            return [row.id for row in rows]
+        finally:
+            db.close()
+    
+    async def _handle_failures(self, failed: Dict[int, str]):
+        """记录失败原因，未超过重试次数的图片退避后重新入队"""
+        retry = await asyncio.get_event_loop().run_in_executor(None, self._record_failures_sync, failed)
+        loop = asyncio.get_event_loop()
+        for image_id, attempts in retry.items():
+            self._delayed.add(image_id)
+            loop.call_later(self.retry_delay_seconds * 2 ** (attempts - 1), self._retry, image_id)
+        self._retried += len(retry)
+        self._failed += len(failed) - len(retry)
+    
+    def _record_failures_sync(self, failed: Dict[int, str]) -> Dict[int, int]:
+        db = SessionLocal()
+        try:
+            retry = {}
+            for row in db.query(Image).filter(Image.id.in_(list(failed))).all():
+                row.index_attempts = (row.index_attempts or 0) + 1
+                row.index_error = failed[row.id][:500]
+                if row.index_attempts < self.max_retries:
+                    row.index_status = INDEX_STATUS_PENDING
+                    retry[row.id] = row.index_attempts
+                else:
+                    row.index_status = INDEX_STATUS_FAILED
+                    self.logger.warning(f"图片建索引失败次数过多，已放弃: {row.id}, {row.index_error}")
+            db.commit()
+            return retry
+        finally:
+            db.close()
+    
+    def _retry(self, image_id: int):
+        self._delayed.discard(image_id)
+        self.submit(image_id)
+    
+    async def retry_failed(self) -> int:
+        """把 failed 状态的图片重置为 pending 并重新处理，返回重置数量"""
+        count = await asyncio.get_event_loop().run_in_executor(None, self._reset_failed_sync)
+        await self._sweep()
+        return count
+    
+    def _reset_failed_sync(self) -> int:
+        db = SessionLocal()
+        try:
+            count = db.query(Image).filter(
+                Image.index_status == INDEX_STATUS_FAILED,
+                Image.is_active == True
+            ).update({
+                Image.index_status: INDEX_STATUS_PENDING,
+                Image.index_attempts: 0
+            }, synchronize_session=False)
+            db.commit()
+            return count
+        finally:
+            db.close()
+    
+    def get_stats(self) -> dict:
+        """获取队列统计信息"""
+        return {
+            "workers": self.workers,
+            "batch_size": self.batch_size,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_pending": self.max_pending,
+            "in_progress": len(self._queued) - (self._queue.qsize() if self._queue is not None else 0),
+            "waiting_retry": len(self._delayed),
+            "indexed": self._indexed,
+            "failed": self._failed,
+            "retried": self._retried,
+            "batches": self._batches,
+            # 从入队到处理完成的平均耗时
+            "avg_latency_seconds": round(self._total_latency / self._processed, 3) if self._processed else 0
+        }
+    
+    async def cleanup(self):
+        """停止工作协程，未完成的图片下次启动时恢复"""
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
\ No newline at end of file
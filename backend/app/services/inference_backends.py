@@ -0,0 +1,244 @@
+"""
+推理后端
+提供 eager / TorchScript / ONNX Runtime 三种前向推理实现及 INT8 量化选项，
+并与 fp32 基线比较输出特征的余弦偏差
+"""
+
+import importlib.metadata
+import json
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision.models as models
+from typing import Callable, Optional
+
+from ..utils.logger import LoggerMixin
+
+# 支持的推理后端与量化方式
+SUPPORTED_BACKENDS = ("eager", "torchscript", "onnx")
+SUPPORTED_QUANTIZATION = ("none", "static", "dynamic")
+# ONNX导出使用的算子集版本
+ONNX_OPSET_VERSION = 17
+# 导出模型旁记录导出参数的元数据文件后缀
+EXPORT_METADATA_SUFFIX = ".meta.json"
+
+
+def _package_version(name: str) -> Optional[str]:
+    """已安装包的版本，未安装时为None"""
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def build_backbone(name: str, pretrained: bool, quantized: bool = False) -> nn.Module:
+    """
+    构建去掉分类层的ResNet特征提取网络
+    
+    Args:
+        name: resnet50 / resnet18，未知名称按 resnet50 处理
+        pretrained: 是否加载预训练权重
+        quantized: 使用torchvision提供的INT8静态量化权重（仅CPU）
+    """
+    name = name.lower()
+    if name not in ("resnet50", "resnet18"):
+        name = "resnet50"
+    
+    if quantized:
+        # 量化模型的 forward 包含量化/反量化节点，替换分类层即可输出特征
+        model = getattr(models.quantization, name)(pretrained=pretrained, quantize=True)
+        model.fc = nn.Identity()
+    else:
+        model = getattr(models, name)(pretrained=pretrained)
+        # 移除最后的分类层，只保留特征提取部分
+        model = nn.Sequential(*list(model.children())[:-1])
+    
+    return model.eval()
+
+
+class TorchRunner:
+    """eager 或 TorchScript 模型的前向推理"""
+    
+    def __init__(self, model: nn.Module, channels_last: bool = False, inference_mode: bool = True):
+        self.model = model
+        self.channels_last = channels_last
+        self.inference_mode = inference_mode
+    
+    def __call__(self, batch: torch.Tensor) -> np.ndarray:
+        if self.channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        with torch.inference_mode() if self.inference_mode else torch.no_grad():
+            features = self.model(batch)
+        return features.reshape(features.shape[0], -1).float().cpu().numpy()
+
+
+class OnnxRunner:
+    """ONNX Runtime 前向推理"""
+    
+    def __init__(self, model_path: str, intra_op_threads: int = 0):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise RuntimeError("onnx 推理后端需要安装 onnxruntime") from e
+        
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+    
+    def __call__(self, batch: torch.Tensor) -> np.ndarray:
+        inputs = np.ascontiguousarray(batch.cpu().numpy(), dtype=np.float32)
+        features = self.session.run(None, {self.input_name: inputs})[0]
+        return features.reshape(features.shape[0], -1)
+
+
+class InferenceBackendBuilder(LoggerMixin):
+    """按配置构建推理后端"""
+    
+    def __init__(self, model_name: str, pretrained: bool, device: torch.device,
+                 export_dir: str, input_size: int = 224):
+        self.model_name = model_name.lower()
+        self.pretrained = pretrained
+        self.device = device
+        self.export_dir = export_dir
+        self.input_size = input_size
+    
+    def build(self, backend: str, quantization: str = "none", channels_last: bool = False,
+              inference_mode: bool = True, onnx_threads: int = 0) -> Callable[[torch.Tensor], np.ndarray]:
+        """
+        构建推理函数
+        
+        Returns:
+            接收归一化后的 (N, 3, H, W) 张量、返回 (N, D) float32 特征矩阵的可调用对象
+        """
+        if backend not in SUPPORTED_BACKENDS:
+            raise ValueError(f"不支持的推理后端: {backend}，可选: {SUPPORTED_BACKENDS}")
+        if quantization not in SUPPORTED_QUANTIZATION:
+            raise ValueError(f"不支持的量化方式: {quantization}，可选: {SUPPORTED_QUANTIZATION}")
+        if quantization == "dynamic" and backend != "onnx":
+            # PyTorch 动态量化只作用于 Linear/LSTM，对卷积网络没有效果
+            raise ValueError("dynamic 量化仅支持 onnx 后端，eager/torchscript 请使用 static")
+        if quantization != "none" and self.device.type != "cpu":
+            raise ValueError("INT8 量化模型仅支持CPU推理")
+        
+        if backend == "onnx":
+            return OnnxRunner(self._export_onnx(quantization), onnx_threads)
+        
+        model = build_backbone(self.model_name, self.pretrained, quantized=quantization == "static")
+        model = model.to(self.device)
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        
+        if backend == "torchscript":
+            example = self._example_input(channels_last)
+            with torch.no_grad():
+                model = torch.jit.freeze(torch.jit.trace(model, example))
+                # 冻结后的图可进一步做算子融合（如 conv+bn、conv+relu）
+                model = torch.jit.optimize_for_inference(model)
+        
+        return TorchRunner(model, channels_last, inference_mode)
+    
+    def build_baseline(self) -> TorchRunner:
+        """fp32 eager 基线，用于偏差检查"""
+        model = build_backbone(self.model_name, self.pretrained).to(self.device)
+        return TorchRunner(model)
+    
+    def _example_input(self, channels_last: bool = False) -> torch.Tensor:
+        example = torch.rand(1, 3, self.input_size, self.input_size, device=self.device)
+        if channels_last:
+            example = example.contiguous(memory_format=torch.channels_last)
+        return example
+    
+    def _export_metadata(self, quantization: str) -> dict:
+        """决定导出结果的参数：模型、权重、输入尺寸以及导出和量化所用的库版本"""
+        metadata = {
+            "model_name": self.model_name,
+            "pretrained": self.pretrained,
+            "input_size": self.input_size,
+            "opset_version": ONNX_OPSET_VERSION,
+            "torch": _package_version("torch"),
+            "torchvision": _package_version("torchvision"),
+            "onnx": _package_version("onnx")
+        }
+        if quantization != "none":
+            metadata.update({"quantization": quantization, "onnxruntime": _package_version("onnxruntime")})
+        return metadata
+    
+    @staticmethod
+    def _is_current(model_path: str, metadata: dict) -> bool:
+        """已导出的模型是否存在且元数据与当前参数一致"""
+        if not os.path.exists(model_path):
+            return False
+        try:
+            with open(model_path + EXPORT_METADATA_SUFFIX, 'r', encoding='utf-8') as f:
+                return json.load(f) == metadata
+        except (OSError, ValueError):
+            return False
+    
+    @staticmethod
+    def _write_metadata(model_path: str, metadata: dict):
+        """模型文件替换完成后写入元数据，中途失败时下次启动会重新导出"""
+        tmp_path = f"{model_path}{EXPORT_METADATA_SUFFIX}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, ensure_ascii=False)
+        os.replace(tmp_path, model_path + EXPORT_METADATA_SUFFIX)
+    
+    def _export_onnx(self, quantization: str) -> str:
+        """导出（或复用已导出的）ONNX模型，返回模型路径
+        
+        模型旁的元数据文件记录模型、权重、输入尺寸和库版本，与当前配置不一致时重新导出。
+        """
+        os.makedirs(self.export_dir, exist_ok=True)
+        fp32_path = os.path.join(self.export_dir, f"{self.model_name}_fp32.onnx")
+        fp32_metadata = self._export_metadata("none")
+        if not self._is_current(fp32_path, fp32_metadata):
+            self.logger.info(f"导出ONNX模型: {fp32_path}")
+            model = build_backbone(self.model_name, self.pretrained)
+            tmp_path = f"{fp32_path}.tmp"
+            torch.onnx.export(
+                model, torch.rand(1, 3, self.input_size, self.input_size), tmp_path,
+                input_names=["input"], output_names=["features"],
+                dynamic_axes={"input": {0: "batch"}, "features": {0: "batch"}},
+                opset_version=ONNX_OPSET_VERSION
+            )
+            os.replace(tmp_path, fp32_path)
+            self._write_metadata(fp32_path, fp32_metadata)
+        
+        if quantization == "none":
+            return fp32_path
+        
+        int8_path = os.path.join(self.export_dir, f"{self.model_name}_int8.onnx")
+        int8_metadata = self._export_metadata(quantization)
+        if not self._is_current(int8_path, int8_metadata):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            
+            self.logger.info(f"生成INT8动态量化ONNX模型: {int8_path}")
+            tmp_path = f"{int8_path}.tmp"
+            quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, int8_path)
+            self._write_metadata(int8_path, int8_metadata)
+        return int8_path
+
+
+def cosine_drift(baseline: Callable[[torch.Tensor], np.ndarray],
+                 candidate: Callable[[torch.Tensor], np.ndarray],
+                 batch: torch.Tensor) -> dict:
+    """
+    比较候选后端与基线在同一批输入上的特征余弦偏差（1 - 余弦相似度）
+    
+    Returns:
+        包含样本数、平均偏差和最大偏差的字典
+    """
+    reference = baseline(batch)
+    features = candidate(batch)
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    features = features / np.linalg.norm(features, axis=1, keepdims=True)
+    drift = 1.0 - np.sum(reference * features, axis=1)
+    return {
+        "samples": int(batch.shape[0]),
+        "mean_drift": float(drift.mean()),
+        "max_drift": float(drift.max())
+    }
\ No newline at end of file
@@ -3,19 +3,20 @@
 负责加载PyTorch模型并提取图像特征
 """
 
+import os
 import torch
-import torch.nn as nn
 import torchvision.transforms as transforms
-import torchvision.models as models
 from PIL import Image
 import numpy as np
-from typing import List, Union, Optional
+from typing import List, Union, Optional, Tuple
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
-import io
 
 from ..core.config import get_settings
 from ..utils.logger import LoggerMixin
+from ..utils.batcher import MicroBatcher
+from .image_decode import DecodePool, decode_image, MODEL_INPUT_SIZE
+from .inference_backends import InferenceBackendBuilder, cosine_drift
 
 settings = get_settings()
 
@@ -26,10 +27,24 @@ class ModelService(LoggerMixin):
     def __init__(self):
         self.model = None
         self.device = None
-        self.transform = None
-        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.normalize = None
+        self.drift_report: Optional[dict] = None
+        self.active_backend = (settings.model.backend, settings.model.quantization)  # 实际使用的 (后端, 量化方式)
+        self.decode_pool: Optional[DecodePool] = None
+        # 解码预处理可并行，前向推理在单独线程串行执行，每次处理一整批
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.model.preprocess_threads, thread_name_prefix="model-preprocess"
+        )
+        self.inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-inference")
         self.feature_dim = settings.faiss.feature_dim
-        
+        # 并发请求的预处理结果合并为一次前向推理
+        self._batcher = MicroBatcher(
+            self._run_inference_batch,
+            max_batch_size=settings.model.batch_size,
+            max_wait_ms=settings.model.batch_wait_ms,
+            name="model-inference"
+        )
+    
     async def initialize(self):
         """初始化模型"""
         try:
@@ -37,9 +52,12 @@ class ModelService(LoggerMixin):
             
             # 设置设备
             self.device = torch.device(
-                settings.model.device if torch.cuda.is_available() 
+                settings.model.device if torch.cuda.is_available()
                 and settings.model.device == "cuda" else "cpu"
             )
+            if settings.model.quantization != "none" and self.device.type != "cpu":
+                self.logger.warning("INT8量化模型仅支持CPU推理，改用CPU")
+                self.device = torch.device("cpu")
             self.logger.info(f"使用设备: {self.device}")
             
             # 在线程池中加载模型
@@ -47,6 +65,11 @@ class ModelService(LoggerMixin):
                 self.executor, self._load_model
             )
             
+            # 启动解码进程池，解码和缩放不再与推理争用同一进程
+            if settings.model.decode_workers > 0:
+                self.decode_pool = DecodePool(settings.model.decode_workers, settings.model.decode_slots)
+                self.decode_pool.start()
+            
             self.logger.info("图像特征提取模型初始化完成")
             
         except Exception as e:
@@ -55,34 +78,63 @@ class ModelService(LoggerMixin):
     
     def _load_model(self):
         """加载模型（在线程池中执行）"""
-        # 加载预训练的ResNet50模型
-        if settings.model.name.lower() == "resnet50":
-            model = models.resnet50(pretrained=settings.model.pretrained)
-            # 移除最后的分类层，只保留特征提取部分
-            model = nn.Sequential(*list(model.children())[:-1])
-        elif settings.model.name.lower() == "resnet18":
-            model = models.resnet18(pretrained=settings.model.pretrained)
-            model = nn.Sequential(*list(model.children())[:-1])
-        else:
-            # 默认使用ResNet50
-            model = models.resnet50(pretrained=settings.model.pretrained)
-            model = nn.Sequential(*list(model.children())[:-1])
+        # 设置图像归一化（解码缩放在 decode_image 中完成，归一化在推理设备上按批进行）
+        self.normalize = transforms.Normalize(
+            mean=[0.485, 0.456, 0.406],
+            std=[0.229, 0.224, 0.225]
+        )
         
-        # 设置为评估模式
-        model.eval()
-        model = model.to(self.device)
+        config = settings.model
+        builder = InferenceBackendBuilder(
+            config.name, config.pretrained, self.device, config.export_dir, MODEL_INPUT_SIZE
+        )
+        self.model = builder.build(
+            config.backend, config.quantization, config.channels_last,
+            config.inference_mode, config.onnx_threads
+        )
+        self.active_backend = (config.backend, config.quantization)
+        self.logger.info(f"推理后端: {config.backend}, 量化: {config.quantization}")
         
-        self.model = model
-        
-        # 设置图像预处理
-        self.transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(
-                mean=[0.485, 0.456, 0.406],
-                std=[0.229, 0.224, 0.225]
+        # 非基线配置与 fp32 eager 比较输出偏差，超过阈值时回退
+        if config.drift_check and (config.backend != "eager" or config.quantization != "none"):
+            self.drift_report = cosine_drift(
+                builder.build_baseline(), self.model, self._drift_check_batch()
             )
-        ])
+            self.logger.info(f"推理后端余弦偏差: {self.drift_report}")
+            if self.drift_report["max_drift"] > config.max_cosine_drift:
+                self.logger.warning(
+                    f"余弦偏差 {self.drift_report['max_drift']:.4f} 超过阈值 "
+                    f"{config.max_cosine_drift}，回退到 fp32 eager"
+                )
+                self.model = builder.build("eager", "none", config.channels_last, config.inference_mode)
+                self.active_backend = ("eager", "none")
+                self.drift_report["fallback"] = True
+    
+    def _drift_check_batch(self) -> torch.Tensor:
+        """偏差检查使用的输入：优先读取样例目录中的图片，否则使用固定种子的随机图像"""
+        samples = max(1, settings.model.drift_check_samples)
+        images = []
+        sample_dir = settings.model.drift_check_dir
+        if sample_dir and os.path.isdir(sample_dir):
+            for name in sorted(os.listdir(sample_dir)):
+                if len(images) >= samples:
+                    break
+                try:
+                    images.append(decode_image(os.path.join(sample_dir, name)))
+                except Exception:
+                    continue
+        
+        if not images:
+            rng = np.random.default_rng(0)
+            batch = rng.integers(0, 256, (samples, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, 3), dtype=np.uint8)
+        else:
+            batch = np.stack(images)
+        return self._to_input(batch)
+    
+    def _to_input(self, batch: np.ndarray) -> torch.Tensor:
+        """将 (N, H, W, 3) uint8 图像转换为归一化的 (N, 3, H, W) 模型输入"""
+        batch_tensor = torch.from_numpy(batch).to(self.device)
+        return self.normalize(batch_tensor.permute(0, 3, 1, 2).float().div_(255))
     
     async def extract_features(self, image_input: Union[str, Image.Image, bytes]) -> np.ndarray:
         """
@@ -95,48 +147,59 @@ class ModelService(LoggerMixin):
             特征向量数组
         """
         try:
-            # 在线程池中处理图像
-            features = await asyncio.get_event_loop().run_in_executor(
-                self.executor, self._extract_features_sync, image_input
-            )
-            return features
+            loop = asyncio.get_event_loop()
+            if not settings.model.dynamic_batching or settings.model.batch_size <= 1:
+                return await loop.run_in_executor(
+                    self.executor, self._extract_features_sync, image_input
+                )
+            
+            # 解码缩放后与其他并发请求合并推理
+            if self.decode_pool is None:
+                slot, pixels = None, await loop.run_in_executor(self.executor, self._preprocess, image_input)
+            else:
+                slot, pixels = await self.decode_pool.decode(image_input)
+            try:
+                return await self._batcher.submit(pixels)
+            finally:
+                if slot is not None:
+                    self.decode_pool.release(slot)
         except Exception as e:
             self.logger.error(f"特征提取失败: {e}")
             raise
     
+    async def _run_inference_batch(self, key, images: List[np.ndarray]) -> List[np.ndarray]:
+        """对一批解码后的图像执行一次前向推理（由微批处理器调用）"""
+        # 在批次开始时立即从共享内存槽位拷贝出整批数据，此后调用方取消并归还槽位也不影响推理
+        batch = np.stack(images)
+        features = await asyncio.get_event_loop().run_in_executor(
+            self.inference_executor, self._forward, batch
+        )
+        return list(features)
+    
     def _extract_features_sync(self, image_input: Union[str, Image.Image, bytes]) -> np.ndarray:
         """同步提取特征（在线程池中执行）"""
-        # 加载图像
-        if isinstance(image_input, str):
-            # 文件路径
-            image = Image.open(image_input).convert('RGB')
-        elif isinstance(image_input, bytes):
-            # 字节数据
-            image = Image.open(io.BytesIO(image_input)).convert('RGB')
-        elif isinstance(image_input, Image.Image):
-            # PIL Image对象
-            image = image_input.convert('RGB')
-        else:
-            raise ValueError(f"不支持的图像输入类型: {type(image_input)}")
+        return self._forward([self._preprocess(image_input)])[0]
+    
+    def _preprocess(self, image_input: Union[str, Image.Image, bytes]) -> np.ndarray:
+        """在当前进程中解码并缩放单张图像，返回 (224, 224, 3) 的 uint8 数组"""
+        return decode_image(image_input)
+    
+    def _forward(self, images: Union[np.ndarray, List[np.ndarray]]) -> np.ndarray:
+        """批量前向推理，返回L2归一化后的特征矩阵 (N, feature_dim)
         
-        # 预处理
-        input_tensor = self.transform(image).unsqueeze(0).to(self.device)
+        输入为 (N, H, W, 3) 的 uint8 图像，转换和归一化在推理设备上整批完成。
+        """
+        batch = images if isinstance(images, np.ndarray) else np.stack(images)
+        features = self.model(self._to_input(batch))
         
-        # 提取特征
-        with torch.no_grad():
-            features = self.model(input_tensor)
-            features = features.squeeze().cpu().numpy()
-            
-            # 确保特征维度正确
-            if features.shape[0] != self.feature_dim:
-                self.logger.warning(
-                    f"特征维度不匹配: 期望{self.feature_dim}, 实际{features.shape[0]}"
-                )
-            
-            # L2 归一化
-            features = features / np.linalg.norm(features)
-            
-        return features
+        # 确保特征维度正确
+        if features.shape[1] != self.feature_dim:
+            self.logger.warning(
+                f"特征维度不匹配: 期望{self.feature_dim}, 实际{features.shape[1]}"
+            )
+        
+        # L2 归一化
+        return features / np.linalg.norm(features, axis=1, keepdims=True)
     
     async def extract_batch_features(self, image_inputs: List[Union[str, Image.Image, bytes]]) -> np.ndarray:
         """
@@ -146,41 +209,86 @@ class ModelService(LoggerMixin):
             image_inputs: 图像输入列表
             
         Returns:
-            特征矩阵，形状为 (N, feature_dim)
+            特征矩阵，形状为 (N, feature_dim)，处理失败的图像被跳过
+        """
+        features, _ = await self.extract_batch_features_masked(image_inputs)
+        return features
+    
+    async def extract_batch_features_masked(
+        self, image_inputs: List[Union[str, Image.Image, bytes]]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        批量提取图像特征，同时返回每个输入是否成功
+        
+        Returns:
+            (成功图像的特征矩阵, 长度为 len(image_inputs) 的布尔掩码)
         """
         try:
-            features_list = await asyncio.get_event_loop().run_in_executor(
-                self.executor, self._extract_batch_features_sync, image_inputs
-            )
-            return np.array(features_list)
+            if self.decode_pool is None:
+                features_list, valid_indices = await asyncio.get_event_loop().run_in_executor(
+                    self.executor, self._extract_batch_features_sync, image_inputs
+                )
+            else:
+                features_list, valid_indices = await self._extract_batch_features_pooled(image_inputs)
+            mask = np.zeros(len(image_inputs), dtype=bool)
+            mask[valid_indices] = True
+            return np.array(features_list, dtype=np.float32).reshape(-1, self.feature_dim), mask
         except Exception as e:
             self.logger.error(f"批量特征提取失败: {e}")
             raise
     
-    def _extract_batch_features_sync(self, image_inputs: List[Union[str, Image.Image, bytes]]) -> List[np.ndarray]:
-        """同步批量提取特征（在线程池中执行）"""
-        features_list = []
+    async def _extract_batch_features_pooled(
+        self, image_inputs: List[Union[str, Image.Image, bytes]]
+    ) -> Tuple[List[np.ndarray], List[int]]:
+        """使用解码进程池批量提取特征，每批图像并行解码后整批推理，返回特征及成功图像的下标"""
+        features_list, valid_indices = [], []
+        batch_size = max(1, min(settings.model.batch_size, self.decode_pool.slots))
+        loop = asyncio.get_event_loop()
+        
+        for i in range(0, len(image_inputs), batch_size):
+            batch = image_inputs[i:i + batch_size]
+            decoded = await asyncio.gather(
+                *[self.decode_pool.decode(image_input) for image_input in batch],
+                return_exceptions=True
+            )
+            
+            slots, images, indices = [], [], []
+            for j, result in enumerate(decoded):
+                if isinstance(result, BaseException):
+                    self.logger.warning(f"处理图像失败: {result}")
+                    continue
+                slots.append(result[0])
+                images.append(result[1])
+                indices.append(i + j)
+            
+            try:
+                if images:
+                    features_list.extend(
+                        await loop.run_in_executor(self.inference_executor, self._forward, images)
+                    )
+                    valid_indices.extend(indices)
+            finally:
+                for slot in slots:
+                    self.decode_pool.release(slot)
+        
+        return features_list, valid_indices
+    
+    def _extract_batch_features_sync(
+        self, image_inputs: List[Union[str, Image.Image, bytes]]
+    ) -> Tuple[List[np.ndarray], List[int]]:
+        """同步批量提取特征（在线程池中执行），返回特征及成功图像的下标"""
+        features_list, valid_indices = [], []
         batch_size = settings.model.batch_size
         
         for i in range(0, len(image_inputs), batch_size):
             batch = image_inputs[i:i + batch_size]
-            batch_tensors = []
+            batch_tensors, indices = [], []
             
             # 准备批次数据
-            for image_input in batch:
+            for j, image_input in enumerate(batch):
                 try:
-                    # 加载和预处理图像
-                    if isinstance(image_input, str):
-                        image = Image.open(image_input).convert('RGB')
-                    elif isinstance(image_input, bytes):
-                        image = Image.open(io.BytesIO(image_input)).convert('RGB')
-                    elif isinstance(image_input, Image.Image):
-                        image = image_input.convert('RGB')
-                    else:
-                        continue
-                    
-                    tensor = self.transform(image)
-                    batch_tensors.append(tensor)
+                    batch_tensors.append(self._preprocess(image_input))
+                    indices.append(i + j)
                 except Exception as e:
                     self.logger.warning(f"处理图像失败: {e}")
                     continue
@@ -189,37 +297,57 @@ class ModelService(LoggerMixin):
                 continue
             
             # 批次推理
-            batch_tensor = torch.stack(batch_tensors).to(self.device)
-            with torch.no_grad():
-                batch_features = self.model(batch_tensor)
-                batch_features = batch_features.squeeze().cpu().numpy()
-                
-                # 处理单个样本的情况
-                if len(batch_features.shape) == 1:
-                    batch_features = batch_features.reshape(1, -1)
-                
-                # L2 归一化
-                for j in range(batch_features.shape[0]):
-                    feature = batch_features[j]
-                    feature = feature / np.linalg.norm(feature)
-                    features_list.append(feature)
+            features_list.extend(self._forward(batch_tensors))
+            valid_indices.extend(indices)
         
-        return features_list
+        return features_list, valid_indices
     
     def get_feature_dim(self) -> int:
         """获取特征维度"""
         return self.feature_dim
     
+    @property
+    def fingerprint(self) -> str:
+        """特征提取配置的标识：模型、权重、实际使用的推理后端和量化方式、输入尺寸及特征维度
+        
+        不同标识产生的向量不能混用，持久化的特征缓存按标识隔离。
+        """
+        backend, quantization = self.active_backend
+        weights = "pretrained" if settings.model.pretrained else "random"
+        return f"{settings.model.name}-{weights}-{backend}-{quantization}-{MODEL_INPUT_SIZE}-{self.feature_dim}"
+    
     def is_initialized(self) -> bool:
         """检查模型是否已初始化"""
         return self.model is not None
     
+    def get_stats(self) -> dict:
+        """获取模型服务统计信息"""
+        return {
+            "model": settings.model.name,
+            "device": str(self.device) if self.device else None,
+            "feature_dim": self.feature_dim,
+            # 实际使用的后端（偏差超限时已回退到 fp32 eager），以及配置的后端
+            "backend": self.active_backend[0],
+            "quantization": self.active_backend[1],
+            "configured_backend": settings.model.backend,
+            "configured_quantization": settings.model.quantization,
+            "fingerprint": self.fingerprint,
+            "drift": self.drift_report,
+            "dynamic_batching": settings.model.dynamic_batching,
+            "batching": self._batcher.get_stats(),
+            "decode_pool": self.decode_pool.get_stats() if self.decode_pool is not None else None
+        }
+    
     async def cleanup(self):
         """清理资源"""
         try:
             self.logger.info("正在清理模型服务资源...")
-            if hasattr(self, 'executor'):
-                self.executor.shutdown(wait=True)
+            # 处理已排队的请求后关闭线程池
+            await self._batcher.drain()
+            self.executor.shutdown(wait=True)
+            self.inference_executor.shutdown(wait=True)
+            if self.decode_pool is not None:
+                self.decode_pool.shutdown()
             
             # 清理GPU内存
             if self.device and self.device.type == 'cuda':
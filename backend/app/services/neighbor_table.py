@@ -0,0 +1,335 @@
+"""
+近邻表服务
+离线批量计算每张已入库图像的Top-K相似图像并持久化，
+以图搜图请求的k不超过K时直接查表返回，无需访问索引
+"""
+
+import asyncio
+import json
+import os
+import time
+import numpy as np
+from typing import List, Optional, Tuple
+
+from ..utils.logger import LoggerMixin
+from .faiss_service import FaissService
+
+
+class NeighborTable(LoggerMixin):
+    """预计算的近邻表
+    
+    三个按图像ID对齐的数组：`<path>.ids.npy`（升序图像ID）、`<path>.neighbors.npy`
+    （(n, K) 近邻图像ID，不足时以-1填充）和 `<path>.scores.npy`（(n, K) 相似度），
+    元数据记录在 `<path>.meta.json`。查询为一次二分查找，结果数组整体替换，
+    进行中的查询不受刷新影响。
+    
+    索引增删后按差异增量刷新：
+    - 已删除图像的行被移除，近邻中含有已删除图像的行重新计算
+    - 新图像计算自身的近邻；已有行分块与新图像逐一比较，新图像进入该行Top-K时插入
+    变更超过 full_rebuild_ratio 时改为全量重建。
+    """
+    
+    def __init__(self, faiss_service: FaissService, path: str, k: int = 50,
+                 chunk_size: int = 1024, workers: int = 2,
+                 refresh_interval_seconds: float = 60.0, full_rebuild_ratio: float = 0.2):
+        self.faiss_service = faiss_service
+        self.path = path
+        self.k = max(1, k)
+        self.chunk_size = max(1, chunk_size)
+        self.workers = max(1, workers)
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.full_rebuild_ratio = full_rebuild_ratio
+        
+        empty = np.empty(0, dtype=np.int64)
+        self._table = (empty, np.empty((0, self.k), dtype=np.int64), np.empty((0, self.k), dtype=np.float32))
+        self._generation = None  # 生成近邻表时的索引版本，None 表示尚未生成
+        self._build_lock = asyncio.Lock()
+        self._build_task: Optional[asyncio.Task] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._status = {"status": "idle"}
+        
+        # 统计信息
+        self._hits = 0
+        self._misses = 0
+    
+    async def initialize(self, build_if_missing: bool = True):
+        """加载已有近邻表并启动后台增量刷新"""
+        loaded = await asyncio.get_event_loop().run_in_executor(None, self._load)
+        if not loaded and build_if_missing:
+            await self.start_build()
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+    
+    def _files(self) -> Tuple[str, str, str, str]:
+        return (f"{self.path}.ids.npy", f"{self.path}.neighbors.npy",
+                f"{self.path}.scores.npy", f"{self.path}.meta.json")
+    
+    def _load(self) -> bool:
+        """加载近邻表，文件缺失、K值变化或数据不一致时返回False"""
+        ids_path, neighbors_path, scores_path, meta_path = self._files()
+        if not os.path.exists(meta_path):
+            return False
+        
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('k') != self.k:
+                self.logger.info(f"近邻表K值已变更: {meta.get('k')} -> {self.k}，需要重新生成")
+                return False
+            
+            ids = np.load(ids_path, mmap_mode='r')
+            neighbors = np.load(neighbors_path, mmap_mode='r')
+            scores = np.load(scores_path, mmap_mode='r')
+            if not (len(ids) == neighbors.shape[0] == scores.shape[0] == meta.get('rows')):
+                raise ValueError("数组行数与元数据不一致")
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"加载近邻表失败，需要重新生成: {e}")
+            return False
+        
+        self._table = (ids, neighbors, scores)
+        # 加载的表与当前索引的差异由下一次增量刷新补齐
+        self._generation = -1
+        self.logger.info(f"近邻表已加载: {self.path}, 共{len(ids)}行, K={self.k}")
+        return True
+    
+    def _save(self, table: Tuple[np.ndarray, np.ndarray, np.ndarray]):
+        """保存近邻表（先写临时文件再原子替换，元数据最后写入）"""
+        table_dir = os.path.dirname(self.path)
+        if table_dir:
+            os.makedirs(table_dir, exist_ok=True)
+        
+        *array_paths, meta_path = self._files()
+        for path, array in zip(array_paths, table):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp_path, path)
+        
+        tmp_path = f"{meta_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'k': self.k, 'rows': len(table[0]), 'saved_at': time.time()}, f)
+        os.replace(tmp_path, meta_path)
+    
+    def lookup(self, image_id: int, k: int) -> Optional[List[Tuple[int, float]]]:
+        """
+        查询图像的前k个近邻
+        
+        Returns:
+            [(图像ID, 相似度)]；k超过K、图像不在表中、表生成后索引中加入了新向量
+            或有效近邻不足k个时返回None，由调用方回退到实时搜索
+        """
+        ids, neighbors, scores = self._table
+        if not self.covers_inserts():
+            # 新图像可能是任意一行的近邻，刷新前查表会漏掉它们
+            self._misses += 1
+            return None
+        
+        pos = int(np.searchsorted(ids, image_id))
+        if k > self.k or pos >= len(ids) or ids[pos] != image_id:
+            self._misses += 1
+            return None
+        
+        row_ids = np.asarray(neighbors[pos])
+        row_scores = np.asarray(scores[pos])
+        valid = row_ids >= 0
+        row_ids, row_scores = row_ids[valid], row_scores[valid]
+        # 刷新前已从索引删除的图像不返回
+        indexed = self.faiss_service.contains_images(row_ids)
+        row_ids, row_scores = row_ids[indexed], row_scores[indexed]
+        
+        # 表中近邻不足k个时，只有生成时整行未填满且没有近邻被删除才是完整结果
+        if len(row_ids) < k and (valid.all() or not indexed.all()):
+            self._misses += 1
+            return None
+        
+        self._hits += 1
+        return list(zip(row_ids[:k].tolist(), row_scores[:k].astype(float).tolist()))
+    
+    @property
+    def generation(self) -> Optional[int]:
+        """生成近邻表时的索引版本"""
+        return self._generation
+    
+    def covers_inserts(self) -> bool:
+        """近邻表生成后索引中是否没有加入新向量（删除在查表时过滤，不影响）"""
+        return self._generation is not None and self._generation >= self.faiss_service.insert_generation
+    
+    def is_building(self) -> bool:
+        """是否有进行中的全量生成"""
+        return self._build_task is not None and not self._build_task.done()
+    
+    async def start_build(self) -> dict:
+        """在后台全量生成近邻表"""
+        if self.is_building():
+            raise RuntimeError("近邻表生成任务正在进行中")
+        
+        self._status = {
+            "status": "running",
+            "mode": "full",
+            "total": 0,
+            "processed": 0,
+            "started_at": time.time(),
+            "finished_at": None,
+            "error": None
+        }
+        self._build_task = asyncio.create_task(self._run_build())
+        return self.get_status()
+    
+    async def _run_build(self):
+        try:
+            async with self._build_lock:
+                generation = self.faiss_service.generation
+                image_ids = self.faiss_service.indexed_image_ids()
+                self._status["total"] = len(image_ids)
+                table = await self._compute(image_ids, track_progress=True)
+                await self._publish(table, generation)
+            self._status.update({"status": "completed", "finished_at": time.time()})
+            self.logger.info(f"近邻表生成完成: 共{len(table[0])}行, K={self.k}")
+        except Exception as e:
+            self.logger.error(f"生成近邻表失败: {e}")
+            self._status.update({"status": "failed", "error": str(e), "finished_at": time.time()})
+    
+    async def _compute(self, image_ids: np.ndarray, candidates: Optional[np.ndarray] = None,
+                       track_progress: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        分块并行计算近邻，返回按图像ID排序的数组
+        
+        Args:
+            image_ids: 需要计算的图像
+            candidates: 只在这些图像中查找近邻，为空时搜索整个索引
+            track_progress: 是否更新全量生成进度
+        """
+        chunks = [image_ids[i:i + self.chunk_size] for i in range(0, len(image_ids), self.chunk_size)]
+        # 限制同时占用的搜索线程数，在线搜索不会被分块任务排满
+        semaphore = asyncio.Semaphore(self.workers)
+        
+        async def run_chunk(chunk: np.ndarray):
+            async with semaphore:
+                if candidates is None:
+                    result = await self.faiss_service.search_neighbors(chunk, self.k)
+                else:
+                    result = await self.faiss_service.search_among(chunk, candidates, self.k)
+            if track_progress:
+                self._status["processed"] += len(chunk)
+            return result
+        
+        results = await asyncio.gather(*[run_chunk(chunk) for chunk in chunks])
+        if not results:
+            return self._table[0][:0], self._table[1][:0], self._table[2][:0]
+        
+        ids = np.concatenate([r[0] for r in results])
+        order = np.argsort(ids, kind='stable')
+        return (ids[order], np.concatenate([r[1] for r in results])[order],
+                np.concatenate([r[2] for r in results])[order])
+    
+    async def _publish(self, table: Tuple[np.ndarray, np.ndarray, np.ndarray], generation: int):
+        """替换内存中的近邻表并落盘"""
+        self._table = table
+        self._generation = generation
+        await asyncio.get_event_loop().run_in_executor(None, self._save, table)
+    
+    async def refresh(self) -> dict:
+        """按索引与近邻表的差异增量刷新"""
+        async with self._build_lock:
+            generation = self.faiss_service.generation
+            if generation == self._generation:
+                return {"added": 0, "removed": 0, "recomputed": 0}
+            
+            indexed_ids = self.faiss_service.indexed_image_ids()
+            ids, neighbors, scores = self._table
+            removed = np.setdiff1d(ids, indexed_ids, assume_unique=True)
+            added = np.setdiff1d(indexed_ids, ids, assume_unique=True)
+            
+            keep = ~np.isin(ids, removed)
+            ids, neighbors, scores = ids[keep], np.asarray(neighbors[keep]), np.asarray(scores[keep])
+            stale = np.isin(neighbors, removed).any(axis=1) if len(removed) else np.zeros(len(ids), dtype=bool)
+            
+            changed = len(added) + int(stale.sum())
+            if changed > self.full_rebuild_ratio * max(len(indexed_ids), 1):
+                self.logger.info(f"近邻表变更较多({changed}行)，改为全量生成")
+                table = await self._compute(indexed_ids)
+                await self._publish(table, generation)
+                return {"added": len(added), "removed": len(removed), "recomputed": len(table[0])}
+            
+            recomputed = await self._compute(np.concatenate([ids[stale], added]))
+            kept = (ids[~stale], neighbors[~stale], scores[~stale])
+            # 近邻关系不对称，已有行需要与全部新图像比较才能得到准确的Top-K
+            inserted = await self._compute(kept[0], candidates=added) if len(added) else None
+            table = await asyncio.get_event_loop().run_in_executor(
+                None, self._merge, kept, inserted, recomputed, self.faiss_service.scores_descending
+            )
+            await self._publish(table, generation)
+            return {"added": len(added), "removed": len(removed), "recomputed": len(recomputed[0])}
+    
+    def _merge(self, kept: Tuple[np.ndarray, np.ndarray, np.ndarray],
+               inserted: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+               recomputed: Tuple[np.ndarray, np.ndarray, np.ndarray],
+               descending: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        合并近邻表
+        
+        Args:
+            kept: 无需重新计算的已有行
+            inserted: 已有行在新图像中的近邻，与原近邻合并后取Top-K
+            recomputed: 重新计算的行和新图像的行
+            descending: 得分是否越大越相似
+        """
+        ids, neighbors, scores = kept
+        if inserted is not None and len(inserted[0]):
+            rows = np.searchsorted(ids, inserted[0])
+            merged_ids = np.hstack([neighbors[rows], inserted[1]])
+            merged_scores = np.hstack([scores[rows], inserted[2]])
+            order_key = np.where(merged_ids >= 0, merged_scores if descending else -merged_scores, -np.inf)
+            # 稳定排序，得分相同时原有近邻在前
+            order = np.argsort(-order_key, axis=1, kind='stable')[:, :self.k]
+            neighbors[rows] = np.take_along_axis(merged_ids, order, axis=1)
+            scores[rows] = np.take_along_axis(merged_scores, order, axis=1)
+        
+        new_ids, new_neighbors, new_scores = recomputed
+        ids = np.concatenate([ids, new_ids])
+        order = np.argsort(ids, kind='stable')
+        return (ids[order], np.concatenate([neighbors, new_neighbors])[order],
+                np.concatenate([scores, new_scores])[order])
+    
+    async def _refresh_loop(self):
+        """索引版本变化后定期增量刷新（启动时加载的表立即刷新，刷新前查表全部回退到实时搜索）"""
+        while True:
+            if not self.is_building() and self.faiss_service.generation != self._generation:
+                try:
+                    changes = await self.refresh()
+                    self.logger.info(f"近邻表增量刷新完成: {changes}")
+                except Exception as e:
+                    self.logger.error(f"近邻表增量刷新失败: {e}")
+            await asyncio.sleep(self.refresh_interval_seconds)
+    
+    def get_status(self) -> dict:
+        """获取近邻表生成进度"""
+        status = dict(self._status)
+        if status.get("total"):
+            status["progress"] = round(status.get("processed", 0) / status["total"], 4)
+        return status
+    
+    def get_stats(self) -> dict:
+        """获取近邻表统计信息"""
+        lookups = self._hits + self._misses
+        return {
+            "path": self.path,
+            "k": self.k,
+            "rows": len(self._table[0]),
+            "generation": self._generation,
+            "up_to_date": self._generation == self.faiss_service.generation,
+            "covers_inserts": self.covers_inserts(),
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": round(self._hits / lookups, 4) if lookups else 0,
+            "build": self.get_status()
+        }
+    
+    async def cleanup(self):
+        """停止后台任务"""
+        for task in (self._refresh_task, self._build_task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
\ No newline at end of file
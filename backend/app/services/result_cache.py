@@ -0,0 +1,77 @@
+"""
+搜索结果缓存
+按查询标识缓存搜索命中的 (图像ID, 相似度) 列表，并以Faiss索引版本判断是否过期
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from ..utils.logger import LoggerMixin
+
+
+class SearchResultCache(LoggerMixin):
+    """搜索结果缓存
+    
+    每个条目记录写入时的索引版本（FaissService.generation）。索引发生任何增删或替换后
+    版本递增，读取时版本不一致的条目视为过期并丢弃，因此不会返回过期结果。
+    写入方应在执行搜索之前读取版本号，搜索期间发生的变更会使该条目立即失效。
+    
+    只缓存命中的图像ID和相似度，不缓存图片详情：修改图片信息、停用未入索引的图片都不改变索引版本，
+    调用方在命中后从数据库读取详情并跳过已停用的图片。
+    """
+    
+    def __init__(self, max_entries: int = 5000, ttl_seconds: float = 300):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # 键 -> (索引版本, 过期时间, 结果)
+        
+        # 统计信息
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+        self._evictions = 0
+    
+    def get(self, key: Hashable, generation: int) -> Optional[Any]:
+        """读取与当前索引版本一致的缓存结果"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry_generation, expires_at, value = entry
+            if entry_generation == generation and expires_at >= time.time():
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return value
+            
+            del self._entries[key]
+            self._stale += 1
+        
+        self._misses += 1
+        return None
+    
+    def put(self, key: Hashable, generation: int, value: Any):
+        """写入缓存，generation 为执行搜索前读取的索引版本"""
+        self._entries[key] = (generation, time.time() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+    
+    def clear(self) -> int:
+        """清空缓存，返回清除的条目数"""
+        cleared = len(self._entries)
+        self._entries.clear()
+        return cleared
+    
+    def get_stats(self) -> dict:
+        """获取缓存统计信息"""
+        lookups = self._hits + self._misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self._hits,
+            "misses": self._misses,
+            "stale": self._stale,
+            "evictions": self._evictions,
+            "hit_rate": round(self._hits / lookups, 4) if lookups else 0
+        }
\ No newline at end of file
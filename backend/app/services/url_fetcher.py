@@ -0,0 +1,259 @@
+"""
+图片URL下载服务
+所有按URL搜索的请求共用一个连接池，限制每个主机的并发下载数，流式下载并在写盘前校验类型和大小
+"""
+
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Iterable, Optional
+
+import httpx
+
+from ..utils.logger import LoggerMixin
+from .image_storage import EXTENSION_FORMATS, SNIFF_BYTES, discard_temp_file, sniff_image_format
+
+# 流式下载时每次读取的块大小
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class FetchError(ValueError):
+    """图片下载失败或内容不符合要求，消息可直接返回给客户端"""
+
+
+class UrlFetcher(LoggerMixin):
+    """图片URL下载器
+    
+    - 共享一个带连接池的 httpx.AsyncClient，连接在请求之间复用
+    - 每个主机同时最多 max_per_host 个下载，单个慢主机不会占满连接池
+    - 响应体分块写入临时文件：先检查状态码、Content-Type 和 Content-Length，
+      第一个块到达后校验文件头魔数，累计超过 max_bytes 立即中止，整个下载受 total_timeout 限制
+    - 下载结果按URL缓存 cache_ttl_seconds 秒，过期后携带 ETag 发送条件请求，304时继续使用缓存的文件
+    - 通过 transport 参数可以注入测试用的传输层
+    """
+    
+    def __init__(self, max_bytes: int, allowed_extensions: Optional[Iterable[str]] = None,
+                 timeout_seconds: float = 10.0, total_timeout_seconds: float = 30.0,
+                 max_connections: int = 100, max_per_host: int = 4, max_redirects: int = 5,
+                 cache_ttl_seconds: float = 300.0, cache_max_entries: int = 256,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.max_bytes = max_bytes
+        self.allowed_formats = {
+            EXTENSION_FORMATS[ext.lower().lstrip('.')]
+            for ext in (allowed_extensions or EXTENSION_FORMATS)
+            if ext.lower().lstrip('.') in EXTENSION_FORMATS
+        }
+        self.total_timeout_seconds = total_timeout_seconds
+        self.max_per_host = max(1, max_per_host)
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self.cache_max_entries = max(0, cache_max_entries)
+        self.cache_dir = tempfile.mkdtemp(prefix="url_fetch_")
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout_seconds),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            follow_redirects=True,
+            max_redirects=max_redirects,
+            transport=transport
+        )
+        
+        self._host_slots: Dict[str, list] = {}  # 主机 -> [信号量, 使用中的请求数]
+        self._cache: "OrderedDict[str, dict]" = OrderedDict()
+        
+        # 统计信息
+        self._hits = 0
+        self._revalidated = 0
+        self._downloads = 0
+        self._download_bytes = 0
+        self._rejected = 0
+    
+    @asynccontextmanager
+    async def fetch(self, url: str):
+        """
+        下载图片，在上下文内可以读取返回的文件，退出后缓存以外的文件被删除
+        
+        Yields:
+            {"path", "content_hash", "size", "content_type", "etag"}
+        
+        Raises:
+            FetchError: 下载失败、超时或内容不是允许的图片
+        """
+        entry = self._cache.get(url)
+        if entry is not None and entry["expires_at"] > time.time():
+            self._hits += 1
+            self._cache.move_to_end(url)
+        else:
+            entry = await self._refresh(url, entry)
+        
+        entry["refs"] += 1
+        try:
+            yield entry
+        finally:
+            entry["refs"] -= 1
+            self._release(entry)
+    
+    async def _refresh(self, url: str, stale: Optional[dict]) -> dict:
+        """下载新条目，或携带 ETag 重新验证过期的条目"""
+        if stale is not None:
+            # 重新验证期间条目可能被淘汰，先占用防止文件被删除
+            stale["refs"] += 1
+            try:
+                downloaded = await self._download_checked(url, stale["etag"])
+                if downloaded is None:
+                    # 304：内容未变化，继续使用缓存的文件
+                    self._revalidated += 1
+                    stale["expires_at"] = time.time() + self.cache_ttl_seconds
+                    stale["evicted"] = False
+                    self._store(url, stale)
+                    return stale
+            finally:
+                stale["refs"] -= 1
+                self._release(stale)
+        else:
+            downloaded = await self._download_checked(url, None)
+        
+        self._store(url, downloaded)
+        return downloaded
+    
+    async def _download_checked(self, url: str, etag: Optional[str]) -> Optional[dict]:
+        """在总超时内完成下载，网络异常转换为 FetchError"""
+        try:
+            return await asyncio.wait_for(self._download(url, etag), self.total_timeout_seconds)
+        except FetchError:
+            self._rejected += 1
+            raise
+        except asyncio.TimeoutError:
+            self._rejected += 1
+            raise FetchError("下载超时，请稍后重试")
+        except httpx.ConnectError as e:
+            self.logger.warning(f"网络连接失败: {url}, {e}")
+            raise FetchError("网络连接失败，请检查URL或网络设置")
+        except httpx.TimeoutException as e:
+            self.logger.warning(f"请求超时: {url}, {e}")
+            raise FetchError("请求超时，请稍后重试")
+        except httpx.InvalidURL:
+            raise FetchError("URL格式不正确")
+        except httpx.HTTPError as e:
+            raise FetchError(f"下载图片失败: {str(e)}")
+    
+    async def _download(self, url: str, etag: Optional[str]) -> Optional[dict]:
+        """流式下载到临时文件，etag 命中时返回None"""
+        headers = {"If-None-Match": etag} if etag else {}
+        async with self._host_slot(httpx.URL(url).host):
+            async with self.client.stream("GET", url, headers=headers) as response:
+                if response.status_code == 304 and etag:
+                    return None
+                if response.status_code != 200:
+                    raise FetchError(f"无法下载图片，状态码: {response.status_code}")
+                
+                content_type = response.headers.get("content-type", "")
+                if not content_type.startswith("image/"):
+                    raise FetchError("URL必须指向图片文件")
+                content_length = response.headers.get("content-length", "")
+                if content_length.isdigit() and int(content_length) > self.max_bytes:
+                    raise FetchError("图片大小超过限制")
+                
+                fd, path = tempfile.mkstemp(suffix=".part", dir=self.cache_dir)
+                hasher = hashlib.md5()
+                size = 0
+                head = b""
+                try:
+                    # 单个块只有几十KB，直接写入页缓存，不切换线程
+                    with os.fdopen(fd, 'wb') as f:
+                        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                            size += len(chunk)
+                            if size > self.max_bytes:
+                                raise FetchError("图片大小超过限制")
+                            if len(head) < SNIFF_BYTES:
+                                head += chunk[:SNIFF_BYTES]
+                                if len(head) >= SNIFF_BYTES:
+                                    self._check_format(head)
+                            hasher.update(chunk)
+                            f.write(chunk)
+                    if len(head) < SNIFF_BYTES:
+                        self._check_format(head)
+                except BaseException:
+                    discard_temp_file(path)
+                    raise
+                
+                self._downloads += 1
+                self._download_bytes += size
+                return {
+                    "path": path,
+                    "content_hash": hasher.hexdigest(),
+                    "size": size,
+                    "content_type": content_type,
+                    "etag": response.headers.get("etag"),
+                    "expires_at": time.time() + self.cache_ttl_seconds,
+                    "refs": 0,
+                    "evicted": False
+                }
+    
+    def _check_format(self, head: bytes):
+        image_format = sniff_image_format(head)
+        if image_format is None or image_format not in self.allowed_formats:
+            raise FetchError("URL内容不是支持的图片格式")
+    
+    @asynccontextmanager
+    async def _host_slot(self, host: str):
+        """限制同一主机的并发下载数，主机没有进行中的下载时释放其信号量"""
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = self._host_slots[host] = [asyncio.Semaphore(self.max_per_host), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                del self._host_slots[host]
+    
+    def _store(self, url: str, entry: dict):
+        """加入缓存并淘汰最久未使用的条目；不缓存时条目在使用结束后删除"""
+        if self.cache_ttl_seconds <= 0 or self.cache_max_entries <= 0:
+            entry["evicted"] = True
+            return
+        current = self._cache.get(url)
+        if current is not None and current is not entry:
+            # 并发请求已经刷新过该URL，淘汰旧条目
+            self._evict(url)
+        self._cache[url] = entry
+        self._cache.move_to_end(url)
+        while len(self._cache) > self.cache_max_entries:
+            self._evict(next(iter(self._cache)))
+    
+    def _evict(self, url: str):
+        entry = self._cache.pop(url)
+        entry["evicted"] = True
+        self._release(entry)
+    
+    @staticmethod
+    def _release(entry: dict):
+        """已淘汰且没有请求在使用的条目删除其文件"""
+        if entry["evicted"] and entry["refs"] == 0:
+            discard_temp_file(entry["path"])
+    
+    def get_stats(self) -> dict:
+        """获取统计信息"""
+        return {
+            "cache_entries": len(self._cache),
+            "cache_hits": self._hits,
+            "revalidated": self._revalidated,
+            "downloads": self._downloads,
+            "download_mb": round(self._download_bytes / 1024 / 1024, 2),
+            "rejected": self._rejected,
+            "active_hosts": len(self._host_slots),
+            "active_downloads": sum(count for _, count in self._host_slots.values())
+        }
+    
+    async def cleanup(self):
+        """关闭连接池并删除缓存的文件"""
+        await self.client.aclose()
+        for url in list(self._cache):
+            self._evict(url)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""
+微批处理工具模块
+将并发到达的请求在短时间窗口内合并为一批统一处理
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+from .logger import LoggerMixin
+
+
+class MicroBatcher(LoggerMixin):
+    """异步微批处理器
+    
+    调用方通过 `submit` 提交单个请求并等待其结果；同一分组的请求累积到
+    max_batch_size 个，或第一个请求等待超过 max_wait_ms 后，作为一批交给
+    run_batch 处理，再把结果按顺序分发给各自的调用方。
+    
+    run_batch 签名为 `async (key, items) -> results`，results 与 items 一一对应；
+    批处理抛出的异常会传递给该批的全部调用方。分组键用于隔离参数不同、
+    不能合并执行的请求。
+    """
+    
+    def __init__(self, run_batch: Callable[[Hashable, List[Any]], Awaitable[List[Any]]],
+                 max_batch_size: int = 32, max_wait_ms: float = 2.0, name: str = "batcher"):
+        self._run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.name = name
+        
+        self._pending: Dict[Hashable, List[Tuple[Any, asyncio.Future, float]]] = {}
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        self._tasks: set = set()
+        
+        # 统计信息
+        self._total_batches = 0
+        self._total_items = 0
+        self._failed_batches = 0
+        self._max_observed = 0
+        self._total_wait = 0.0
+    
+    async def submit(self, item: Any, key: Hashable = None) -> Any:
+        """提交单个请求并等待所在批次的处理结果"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue = self._pending.setdefault(key, [])
+        queue.append((item, future, time.perf_counter()))
+        
+        if len(queue) >= self.max_batch_size:
+            self._flush(key)
+        elif len(queue) == 1:
+            if self.max_wait > 0:
+                self._timers[key] = loop.call_later(self.max_wait, self._flush, key)
+            else:
+                # 不等待时仍让出一次事件循环，合并同一轮到达的请求
+                self._timers[key] = loop.call_soon(self._flush, key)
+        
+        return await future
+    
+    def _flush(self, key: Hashable):
+        """将分组内累积的请求作为一批提交处理"""
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        
+        queue = self._pending.pop(key, None)
+        if not queue:
+            return
+        
+        task = asyncio.ensure_future(self._execute(key, queue))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _execute(self, key: Hashable, queue: List[Tuple[Any, asyncio.Future, float]]):
+        """执行一批请求并分发结果"""
+        # 已被调用方取消的请求不再处理
+        queue = [entry for entry in queue if not entry[1].done()]
+        if not queue:
+            return
+        
+        now = time.perf_counter()
+        self._total_batches += 1
+        self._total_items += len(queue)
+        self._max_observed = max(self._max_observed, len(queue))
+        self._total_wait += sum(now - enqueued for _, _, enqueued in queue)
+        
+        try:
+            results = await self._run_batch(key, [item for item, _, _ in queue])
+            if len(results) != len(queue):
+                raise RuntimeError(f"批处理结果数量不一致: {len(results)} != {len(queue)}")
+        except Exception as e:
+            self._failed_batches += 1
+            self.logger.error(f"{self.name} 批处理失败: {e}")
+            for _, future, _ in queue:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (_, future, _), result in zip(queue, results):
+            if not future.done():
+                future.set_result(result)
+    
+    async def drain(self):
+        """立即处理全部累积的请求并等待进行中的批次完成"""
+        for key in list(self._pending):
+            self._flush(key)
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+    
+    def get_stats(self) -> dict:
+        """获取批处理统计信息"""
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "total_batches": self._total_batches,
+            "total_items": self._total_items,
+            "failed_batches": self._failed_batches,
+            "avg_batch_size": round(self._total_items / self._total_batches, 2) if self._total_batches else 0,
+            "max_observed_batch_size": self._max_observed,
+            "avg_wait_ms": round(self._total_wait / self._total_items * 1000, 3) if self._total_items else 0,
+            "pending": sum(len(queue) for queue in self._pending.values()),
+            "in_flight_batches": len(self._tasks)
+        }
\ No newline at end of file
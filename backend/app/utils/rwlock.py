@@ -0,0 +1,75 @@
+"""
+读写锁工具模块
+允许多个读者并发访问，写者独占访问
+"""
+
+import threading
+from contextlib import contextmanager
+
+
+class RWLock:
+    """写者优先的读写锁
+    
+    有写者等待时新的读者会阻塞，避免持续的搜索请求使写入一直无法获得锁。
+    锁不可重入：持有读锁时不能再获取写锁，反之亦然。
+    """
+    
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+    
+    def acquire_read(self):
+        """获取读锁"""
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+    
+    def release_read(self):
+        """释放读锁"""
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+    
+    def acquire_write(self):
+        """获取写锁"""
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+    
+    def release_write(self):
+        """释放写锁"""
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+    
+    @contextmanager
+    def read(self):
+        """读锁上下文"""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+    
+    @contextmanager
+    def write(self):
+        """写锁上下文"""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+    
+    @property
+    def readers(self) -> int:
+        """当前持有读锁的线程数"""
+        return self._readers
\ No newline at end of file
@@ -0,0 +1,140 @@
+"""
+静态文件服务模块
+在 Starlette StaticFiles 的基础上补充缓存头、预压缩文件和交给反向代理发送文件的支持
+"""
+
+import os
+import re
+from mimetypes import guess_type
+from typing import Dict, Iterable, Optional, Tuple
+from urllib.parse import quote
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+# 内容寻址的原图：文件名为32位MD5
+CONTENT_ADDRESSED_NAME = re.compile(r"^[0-9a-f]{32}\.[A-Za-z0-9]+$")
+# 支持的预压缩格式，按优先级排列
+PRECOMPRESSED_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+# 本身已压缩的格式不查找预压缩文件，常见图片请求不产生额外的文件系统访问
+COMPRESSED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".gz", ".br", ".zip", ".woff2"}
+
+
+class ImageFileResponse(FileResponse):
+    """更大读取块的文件响应：每个块都要切换一次线程，块越大事件循环开销越小"""
+    chunk_size = 256 * 1024
+
+
+def _accepted_encodings(accept_encoding: str) -> set:
+    """解析 Accept-Encoding，返回可接受的编码（忽略 q=0）"""
+    accepted = set()
+    for item in accept_encoding.split(","):
+        parts = [part.strip() for part in item.split(";")]
+        if not parts[0]:
+            continue
+        if any(part.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000") for part in parts[1:]):
+            continue
+        accepted.add(parts[0].lower())
+    return accepted
+
+
+class CachedStaticFiles(StaticFiles):
+    """带缓存策略的静态文件服务
+    
+    - 内容寻址的原图URL与内容一一对应，返回 immutable 长缓存，ETag 使用内容哈希
+    - derived_dirs 下的派生文件（可能按新参数重新生成）和其他文件使用较短的缓存时间，过期后通过
+      ETag / Last-Modified 条件请求重新验证，未变化时返回304
+    - Range 请求、HEAD 请求以及服务器支持的 pathsend 零拷贝扩展由 FileResponse 处理
+    - 客户端接受时优先返回同目录下的 .br / .gz 预压缩文件
+    - 配置 sendfile_header 后只返回响应头，由前置的 nginx（X-Accel-Redirect）
+      或 Apache/lighttpd（X-Sendfile）通过 sendfile 发送文件，不占用应用进程
+    - denied_dirs 下的文件和以 . 开头的隐藏文件、目录（如未完成上传的临时文件）不对外提供，返回404
+    """
+    
+    def __init__(self, *, directory: str, immutable_max_age: int = 31536000,
+                 derived_max_age: int = 86400, default_max_age: int = 3600,
+                 derived_dirs: Iterable[str] = (), denied_dirs: Iterable[str] = (),
+                 precompressed: bool = True,
+                 sendfile_header: Optional[str] = None,
+                 accel_redirect_prefix: str = "/_protected_static", **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        self.immutable_max_age = immutable_max_age
+        self.derived_max_age = derived_max_age
+        self.default_max_age = default_max_age
+        self.derived_dirs = set(derived_dirs)
+        self.denied_dirs = set(denied_dirs)
+        self.precompressed = precompressed
+        self.sendfile_header = sendfile_header or None
+        self.accel_redirect_prefix = accel_redirect_prefix.rstrip("/")
+    
+    def lookup_path(self, path: str) -> Tuple[str, Optional[os.stat_result]]:
+        segments = path.replace(os.sep, "/").split("/")
+        if any(segment.startswith(".") or segment in self.denied_dirs for segment in segments):
+            return "", None
+        return super().lookup_path(path)
+    
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope,
+                      status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        path = self.get_path(scope).replace(os.sep, "/")
+        name = os.path.basename(path)
+        media_type = guess_type(str(full_path))[0] or "application/octet-stream"
+        
+        segments = path.split("/")
+        derived = not self.derived_dirs.isdisjoint(segments[:-1])
+        immutable = not derived and CONTENT_ADDRESSED_NAME.match(name) is not None
+        if immutable:
+            cache_control = f"public, max-age={self.immutable_max_age}, immutable"
+        else:
+            cache_control = f"public, max-age={self.derived_max_age if derived else self.default_max_age}"
+        
+        headers = {"cache-control": cache_control}
+        encoding = None
+        if self.precompressed and os.path.splitext(name)[1].lower() not in COMPRESSED_EXTENSIONS:
+            headers["vary"] = "Accept-Encoding"
+            variant = self._find_precompressed(str(full_path), request_headers.get("accept-encoding", ""))
+            if variant is not None:
+                encoding, full_path, stat_result = variant
+                headers["content-encoding"] = encoding
+                path = f"{path}{dict(PRECOMPRESSED_ENCODINGS)[encoding]}"
+        
+        if immutable:
+            # 内容哈希在所有实例上都相同，与文件的修改时间无关
+            content_hash = name.split(".", 1)[0]
+            headers["etag"] = f'"{content_hash}-{encoding}"' if encoding else f'"{content_hash}"'
+        
+        if self.sendfile_header:
+            return self._sendfile_response(str(full_path), path, status_code, media_type, headers)
+        
+        response = ImageFileResponse(
+            full_path, status_code=status_code, headers=headers,
+            media_type=media_type, stat_result=stat_result
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+    
+    @staticmethod
+    def _find_precompressed(full_path: str, accept_encoding: str) -> Optional[Tuple[str, str, os.stat_result]]:
+        """查找客户端可接受的预压缩文件，返回 (编码, 路径, 文件状态)"""
+        accepted = _accepted_encodings(accept_encoding)
+        for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+            if encoding not in accepted:
+                continue
+            try:
+                stat_result = os.stat(full_path + suffix)
+            except OSError:
+                continue
+            return encoding, full_path + suffix, stat_result
+        return None
+    
+    def _sendfile_response(self, full_path: str, path: str, status_code: int,
+                           media_type: str, headers: Dict[str, str]) -> Response:
+        """只返回响应头，由反向代理读取并发送文件（条件请求和 Range 也由代理处理）"""
+        if self.sendfile_header.lower() == "x-accel-redirect":
+            headers[self.sendfile_header] = quote(f"{self.accel_redirect_prefix}/{path}")
+        else:
+            headers[self.sendfile_header] = os.path.abspath(full_path)
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
\ No newline at end of file
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+图与图寻 - 批量导入命令
+通过管理接口在服务进程内执行导入（索引只由服务进程写入），并显示进度
+
+用法:
+    python ingest.py --dir /data/photos
+    python ingest.py --manifest /data/photos.txt
+    python ingest.py --resume 20240101120000_ab12cd34
+    python ingest.py --status
+"""
+
+import argparse
+import sys
+import time
+
+import httpx
+
+from app.core.config import get_settings
+
+settings = get_settings()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量导入图片")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--dir", help="服务器上 ingest.ingest_root 内的图片目录（递归扫描）")
+    group.add_argument("--manifest", help="服务器上 ingest.ingest_root 内的清单文件，每行一个图片路径")
+    group.add_argument("--resume", metavar="JOB_ID", help="从断点恢复已有任务")
+    group.add_argument("--status", action="store_true", help="查看当前任务进度")
+    group.add_argument("--cancel", action="store_true", help="取消当前任务")
+    parser.add_argument("--server", default=f"http://127.0.0.1:{settings.server.port}", help="服务地址")
+    parser.add_argument("--interval", type=float, default=5.0, help="进度刷新间隔（秒）")
+    parser.add_argument("--no-wait", action="store_true", help="启动后立即返回，不等待完成")
+    args = parser.parse_args()
+    
+    base_url = f"{args.server.rstrip('/')}/api/v1/admin/ingest/bulk"
+    with httpx.Client(timeout=60) as client:
+        if args.status:
+            print_status(client.get(f"{base_url}/status").json()["data"])
+            return
+        if args.cancel:
+            response = client.post(f"{base_url}/cancel")
+            print(response.json().get("message") or response.json().get("detail"))
+            return
+        
+        response = client.post(base_url, json={
+            "source_dir": args.dir,
+            "manifest": args.manifest,
+            "job_id": args.resume
+        })
+        if response.status_code != 200:
+            print(f"❌ 启动失败: {response.json().get('detail')}")
+            sys.exit(1)
+        
+        status = response.json()["data"]
+        print(f"🚀 导入任务已启动: {status['job_id']}（中断后可使用 --resume {status['job_id']} 恢复）")
+        if args.no_wait:
+            return
+        
+        while status.get("status") == "running":
+            print_status(status)
+            time.sleep(args.interval)
+            status = client.get(f"{base_url}/status").json()["data"]
+        print_status(status)
+        if status.get("status") != "completed":
+            sys.exit(1)
+
+
+def print_status(status: dict):
+    """输出任务进度"""
+    if status.get("status") == "idle":
+        print("当前没有导入任务")
+        return
+    total = status.get("total") or 0
+    percent = status.get("progress", 0) * 100
+    line = (
+        f"[{status.get('status')}] {status.get('offset', 0)}/{total} ({percent:.1f}%) "
+        f"导入 {status.get('ingested', 0)}, 重复 {status.get('duplicates', 0)}, 失败 {status.get('failed', 0)}"
+    )
+    if status.get("error"):
+        line += f", 错误: {status['error']}"
+    print(line)
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
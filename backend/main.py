@@ -11,15 +11,24 @@ os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
 
 from app.core.config import get_settings
 from app.core.database import create_tables
 from app.api.routes import api_router
+from app.services.embedding_cache import EmbeddingCache
+from app.services.result_cache import SearchResultCache
 from app.services.faiss_service import FaissService
+from app.services.feature_store import FeatureStore
 from app.services.model_service import ModelService
+from app.services.neighbor_table import NeighborTable
+from app.services.indexing_queue import IndexingQueue
+from app.services.bulk_ingest import BulkIngestor
+from app.services.derivatives import DerivativeService
+from app.services.url_fetcher import UrlFetcher
 from app.utils.logger import setup_logging
+from app.utils.static_files import CachedStaticFiles
+from app.services.image_storage import ANALYSIS_DIR_NAME, THUMBNAIL_DIR_NAME
 
 # 设置日志
 setup_logging()
@@ -42,21 +51,139 @@ async def lifespan(app: FastAPI):
     await model_service.initialize()
     app.state.model_service = model_service
     
+    # 初始化特征存储
+    feature_store = None
+    if settings.feature_store.enabled:
+        feature_store = FeatureStore(
+            settings.feature_store.path,
+            settings.faiss.feature_dim,
+            settings.feature_store.dtype
+        )
+        await feature_store.initialize()
+        app.state.feature_store = feature_store
+    
+    # 初始化特征向量缓存
+    if settings.embedding_cache.enabled:
+        cache_config = settings.embedding_cache
+        app.state.embedding_cache = EmbeddingCache(
+            max_entries=cache_config.max_entries,
+            ttl_seconds=cache_config.ttl_seconds,
+            disk_dir=cache_config.disk_dir if cache_config.disk_enabled else None,
+            disk_ttl_seconds=cache_config.disk_ttl_seconds,
+            namespace=model_service.fingerprint
+        )
+    
+    # 初始化搜索结果缓存
+    if settings.result_cache.enabled:
+        app.state.result_cache = SearchResultCache(
+            max_entries=settings.result_cache.max_entries,
+            ttl_seconds=settings.result_cache.ttl_seconds
+        )
+    
+    # 按URL搜索共用的下载连接池
+    fetch_config = settings.url_fetch
+    app.state.url_fetcher = UrlFetcher(
+        settings.storage.max_file_size,
+        allowed_extensions=settings.storage.allowed_extensions,
+        timeout_seconds=fetch_config.timeout_seconds,
+        total_timeout_seconds=fetch_config.total_timeout_seconds,
+        max_connections=fetch_config.max_connections,
+        max_per_host=fetch_config.max_per_host,
+        max_redirects=fetch_config.max_redirects,
+        cache_ttl_seconds=fetch_config.cache_ttl_seconds,
+        cache_max_entries=fetch_config.cache_max_entries
+    )
+    
     # 初始化Faiss服务
-    faiss_service = FaissService()
+    faiss_service = FaissService(feature_store=feature_store)
     await faiss_service.initialize()
     app.state.faiss_service = faiss_service
     
+    # 初始化后台建索引队列（同时恢复上次未完成的图片）
+    ingest_config = settings.ingest
+    indexing_queue = IndexingQueue(
+        model_service,
+        faiss_service,
+        feature_store=feature_store,
+        embedding_cache=getattr(app.state, 'embedding_cache', None),
+        workers=ingest_config.queue_workers,
+        batch_size=ingest_config.queue_batch_size,
+        batch_wait_ms=ingest_config.queue_batch_wait_ms,
+        max_pending=ingest_config.queue_max_pending,
+        max_retries=ingest_config.max_retries,
+        retry_delay_seconds=ingest_config.retry_delay_seconds,
+        sweep_interval_seconds=ingest_config.sweep_interval_seconds
+    )
+    await indexing_queue.start()
+    app.state.indexing_queue = indexing_queue
+    
+    # 初始化派生图片服务（缩略图和分析副本）
+    derivative_service = None
+    if settings.derivatives.enabled:
+        derivative_config = settings.derivatives
+        derivative_service = DerivativeService(
+            settings.storage.thumbnail_size,
+            analysis_size=derivative_config.analysis_size,
+            thumbnail_quality=derivative_config.thumbnail_quality,
+            analysis_quality=derivative_config.analysis_quality,
+            workers=derivative_config.workers,
+            backfill_batch_size=derivative_config.backfill_batch_size
+        )
+        if derivative_config.backfill_on_startup:
+            derivative_service.start_backfill()
+        app.state.derivative_service = derivative_service
+    
+    # 批量导入
+    app.state.bulk_ingestor = BulkIngestor(
+        model_service,
+        faiss_service,
+        feature_store,
+        ingest_config.checkpoint_dir,
+        ingest_config.ingest_root,
+        batch_size=ingest_config.bulk_batch_size,
+        read_threads=ingest_config.bulk_read_threads,
+        allowed_extensions=settings.storage.allowed_extensions,
+        max_file_size=settings.storage.max_file_size,
+        derivative_service=derivative_service
+    )
+    
+    # 初始化预计算近邻表
+    if settings.neighbor_table.enabled:
+        table_config = settings.neighbor_table
+        neighbor_table = NeighborTable(
+            faiss_service,
+            table_config.path,
+            k=table_config.k,
+            chunk_size=table_config.chunk_size,
+            workers=table_config.workers,
+            refresh_interval_seconds=table_config.refresh_interval_seconds,
+            full_rebuild_ratio=table_config.full_rebuild_ratio
+        )
+        await neighbor_table.initialize(build_if_missing=table_config.build_on_startup)
+        app.state.neighbor_table = neighbor_table
+    
     print("✅ 服务启动完成!")
     
     yield
     
     # 关闭时清理
     print("🛑 正在关闭服务...")
+    if hasattr(app.state, 'bulk_ingestor'):
+        await app.state.bulk_ingestor.cleanup()
+    if hasattr(app.state, 'indexing_queue'):
+        await app.state.indexing_queue.cleanup()
+    if hasattr(app.state, 'derivative_service'):
+        await app.state.derivative_service.cleanup()
+    if hasattr(app.state, 'url_fetcher'):
+        await app.state.url_fetcher.cleanup()
+    if hasattr(app.state, 'neighbor_table'):
+        await app.state.neighbor_table.cleanup()
     if hasattr(app.state, 'model_service'):
         await app.state.model_service.cleanup()
     if hasattr(app.state, 'faiss_service'):
         await app.state.faiss_service.cleanup()
+    if hasattr(app.state, 'feature_store'):
+        await app.state.feature_store.cleanup()
     print("✅ 服务已关闭")
 
 
@@ -79,10 +206,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 静态文件服务
+# 静态文件服务：只提供图片目录，索引、快照、模型和导入目录等数据不对外暴露
 import os
-static_dir = os.path.join(os.path.dirname(__file__), "data")
-app.mount("/static", StaticFiles(directory=static_dir), name="static")
+static_dir = os.path.join(os.path.dirname(__file__), "data", "images")
+os.makedirs(static_dir, exist_ok=True)
+static_config = settings.static_files
+app.mount("/static/images", CachedStaticFiles(
+    directory=static_dir,
+    immutable_max_age=static_config.immutable_max_age,
+    derived_max_age=static_config.derived_max_age,
+    default_max_age=static_config.default_max_age,
+    derived_dirs=(THUMBNAIL_DIR_NAME,),
+    denied_dirs=(ANALYSIS_DIR_NAME,),
+    precompressed=static_config.precompressed,
+    sendfile_header=static_config.sendfile_header,
+    accel_redirect_prefix=static_config.accel_redirect_prefix
+), name="static")
 
 # 注册API路由
 app.include_router(api_router, prefix="/api/v1")
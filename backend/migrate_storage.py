@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+图与图寻 - 图片存储迁移命令
+把旧版平铺存储（upload_dir/<uuid>.jpg）的图片移动到按哈希分层的内容寻址位置，并更新数据库记录
+
+迁移只重命名文件、修改 file_path 和 filename，图像ID和索引不变，可以重复执行，中断后再次运行即可继续。
+迁移期间访问旧URL会短暂返回404，建议在低峰期执行。
+
+用法:
+    python migrate_storage.py
+    python migrate_storage.py --dry-run
+"""
+
+import argparse
+import os
+
+from app.core.database import SessionLocal
+from app.models.image import Image
+from app.services.image_storage import content_filename, migrate_file, storage_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="迁移图片到内容寻址存储")
+    parser.add_argument("--batch-size", type=int, default=500, help="每批处理并提交的记录数")
+    parser.add_argument("--dry-run", action="store_true", help="只统计需要迁移的记录，不移动文件")
+    args = parser.parse_args()
+    
+    migrated = missing = failed = 0
+    last_id = 0
+    db = SessionLocal()
+    try:
+        while True:
+            # 内容寻址的文件名包含分层目录，旧文件名不含 /
+            rows = db.query(Image).filter(
+                Image.id > last_id,
+                ~Image.filename.contains("/")
+            ).order_by(Image.id).limit(args.batch_size).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            
+            for image in rows:
+                if args.dry_run:
+                    migrated += 1
+                    continue
+                try:
+                    if os.path.exists(image.file_path):
+                        file_path, filename, _ = migrate_file(image.file_path, image.hash_value, image.filename)
+                    else:
+                        # 上次运行在移动文件后、提交记录前中断
+                        filename = content_filename(image.hash_value, image.filename) if image.hash_value else None
+                        if filename is None or not os.path.exists(storage_path(filename)):
+                            print(f"⚠️  文件不存在，跳过: {image.id} {image.file_path}")
+                            missing += 1
+                            continue
+                        file_path = storage_path(filename)
+                except OSError as e:
+                    print(f"❌ 迁移失败: {image.id} {image.file_path}: {e}")
+                    failed += 1
+                    continue
+                
+                image.file_path = file_path
+                image.filename = filename
+                migrated += 1
+            
+            if not args.dry_run:
+                db.commit()
+            print(f"已处理到图像ID {last_id}: 迁移 {migrated}, 缺失 {missing}, 失败 {failed}")
+    finally:
+        db.close()
+    
+    action = "需要迁移" if args.dry_run else "已迁移"
+    print(f"✅ 完成: {action} {migrated} 张, 文件缺失 {missing} 张, 失败 {failed} 张")
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
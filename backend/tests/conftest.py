@@ -0,0 +1,9 @@
+"""
+测试公共配置
+"""
+
+import os
+import sys
+
+# 从任意目录运行 pytest 时都能导入 app 包
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
\ No newline at end of file
@@ -0,0 +1,160 @@
+"""
+批量导入测试：只能导入 ingest_root 内的文件，文件流式复制到临时文件后移动到存储位置
+"""
+
+import asyncio
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from PIL import Image as PILImage
+
+pytest.importorskip("torch")
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.core.database import Base
+from app.models.image import Image, INDEX_STATUS_INDEXED
+from app.models.user import User
+from app.services import bulk_ingest as bulk_module
+from app.services import image_storage
+from app.services.bulk_ingest import BulkIngestor
+
+
+@pytest.fixture
+def ingest_root(tmp_path):
+    root = tmp_path / "import"
+    (root / "photos").mkdir(parents=True)
+    (root / "photos" / "a.jpg").write_bytes(b"a")
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "secret.jpg").write_bytes(b"s")
+    return root
+
+
+@pytest.fixture
+def ingestor(tmp_path, ingest_root):
+    return BulkIngestor(None, None, None, str(tmp_path / "checkpoints"), str(ingest_root),
+                        allowed_extensions=["jpg"])
+
+
+def read_list(ingestor, job):
+    with open(ingestor._job_path(job["job_id"], "list"), encoding='utf-8') as f:
+        return f.read().splitlines()
+
+
+@pytest.mark.parametrize("name", ["outside", "import/../outside", "import-other"])
+def test_source_dir_outside_root_is_rejected(tmp_path, ingestor, name):
+    (tmp_path / "import-other").mkdir(exist_ok=True)
+    with pytest.raises(ValueError):
+        ingestor._create_job(str(tmp_path / name), None)
+
+
+def test_manifest_outside_root_is_rejected(tmp_path, ingestor):
+    manifest = tmp_path / "outside" / "list.txt"
+    manifest.write_text("secret.jpg\n", encoding='utf-8')
+    with pytest.raises(ValueError):
+        ingestor._create_job(None, str(manifest))
+
+
+def test_manifest_entries_outside_root_are_failed(tmp_path, ingestor, ingest_root):
+    manifest = ingest_root / "list.txt"
+    manifest.write_text("\n".join([
+        "photos/a.jpg",
+        "../outside/secret.jpg",
+        str(tmp_path / "outside" / "secret.jpg")
+    ]), encoding='utf-8')
+    
+    job = ingestor._create_job(None, str(manifest))
+    
+    assert read_list(ingestor, job) == [str(ingest_root / "photos" / "a.jpg")]
+    assert job["total"] == 1
+    assert job["failed"] == 2
+    with open(ingestor._job_path(job["job_id"], "failed"), encoding='utf-8') as f:
+        assert len(f.read().splitlines()) == 2
+
+
+def test_symlink_out_of_root_is_skipped(tmp_path, ingestor, ingest_root):
+    link = ingest_root / "photos" / "link.jpg"
+    try:
+        os.symlink(tmp_path / "outside" / "secret.jpg", link)
+    except (OSError, NotImplementedError):
+        pytest.skip("不支持符号链接")
+    
+    job = ingestor._create_job(str(ingest_root / "photos"), None)
+    
+    assert read_list(ingestor, job) == [str(ingest_root / "photos" / "a.jpg")]
+    assert ingestor._read_file(str(link)) == "不在导入根目录内"
+
+
+class FakeModelService:
+    def __init__(self):
+        self.inputs = []
+    
+    async def extract_batch_features_masked(self, image_inputs):
+        self.inputs.extend(image_inputs)
+        return np.ones((len(image_inputs), 4), dtype=np.float32), np.ones(len(image_inputs), dtype=bool)
+
+
+class FakeFaissService:
+    def __init__(self):
+        self.added = []
+    
+    async def add_vectors(self, vectors, image_ids):
+        self.added.extend(image_ids)
+        return image_ids
+
+
+def _jpeg(color) -> bytes:
+    buffer = io.BytesIO()
+    PILImage.new('RGB', (8, 8), color).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def test_batches_hold_temp_files_instead_of_contents(tmp_path, ingest_root, monkeypatch):
+    upload_dir = tmp_path / "uploads"
+    monkeypatch.setattr(image_storage.settings.storage, "upload_dir", str(upload_dir))
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine, tables=[User.__table__, Image.__table__])
+    monkeypatch.setattr(bulk_module, "SessionLocal", sessionmaker(bind=engine))
+    
+    red, blue = _jpeg((255, 0, 0)), _jpeg((0, 0, 255))
+    photos = ingest_root / "photos"
+    (photos / "red.jpg").write_bytes(red)
+    (photos / "red_copy.jpg").write_bytes(red)
+    (photos / "blue.jpg").write_bytes(blue)
+    (photos / "big.jpg").write_bytes(blue + b"\0" * 4096)
+    paths = [str(photos / name) for name in ("red.jpg", "red_copy.jpg", "blue.jpg", "big.jpg")]
+    
+    model_service, faiss_service = FakeModelService(), FakeFaissService()
+    ingestor = BulkIngestor(model_service, faiss_service, None, str(tmp_path / "checkpoints"),
+                            str(ingest_root), allowed_extensions=["jpg"], max_file_size=len(blue) + 1)
+    os.makedirs(ingestor.checkpoint_dir)
+    job = {"job_id": "job", "duplicates": 0, "ingested": 0, "failed": 0}
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        prepared = asyncio.run(ingestor._prepare(paths, executor))
+        assert prepared["duplicates"] == 1
+        assert prepared["failed"] == [(paths[3], "文件大小超过限制")]
+        assert all("content" not in item for item in prepared["items"])
+        assert len(os.listdir(upload_dir / image_storage.INCOMING_DIR_NAME)) == 2
+        
+        asyncio.run(ingestor._commit(prepared, job, executor))
+    finally:
+        executor.shutdown()
+    
+    assert job["ingested"] == 2 and sorted(faiss_service.added) == [1, 2]
+    assert os.listdir(upload_dir / image_storage.INCOMING_DIR_NAME) == []
+    db = sessionmaker(bind=engine)()
+    try:
+        for row in db.query(Image).all():
+            assert row.index_status == INDEX_STATUS_INDEXED
+            with open(row.file_path, 'rb') as f:
+                assert hashlib.md5(f.read()).hexdigest() == row.hash_value
+    finally:
+        db.close()
\ No newline at end of file
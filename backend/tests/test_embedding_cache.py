@@ -0,0 +1,57 @@
+"""
+特征向量缓存测试
+"""
+
+import asyncio
+import os
+
+import numpy as np
+
+from app.services.embedding_cache import EmbeddingCache
+
+KEY = "0123456789abcdef0123456789abcdef"
+
+
+def test_memory_lru_eviction():
+    cache = EmbeddingCache(max_entries=2)
+    
+    async def run():
+        for i in range(3):
+            await cache.put(f"{i:032x}", np.full(4, i))
+        return [await cache.get(f"{i:032x}") for i in range(3)]
+    
+    first, second, third = asyncio.run(run())
+    assert first is None
+    assert second.tolist() == [1, 1, 1, 1]
+    assert not third.flags.writeable
+    assert cache.get_stats()["evictions"] == 1
+
+
+def test_disk_tier_shared_within_namespace(tmp_path):
+    writer = EmbeddingCache(disk_dir=str(tmp_path), namespace="resnet50-eager-none")
+    asyncio.run(writer.put(KEY, np.arange(4)))
+    
+    # 另一个进程（新的缓存实例）在相同配置下命中磁盘层
+    reader = EmbeddingCache(disk_dir=str(tmp_path), namespace="resnet50-eager-none")
+    vector = asyncio.run(reader.get(KEY))
+    assert vector.tolist() == [0, 1, 2, 3]
+    assert reader.get_stats()["disk_hits"] == 1
+
+
+def test_disk_tier_isolated_by_model_fingerprint(tmp_path):
+    asyncio.run(EmbeddingCache(disk_dir=str(tmp_path), namespace="resnet50-eager-none").put(KEY, np.arange(4)))
+    
+    # 切换推理后端或量化方式后不能读到旧模型的向量
+    quantized = EmbeddingCache(disk_dir=str(tmp_path), namespace="resnet50-eager-static")
+    assert asyncio.run(quantized.get(KEY)) is None
+
+
+def test_expired_disk_entry_is_removed(tmp_path):
+    cache = EmbeddingCache(disk_dir=str(tmp_path), disk_ttl_seconds=60)
+    asyncio.run(cache.put(KEY, np.arange(4)))
+    path = cache._disk_path(KEY)
+    os.utime(path, (0, 0))
+    
+    cache.clear()
+    assert asyncio.run(cache.get(KEY)) is None
+    assert not os.path.exists(path)
\ No newline at end of file
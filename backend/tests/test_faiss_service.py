@@ -0,0 +1,356 @@
+"""
+Faiss服务测试：以图像ID作为Faiss ID的写入和删除、延迟落盘、IVF训练、乘积量化重排序、HNSW搜索参数、在线重建、快照保存、回滚和内存映射模式下的写入、以图搜图
+"""
+
+import asyncio
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.core.database import Base
+from app.models.faiss_index import FaissIndexInfo
+from app.models.image import Image, INDEX_STATUS_INDEXED, INDEX_STATUS_PENDING
+from app.models.user import User
+from app.services import faiss_service as faiss_module
+from app.services.faiss_service import FaissService, PQ_MIN_TRAIN_VECTORS
+from app.services.feature_store import FeatureStore
+from app.services.index_snapshot import SnapshotManager
+
+DIM = 8
+
+
+def _vectors(count: int, seed: int) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((count, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def session_factory(monkeypatch):
+    """用内存SQLite代替MySQL"""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine, tables=[User.__table__, Image.__table__, FaissIndexInfo.__table__])
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(faiss_module, "SessionLocal", factory)
+    return factory
+
+
+@pytest.fixture
+def service(tmp_path, session_factory):
+    """使用小维度平面索引的服务，快照写入临时目录"""
+    svc = FaissService()
+    svc.feature_dim = DIM
+    svc.index_type = "IndexFlatIP"
+    svc.index_path = str(tmp_path / "image_features.index")
+    svc.snapshots = SnapshotManager(str(tmp_path / "snapshots"))
+    svc.index = svc._create_index()
+    yield svc
+    for executor in (svc.search_executor, svc.mutation_executor, svc.persist_executor):
+        executor.shutdown(wait=False)
+
+
+def test_remove_image_deletes_vector_by_image_id(service):
+    vectors = _vectors(3, seed=1)
+    assert service._add_vectors_sync(vectors, [10, 20, 30]) == [10, 20, 30]
+    
+    assert asyncio.run(service.remove_image(20))
+    assert not asyncio.run(service.remove_image(20))
+    assert service.index.ntotal == 2
+    
+    # 被删除的向量不再出现在结果中，其余图像ID保持不变
+    _, image_ids = service._search_sync(vectors[1], 3)
+    assert sorted(image_ids) == [10, 30]
+
+
+def test_adding_existing_image_replaces_its_vector(service):
+    service._add_vectors_sync(_vectors(2, seed=1), [10, 20])
+    replacement = _vectors(1, seed=2)
+    service._add_vectors_sync(replacement, [10])
+    
+    assert service.index.ntotal == 2
+    scores, image_ids = service._search_sync(replacement[0], 1)
+    assert image_ids == [10]
+    assert scores[0] == pytest.approx(1.0, abs=1e-5)
+
+
+def test_changes_are_saved_after_threshold(service, monkeypatch):
+    monkeypatch.setattr(faiss_module.settings.faiss, "save_every_n_adds", 3)
+    
+    # 未达到阈值时只标记为脏数据，不写文件
+    asyncio.run(service.add_vectors(_vectors(2, seed=1), [1, 2]))
+    assert service.get_index_info()["dirty"]
+    assert service.get_index_info()["pending_changes"] == 2
+    assert service.snapshots.current_version() is None
+    
+    asyncio.run(service.remove_images([2]))
+    assert service.snapshots.current_version() is not None
+    assert not service.get_index_info()["dirty"]
+    assert service.get_index_info()["pending_changes"] == 0
+
+
+def test_flush_saves_pending_changes(service, monkeypatch):
+    monkeypatch.setattr(faiss_module.settings.faiss, "save_every_n_adds", 100)
+    asyncio.run(service.add_vectors(_vectors(3, seed=1), [1, 2, 3]))
+    asyncio.run(service.flush())
+    
+    assert not service.get_index_info()["dirty"]
+    manifest = service.snapshots.load_manifest(service.snapshots.current_version())
+    assert manifest["total_vectors"] == 3
+
+
+def test_ivf_trains_once_corpus_is_large_enough(service, monkeypatch):
+    monkeypatch.setattr(faiss_module.settings.faiss, "ivf_min_train_vectors", 200)
+    monkeypatch.setattr(faiss_module.settings.faiss, "nprobe", 1)
+    service.index_type = "IndexIVFFlat"
+    vectors = _vectors(400, seed=1)
+    
+    # 语料不足时保持暴力搜索
+    service._add_vectors_sync(vectors[:100], list(range(1, 101)))
+    assert not service._train_index_sync()
+    assert not service._is_ivf(service.index)
+    
+    service._add_vectors_sync(vectors[100:], list(range(101, 401)))
+    assert service._train_index_sync()
+    ivf = faiss_module.faiss.extract_index_ivf(service.index)
+    assert ivf.nlist == 400 // 39
+    assert service.index.ntotal == 400
+    
+    # nprobe 按请求传入，超过 nlist 时截断，不修改共享索引
+    assert service._search_params(service.index, 1).nprobe == 1
+    assert service._search_params(service.index, 1, 1000).nprobe == ivf.nlist
+    assert ivf.nprobe == 1
+    _, image_ids = service._search_sync(vectors[250], 1, nprobe=ivf.nlist)
+    assert image_ids == [251]
+
+
+def test_pq_candidates_are_reranked_with_full_precision_vectors(service, tmp_path, monkeypatch):
+    monkeypatch.setattr(faiss_module.settings.faiss, "pq_bytes_per_vector", 3)
+    monkeypatch.setattr(faiss_module.settings.faiss, "rerank_factor", 20)
+    service.index_type = "IndexIVFPQ"
+    service.feature_store = FeatureStore(str(tmp_path / "features"), DIM)
+    service.feature_store.open()
+    
+    # 预算3字节时取能整除维度的最大子量化器个数
+    assert service._choose_pq_m() == 2
+    vectors = _vectors(PQ_MIN_TRAIN_VECTORS, seed=1)
+    image_ids = list(range(1, PQ_MIN_TRAIN_VECTORS + 1))
+    service.feature_store.append(image_ids, vectors)
+    service._add_vectors_sync(vectors, image_ids)
+    assert service._train_index_sync()
+    
+    # 压缩编码只有2字节，重排序后的得分是全精度内积
+    nlist = faiss_module.faiss.extract_index_ivf(service.index).nlist
+    scores, image_ids = service._search_sync(vectors[41], 3, nprobe=nlist)
+    assert image_ids[0] == 42
+    assert scores[0] == pytest.approx(1.0, abs=1e-5)
+    np.testing.assert_allclose(scores, vectors[np.asarray(image_ids) - 1] @ vectors[41], atol=1e-5)
+
+
+def test_hnsw_ef_search_per_request_and_deleted_nodes_excluded(service, monkeypatch):
+    monkeypatch.setattr(faiss_module.settings.faiss, "hnsw_ef_search", 16)
+    service.index_type = "IndexHNSWFlat"
+    service.index = service._create_index()
+    vectors = _vectors(50, seed=1)
+    service._add_vectors_sync(vectors, list(range(1, 51)))
+    
+    # efSearch 默认取配置，可按请求覆盖，且不小于k
+    assert service._search_params(service.index, 5).efSearch == 16
+    assert service._search_params(service.index, 5, ef_search=100).efSearch == 100
+    assert service._search_params(service.index, 5, ef_search=2).efSearch == 5
+    
+    # HNSW不能删除节点，删除的ID由选择器排除，返回数量不受影响
+    assert service._remove_vectors_sync([3]) == 1
+    _, image_ids = service._search_sync(vectors[2], 5, ef_search=64)
+    assert 3 not in image_ids
+    assert len(image_ids) == 5
+    assert service.get_index_info()["deleted_vectors"] == 1
+
+
+def _add_images(session_factory, image_ids, active=True):
+    db = session_factory()
+    for image_id in image_ids:
+        db.add(Image(
+            id=image_id, filename=f"{image_id}.jpg", original_name=f"{image_id}.jpg",
+            file_path=f"/missing/{image_id}.jpg", file_size=1, is_active=active
+        ))
+    db.commit()
+    db.close()
+
+
+def _rebuild(svc: FaissService, index_type: str) -> dict:
+    async def run():
+        await svc.start_rebuild(index_type)
+        await svc._rebuild_task
+        return svc.get_rebuild_status()
+    return asyncio.run(run())
+
+
+def test_online_rebuild_applies_changes_made_during_build(service, session_factory, tmp_path, monkeypatch):
+    _add_images(session_factory, range(1, 7))
+    _add_images(session_factory, [7], active=False)
+    vectors = _vectors(8, seed=1)
+    service.feature_store = FeatureStore(str(tmp_path / "features"), DIM)
+    service.feature_store.open()
+    service.feature_store.append(list(range(1, 7)), vectors[:6])
+    service._add_vectors_sync(vectors[:7], list(range(1, 8)))
+    
+    build = service._iter_rebuild_vectors
+    
+    def build_with_concurrent_writes(image_ids, batch_size=65536):
+        yield from build(image_ids, batch_size)
+        # 构建影子索引期间旧索引继续接受写入
+        service._add_vectors_sync(vectors[7:], [8])
+        service._remove_vectors_sync([2])
+    
+    monkeypatch.setattr(service, "_iter_rebuild_vectors", build_with_concurrent_writes)
+    epoch = service._index_epoch
+    status = _rebuild(service, "IndexHNSWFlat")
+    assert status["status"] == "completed"
+    assert status["processed"] == 6
+    
+    # 停用的图像不进入新索引，构建期间的增删在替换时补齐
+    assert service.index_type == "IndexHNSWFlat"
+    assert service._get_hnsw(service.index) is not None
+    assert service._index_epoch == epoch + 1
+    assert sorted(service.id_mapping.faiss_ids.tolist()) == [1, 3, 4, 5, 6, 8]
+    _, image_ids = service._search_sync(vectors[1], 6)
+    assert sorted(image_ids) == [1, 3, 4, 5, 6, 8]
+    
+    db = session_factory()
+    try:
+        current = db.query(FaissIndexInfo).filter(FaissIndexInfo.is_current == True).one()
+        assert current.id == status["version_id"]
+        assert current.index_type == "IndexHNSWFlat"
+    finally:
+        db.close()
+
+
+def test_training_result_is_dropped_when_index_is_swapped(service, session_factory, monkeypatch):
+    monkeypatch.setattr(faiss_module.settings.faiss, "ivf_min_train_vectors", 200)
+    service.index_type = "IndexIVFFlat"
+    _add_images(session_factory, range(1, 201))
+    service._add_vectors_sync(_vectors(200, seed=1), list(range(1, 201)))
+    create_ivf_index = service._create_ivf_index
+    
+    def rebuild_while_training(nlist, index_type=None):
+        # 聚类训练在写锁外进行，此时在线重建替换了索引
+        _rebuild(service, "IndexFlatIP")
+        return create_ivf_index(nlist, index_type)
+    
+    monkeypatch.setattr(service, "_create_ivf_index", rebuild_while_training)
+    rebuilt = service.index
+    assert not service._train_index_sync()
+    assert service.index is not rebuilt
+    assert not service._is_ivf(service.index)
+    assert service.index.ntotal == 200
+
+
+@pytest.mark.parametrize("index_type", ["IndexFlatIP", "IndexHNSWFlat"])
+def test_search_by_image_id_reuses_vector_and_excludes_query(service, index_type):
+    service.index_type = index_type
+    service.index = service._create_index()
+    vectors = _vectors(20, seed=1)
+    service._add_vectors_sync(vectors, list(range(1, 21)))
+    service._remove_vectors_sync([5])
+    
+    np.testing.assert_allclose(asyncio.run(service.get_vector(3)), vectors[2], atol=1e-5)
+    assert asyncio.run(service.get_vector(5)) is None
+    
+    # 查询图片本身在Faiss内部被排除，仍返回k个结果
+    _, image_ids = service._search_sync(vectors[2], 5, exclude_image_ids=[3])
+    assert 3 not in image_ids and 5 not in image_ids
+    assert len(image_ids) == 5
+
+
+@pytest.fixture
+def mmap_service(service):
+    """内存映射模式的服务"""
+    service.load_mode = "mmap"
+    return service
+
+
+def _snapshot(svc: FaissService, image_ids, seed: int) -> str:
+    svc._add_vectors_sync(_vectors(len(image_ids), seed), list(image_ids))
+    svc._save_index_sync()
+    return svc._snapshot_version
+
+
+def test_rollback_then_add_in_mmap_mode(mmap_service):
+    service = mmap_service
+    first = _snapshot(service, range(1, 11), seed=1)
+    _snapshot(service, range(11, 21), seed=2)
+    
+    result = service._rollback_sync(first)
+    assert result["total_vectors"] == 10
+    assert service.get_index_info()["mmapped"]
+    
+    # 首次写入前必须从只读映射复制到内存，否则Faiss断言失败终止进程
+    service._add_vectors_sync(_vectors(5, seed=3), list(range(100, 105)))
+    assert not service.get_index_info()["mmapped"]
+    assert service.index.ntotal == 15
+    assert service.id_mapping.contains([1, 100, 104]).all()
+
+
+def test_failed_rollback_keeps_mmap_marker(mmap_service):
+    service = mmap_service
+    first = _snapshot(service, range(1, 11), seed=1)
+    second = _snapshot(service, range(11, 21), seed=2)
+    service._rollback_sync(second)
+    mmapped_index = service.index
+    
+    # 清单记录的数量与文件不符：读取成功但校验失败，回滚被拒绝
+    manifest_path = f"{service.snapshots.path(first)}/manifest.json"
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = f.read()
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        f.write(manifest.replace('"total_vectors": 10', '"total_vectors": 11'))
+    with pytest.raises(ValueError):
+        service._rollback_sync(first)
+    
+    assert service.index is mmapped_index
+    assert service._mmap_index is mmapped_index
+    service._add_vectors_sync(_vectors(1, seed=4), [200])
+    assert service.index.ntotal == 21
+
+
+def test_pruned_snapshots_are_removed_from_version_table(service, session_factory, monkeypatch):
+    monkeypatch.setattr(faiss_module.settings.faiss, "snapshot_keep", 2)
+    for batch in range(5):
+        _snapshot(service, range(batch * 10 + 1, batch * 10 + 11), seed=batch)
+    
+    db = session_factory()
+    try:
+        rows = db.query(FaissIndexInfo).order_by(FaissIndexInfo.id).all()
+        assert [row.index_path for row in rows] == [
+            service.snapshots.path(version) for version in service.snapshots.list_versions()
+        ]
+        assert [row.is_current for row in rows] == [False, True]
+    finally:
+        db.close()
+
+
+def test_rollback_resets_rows_missing_from_snapshot_and_removes_inactive(service, session_factory):
+    _add_images(session_factory, range(1, 5))
+    first = _snapshot(service, range(1, 4), seed=1)
+    _snapshot(service, [4], seed=2)
+    db = session_factory()
+    db.query(Image).update({Image.index_status: INDEX_STATUS_INDEXED, Image.faiss_id: Image.id})
+    db.query(Image).filter(Image.id == 2).update({Image.is_active: False})
+    db.commit()
+    db.close()
+    service._remove_vectors_sync([2])
+    
+    result = asyncio.run(service.rollback(first))
+    
+    # 快照之后入库的图片交给建索引队列补做，快照之后停用的图片再次移除
+    assert result["reset_to_pending"] == 1 and result["removed_inactive"] == 1
+    assert service.id_mapping.contains([1, 2, 3, 4]).tolist() == [True, False, True, False]
+    db = session_factory()
+    try:
+        rows = {row.id: row for row in db.query(Image).all()}
+        assert (rows[4].index_status, rows[4].faiss_id) == (INDEX_STATUS_PENDING, None)
+        assert rows[1].index_status == INDEX_STATUS_INDEXED
+    finally:
+        db.close()
\ No newline at end of file
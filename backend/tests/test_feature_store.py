@@ -0,0 +1,64 @@
+"""
+特征存储测试
+"""
+
+import numpy as np
+import pytest
+
+from app.services.feature_store import FeatureStore
+
+DIM = 4
+
+
+def _open(tmp_path, dtype="float32") -> FeatureStore:
+    store = FeatureStore(str(tmp_path / "features"), DIM, dtype)
+    store.open()
+    return store
+
+
+def test_append_get_and_overwrite(tmp_path):
+    store = _open(tmp_path)
+    store.append([1, 2], np.arange(8).reshape(2, DIM))
+    store.append([1], np.full((1, DIM), 9))
+    
+    vectors, found = store.get([1, 2, 3])
+    assert found.tolist() == [True, True, False]
+    assert vectors[0].tolist() == [9, 9, 9, 9]
+    assert vectors[1].tolist() == [4, 5, 6, 7]
+    assert len(store) == 2
+    assert store.get_stats()["total_rows"] == 3
+
+
+def test_reopen_truncates_partial_row(tmp_path):
+    store = _open(tmp_path)
+    store.append([1, 2], np.ones((2, DIM)))
+    # 模拟崩溃：向量文件多写了半行
+    with open(store.vec_path, "ab") as f:
+        f.write(b"\0" * 6)
+    
+    reopened = _open(tmp_path)
+    assert len(reopened) == 2
+    reopened.append([3], np.full((1, DIM), 3))
+    vectors, found = reopened.get([3])
+    assert found[0] and vectors[0].tolist() == [3, 3, 3, 3]
+
+
+def test_iter_batches_skips_missing_ids(tmp_path):
+    store = _open(tmp_path)
+    store.append([5, 1, 3], np.arange(12).reshape(3, DIM))
+    
+    batches = list(store.iter_batches([1, 3, 7], batch_size=1))
+    assert [ids.tolist() for ids, _ in batches] == [[1], [3]]
+    assert batches[0][1][0].tolist() == [4, 5, 6, 7]
+    
+    all_ids = np.concatenate([ids for ids, _ in store.iter_batches()])
+    assert sorted(all_ids.tolist()) == [1, 3, 5]
+
+
+def test_dtype_from_existing_meta_wins(tmp_path):
+    _open(tmp_path, "float16").append([1], np.ones((1, DIM)))
+    store = _open(tmp_path, "float32")
+    assert store.dtype == np.float16
+    
+    with pytest.raises(ValueError):
+        FeatureStore(str(tmp_path / "features"), DIM + 1).open()
\ No newline at end of file
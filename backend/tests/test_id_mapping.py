@@ -0,0 +1,94 @@
+"""
+ID映射测试：与字典实现逐步对照，覆盖增量合并、覆盖写入、删除和内存映射加载
+"""
+
+import numpy as np
+import pytest
+
+from app.services import id_mapping as id_mapping_module
+from app.services.id_mapping import IdMapping
+
+
+def _check(mapping: IdMapping, expected: dict):
+    keys = np.array(sorted(expected), dtype=np.int64)
+    assert len(mapping) == len(expected)
+    assert mapping.faiss_ids.tolist() == keys.tolist()
+    assert mapping.image_ids.tolist() == [expected[key] for key in keys.tolist()]
+    
+    probe = np.arange(-1, 260, dtype=np.int64)
+    image_ids, found = mapping.translate(probe)
+    assert found.tolist() == [int(key) in expected for key in probe]
+    assert image_ids[found].tolist() == [expected[int(key)] for key in probe[found]]
+
+
+@pytest.mark.parametrize("merge_rows", [1, 8, 1024])
+def test_random_operations_match_dict(monkeypatch, merge_rows):
+    # 阈值很小时每隔几次写入就合并一次，较大时全部留在增量中
+    monkeypatch.setattr(id_mapping_module, "MIN_MERGE_ROWS", merge_rows)
+    rng = np.random.default_rng(merge_rows)
+    mapping = IdMapping.from_pairs(range(0, 200, 2), range(1000, 1100))
+    expected = {faiss_id: image_id for faiss_id, image_id in zip(range(0, 200, 2), range(1000, 1100))}
+    
+    for step in range(300):
+        ids = rng.integers(0, 256, rng.integers(1, 6)).tolist()
+        if rng.random() < 0.6:
+            values = rng.integers(0, 10 ** 6, len(ids)).tolist()
+            mapping.add(ids, values)
+            expected.update(zip(ids, values))
+        else:
+            removed = mapping.remove(ids)
+            assert sorted(removed.tolist()) == sorted({i for i in ids if i in expected})
+            for faiss_id in ids:
+                expected.pop(faiss_id, None)
+        if step % 25 == 0:
+            _check(mapping, expected)
+    _check(mapping, expected)
+
+
+def test_single_adds_do_not_copy_base():
+    mapping = IdMapping.from_pairs(range(0, 200000, 2), range(0, 200000, 2))
+    base = mapping._state[0]
+    for image_id in range(1, 201, 2):
+        mapping.add([image_id], [image_id])
+    
+    # 少量写入只进入增量，主数组保持不变
+    assert mapping._state[0] is base
+    assert len(mapping) == 100100
+    assert mapping.contains([1, 199, 201, 199998]).tolist() == [True, True, False, True]
+
+
+def test_duplicate_ids_in_batch_keep_last():
+    mapping = IdMapping.from_pairs([5, 3, 5], [1, 2, 3])
+    assert mapping.pairs().tolist() == [[3, 2], [5, 3]]
+    mapping.add([3, 3], [7, 8])
+    assert mapping.translate([3])[0].tolist() == [8]
+
+
+def test_pairs_snapshot_is_stable():
+    mapping = IdMapping.from_pairs([1, 2], [10, 20])
+    snapshot = mapping.pairs()
+    mapping.add([3], [30])
+    mapping.remove([1])
+    assert snapshot.tolist() == [[1, 10], [2, 20]]
+    assert mapping.pairs().tolist() == [[2, 20], [3, 30]]
+
+
+def test_lookup_faiss_ids():
+    mapping = IdMapping.from_pairs([1, 2, 3], [30, 10, 20])
+    mapping.add([4], [40])
+    assert sorted(mapping.lookup_faiss_ids([10, 40, 99]).tolist()) == [2, 4]
+
+
+def test_save_and_mmap_load(tmp_path):
+    path = str(tmp_path / "mapping.npy")
+    mapping = IdMapping.from_pairs([1, 2, 3], [10, 20, 30])
+    mapping.add([4], [40])
+    mapping.remove([2])
+    mapping.save(path)
+    
+    loaded = IdMapping.load(path, mmap=True)
+    assert loaded.pairs().tolist() == [[1, 10], [3, 30], [4, 40]]
+    # 内存映射的主数组是只读的，变更只产生新数组
+    loaded.add([2], [21])
+    loaded.remove([1])
+    assert loaded.pairs().tolist() == [[2, 21], [3, 30], [4, 40]]
\ No newline at end of file
@@ -0,0 +1,62 @@
+"""
+图像解码测试：解码进程池通过共享内存返回与进程内解码相同的像素
+"""
+
+import asyncio
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.services.image_decode import DecodePool, decode_image, MODEL_INPUT_SIZE
+
+
+def _jpeg(width: int, height: int, color) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def test_decode_image_resizes_every_input_type(tmp_path):
+    content = _jpeg(640, 480, (200, 10, 10))
+    path = tmp_path / "a.jpg"
+    path.write_bytes(content)
+    
+    for image_input in (content, str(path), Image.open(io.BytesIO(content))):
+        pixels = decode_image(image_input)
+        assert pixels.shape == (MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, 3)
+        assert pixels.dtype == np.uint8
+    with pytest.raises(ValueError):
+        decode_image(123)
+
+
+def test_pool_decodes_into_shared_slots_and_releases_them():
+    images = [_jpeg(320, 240, (i * 40, 100, 200)) for i in range(4)]
+    pool = DecodePool(workers=2, slots=2)
+    
+    async def main():
+        pool.start()
+        
+        async def decode(content):
+            slot, pixels = await pool.decode(content)
+            try:
+                return pixels.copy()
+            finally:
+                pool.release(slot)
+        
+        results = await asyncio.gather(*[decode(content) for content in images])
+        # 解码失败时槽位同样归还
+        with pytest.raises(Exception):
+            await pool.decode(b"not an image")
+        return results, pool.get_stats()
+    
+    try:
+        results, stats = asyncio.run(main())
+    finally:
+        pool.shutdown()
+    
+    # 槽位数少于请求数时排队复用，结果与进程内解码一致
+    for content, pixels in zip(images, results):
+        np.testing.assert_array_equal(pixels, decode_image(content))
+    assert stats["free_slots"] == 2
\ No newline at end of file
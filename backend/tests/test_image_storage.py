@@ -0,0 +1,92 @@
+"""
+图片存储测试：流式写入临时文件、超限中止、内容寻址分层存储、派生图片生成
+"""
+
+import hashlib
+import io
+import os
+
+import pytest
+from PIL import Image as PILImage
+
+from app.services import image_storage
+from app.services.image_storage import (
+    FileTooLargeError, analysis_filename, commit_temp_file, content_filename, generate_derivatives,
+    migrate_file, save_uploaded_file, storage_path, stream_to_temp_file, thumbnail_filename
+)
+
+
+@pytest.fixture
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_storage.settings.storage, "upload_dir", str(tmp_path / "uploads"))
+    return tmp_path / "uploads"
+
+
+def test_stream_to_temp_file_hashes_while_writing(upload_dir):
+    content = os.urandom(10_000)
+    temp_path, size, file_hash = stream_to_temp_file(io.BytesIO(content), max_size=10_000, chunk_size=4096)
+    
+    assert size == len(content)
+    assert file_hash == hashlib.md5(content).hexdigest()
+    
+    file_path, unique_filename = commit_temp_file(temp_path, file_hash, "photo.JPG")
+    assert unique_filename.endswith(".jpg")
+    assert not os.path.exists(temp_path)
+    with open(file_path, 'rb') as f:
+        assert f.read() == content
+
+
+def test_oversized_upload_is_rejected_and_removed(upload_dir):
+    with pytest.raises(FileTooLargeError):
+        stream_to_temp_file(io.BytesIO(b"x" * 5000), max_size=4096, chunk_size=1024)
+    
+    assert os.listdir(upload_dir / image_storage.INCOMING_DIR_NAME) == []
+
+
+def test_content_filename_is_sharded_by_hash(upload_dir, monkeypatch):
+    file_hash = "abcdef0123456789"
+    monkeypatch.setattr(image_storage.settings.storage, "shard_levels", 2)
+    assert content_filename(file_hash, "a.PNG") == "ab/cd/abcdef0123456789.png"
+    assert storage_path("ab/cd/x.png") == str(upload_dir / "ab" / "cd" / "x.png")
+    
+    monkeypatch.setattr(image_storage.settings.storage, "shard_levels", 0)
+    assert content_filename(file_hash, "a.png") == "abcdef0123456789.png"
+
+
+def test_identical_content_is_stored_once(upload_dir):
+    first_path, first_name = save_uploaded_file(b"same", "a.jpg")
+    second_path, second_name = save_uploaded_file(b"same", "b.jpg")
+    
+    assert (first_path, first_name) == (second_path, second_name)
+    assert first_name.startswith(hashlib.md5(b"same").hexdigest()[:2] + "/")
+    assert os.listdir(upload_dir / image_storage.INCOMING_DIR_NAME) == []
+
+
+def test_migrate_file_moves_flat_file_into_shards(upload_dir):
+    upload_dir.mkdir()
+    old_path = upload_dir / "legacy.jpg"
+    old_path.write_bytes(b"legacy")
+    
+    new_path, stored_filename, file_hash = migrate_file(str(old_path), None, "legacy.jpg")
+    
+    assert file_hash == hashlib.md5(b"legacy").hexdigest()
+    assert stored_filename == content_filename(file_hash, "legacy.jpg")
+    assert not old_path.exists()
+    with open(new_path, 'rb') as f:
+        assert f.read() == b"legacy"
+
+
+def test_generate_derivatives_writes_thumbnail_and_analysis_copy(upload_dir):
+    buffer = io.BytesIO()
+    PILImage.new('RGB', (800, 400), (200, 10, 10)).save(buffer, format='JPEG')
+    file_path, stored_filename = save_uploaded_file(buffer.getvalue(), "a.jpg")
+    
+    assert generate_derivatives(file_path, stored_filename, (100, 100), analysis_size=200)
+    with PILImage.open(storage_path(thumbnail_filename(stored_filename))) as thumb:
+        assert thumb.format == 'WEBP' and thumb.size == (100, 50)
+    with PILImage.open(storage_path(analysis_filename(stored_filename))) as analysis:
+        # 保持宽高比，短边缩放到 analysis_size
+        assert analysis.size == (400, 200)
+    
+    # 已存在的派生文件不重复生成
+    assert not generate_derivatives(file_path, stored_filename, (100, 100), analysis_size=200)
\ No newline at end of file
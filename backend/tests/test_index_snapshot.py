@@ -0,0 +1,63 @@
+"""
+索引快照管理测试
+"""
+
+import os
+
+from app.services.index_snapshot import SnapshotManager
+
+
+def _write(content: bytes):
+    def write_files(snapshot_dir: str):
+        with open(os.path.join(snapshot_dir, "index.faiss"), "wb") as f:
+            f.write(content)
+    return write_files
+
+
+def test_create_promote_and_verify(tmp_path):
+    snapshots = SnapshotManager(str(tmp_path))
+    first = snapshots.create(_write(b"one"), {"total_vectors": 1})
+    second = snapshots.create(_write(b"two"), {"total_vectors": 2})
+    snapshots.promote(first)
+    
+    assert snapshots.list_versions() == [first, second] == ["v000001", "v000002"]
+    assert snapshots.current_version() == first
+    assert snapshots.load_manifest(second)["total_vectors"] == 2
+    assert snapshots.verify(first)
+    # CURRENT 优先，其次更早的版本，最后是被放弃的新版本
+    assert snapshots.load_candidates() == [first, second]
+
+
+def test_verify_detects_corruption(tmp_path):
+    snapshots = SnapshotManager(str(tmp_path))
+    version = snapshots.create(_write(b"abc"), {})
+    with open(os.path.join(snapshots.path(version), "index.faiss"), "wb") as f:
+        f.write(b"abd")
+    
+    assert snapshots.verify(version, check_checksums=False)
+    assert not snapshots.verify(version, check_checksums=True)
+
+
+def test_failed_write_leaves_no_version(tmp_path):
+    snapshots = SnapshotManager(str(tmp_path))
+    
+    def broken(snapshot_dir: str):
+        _write(b"partial")(snapshot_dir)
+        raise OSError("disk full")
+    
+    try:
+        snapshots.create(broken, {})
+    except OSError:
+        pass
+    assert snapshots.list_versions() == []
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_prune_keeps_recent_and_current(tmp_path):
+    snapshots = SnapshotManager(str(tmp_path))
+    versions = [snapshots.create(_write(b"x"), {}) for _ in range(5)]
+    snapshots.promote(versions[0])
+    
+    removed = snapshots.prune(2)
+    assert removed == versions[1:3]
+    assert snapshots.list_versions() == [versions[0]] + versions[3:]
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""
+后台建索引队列测试：处理期间被删除的图片不能留在索引中，特征始终从原图提取
+"""
+
+import asyncio
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.core.database import Base
+from app.models.image import Image, INDEX_STATUS_INDEXED, INDEX_STATUS_PENDING
+from app.models.user import User
+from app.services import indexing_queue as queue_module
+from app.services import image_storage
+from app.services.indexing_queue import IndexingQueue
+
+
+class FakeModelService:
+    def __init__(self):
+        self.inputs = []
+    
+    async def extract_batch_features_masked(self, image_inputs):
+        self.inputs.extend(image_inputs)
+        return np.ones((len(image_inputs), 4), dtype=np.float32), np.ones(len(image_inputs), dtype=bool)
+
+
+class FakeFaissService:
+    """写入向量时模拟另一个请求删除了图片"""
+    
+    def __init__(self, session_factory, deleted_id: int):
+        self.session_factory = session_factory
+        self.deleted_id = deleted_id
+        self.added = []
+        self.removed = []
+    
+    async def add_vectors(self, vectors, image_ids):
+        self.added.extend(image_ids)
+        db = self.session_factory()
+        try:
+            db.query(Image).filter(Image.id == self.deleted_id).update({Image.is_active: False})
+            db.commit()
+        finally:
+            db.close()
+        return image_ids
+    
+    async def remove_images(self, image_ids):
+        self.removed.extend(image_ids)
+        return len(image_ids)
+
+
+@pytest.fixture
+def session_factory(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine, tables=[User.__table__, Image.__table__])
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(queue_module, "SessionLocal", factory)
+    
+    db = factory()
+    for image_id in (1, 2):
+        db.add(Image(
+            id=image_id, filename=f"{image_id}.jpg", original_name=f"{image_id}.jpg",
+            file_path=f"/missing/{image_id}.jpg", file_size=1, index_status=INDEX_STATUS_PENDING
+        ))
+    db.commit()
+    db.close()
+    return factory
+
+
+def test_image_deleted_while_indexing_is_removed_from_index(session_factory):
+    faiss_service = FakeFaissService(session_factory, deleted_id=2)
+    queue = IndexingQueue(FakeModelService(), faiss_service)
+    
+    asyncio.run(queue._process([1, 2]))
+    
+    assert faiss_service.added == [1, 2]
+    assert faiss_service.removed == [2]
+    db = session_factory()
+    try:
+        statuses = {row.id: row.index_status for row in db.query(Image).all()}
+    finally:
+        db.close()
+    assert statuses[1] == INDEX_STATUS_INDEXED
+    assert statuses[2] != INDEX_STATUS_INDEXED
+    assert queue.get_stats()["indexed"] == 1
+
+
+def test_features_are_extracted_from_original_even_with_analysis_copy(session_factory, tmp_path, monkeypatch):
+    monkeypatch.setattr(image_storage.settings.storage, "upload_dir", str(tmp_path))
+    analysis_path = image_storage.storage_path(image_storage.analysis_filename("1.jpg"))
+    os.makedirs(os.path.dirname(analysis_path))
+    open(analysis_path, 'wb').close()
+    model_service = FakeModelService()
+    queue = IndexingQueue(model_service, FakeFaissService(session_factory, deleted_id=None))
+    
+    asyncio.run(queue._process([1, 2]))
+    
+    assert model_service.inputs == ["/missing/1.jpg", "/missing/2.jpg"]
\ No newline at end of file
@@ -0,0 +1,167 @@
+"""
+模型服务测试：并发请求合并为一次前向推理、推理后端选择与偏差回退、ONNX导出复用
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from app.services import inference_backends as backends_module
+from app.services import model_service as model_module
+from app.services.inference_backends import InferenceBackendBuilder
+from app.services.model_service import ModelService
+
+
+@pytest.fixture
+def service(monkeypatch):
+    """用记录批次的假推理代替真实模型"""
+    monkeypatch.setattr(model_module.settings.model, "dynamic_batching", True)
+    monkeypatch.setattr(model_module.settings.model, "batch_size", 4)
+    monkeypatch.setattr(model_module.settings.model, "batch_wait_ms", 50)
+    svc = ModelService()
+    svc.forward_batches = []
+    
+    def forward(images):
+        svc.forward_batches.append(len(images))
+        return np.array([[float(image[0]), 1.0] for image in images], dtype=np.float32)
+    
+    monkeypatch.setattr(svc, "_preprocess", lambda image_input: np.array([image_input[0]], dtype=np.uint8))
+    monkeypatch.setattr(svc, "_forward", forward)
+    yield svc
+    svc.executor.shutdown(wait=False)
+    svc.inference_executor.shutdown(wait=False)
+
+
+def test_concurrent_requests_share_one_forward_pass(service):
+    async def main():
+        return await asyncio.gather(*[service.extract_features(bytes([i])) for i in range(6)])
+    
+    features = asyncio.run(main())
+    
+    # 每个请求拿到自己那一行，满批立即推理，剩余请求等待后成批
+    assert [row[0] for row in features] == [0, 1, 2, 3, 4, 5]
+    assert service.forward_batches == [4, 2]
+    assert service.get_stats()["batching"]["total_batches"] == 2
+
+
+def test_dynamic_batching_can_be_disabled(service, monkeypatch):
+    monkeypatch.setattr(model_module.settings.model, "dynamic_batching", False)
+    
+    async def main():
+        return await asyncio.gather(*[service.extract_features(bytes([i])) for i in range(3)])
+    
+    asyncio.run(main())
+    assert service.forward_batches == [1, 1, 1]
+
+
+class FakeBuilder:
+    """记录构建请求的推理后端构建器，候选后端的输出由 candidate 决定"""
+    
+    def __init__(self, candidate):
+        self.candidate = candidate
+        self.built = []
+    
+    def baseline(self, batch):
+        return np.tile([1.0, 0.0, 1.0, 0.0], (len(batch), 1))
+    
+    def build(self, backend, quantization="none", *args):
+        self.built.append((backend, quantization))
+        return self.baseline if (backend, quantization) == ("eager", "none") else self.candidate
+    
+    def build_baseline(self):
+        return self.baseline
+
+
+@pytest.fixture
+def backend_config(monkeypatch):
+    config = model_module.settings.model
+    monkeypatch.setattr(config, "backend", "torchscript")
+    monkeypatch.setattr(config, "quantization", "static")
+    monkeypatch.setattr(config, "drift_check", True)
+    monkeypatch.setattr(config, "drift_check_dir", "")
+    monkeypatch.setattr(config, "drift_check_samples", 2)
+    monkeypatch.setattr(config, "max_cosine_drift", 0.02)
+    return config
+
+
+def _load(service, monkeypatch, candidate) -> FakeBuilder:
+    builder = FakeBuilder(candidate)
+    monkeypatch.setattr(model_module, "InferenceBackendBuilder", lambda *args: builder)
+    monkeypatch.setattr(service, "_to_input", lambda batch: batch)
+    service._load_model()
+    return builder
+
+
+def test_selected_backend_is_kept_within_drift_budget(service, backend_config, monkeypatch):
+    def candidate(batch):
+        return np.tile([1.0, 0.01, 1.0, 0.0], (len(batch), 1))
+    
+    builder = _load(service, monkeypatch, candidate)
+    
+    assert builder.built == [("torchscript", "static")]
+    assert service.model is candidate
+    assert service.drift_report["samples"] == 2
+    assert service.drift_report["max_drift"] < backend_config.max_cosine_drift
+    assert "fallback" not in service.drift_report
+
+
+def test_drifting_backend_falls_back_to_fp32_eager(service, backend_config, monkeypatch):
+    def candidate(batch):
+        return np.tile([0.0, 1.0, 0.0, 1.0], (len(batch), 1))
+    
+    builder = _load(service, monkeypatch, candidate)
+    
+    assert builder.built == [("torchscript", "static"), ("eager", "none")]
+    assert service.model == builder.baseline
+    assert service.drift_report["max_drift"] == pytest.approx(1.0)
+    assert service.drift_report["fallback"]
+    
+    # 统计信息报告实际使用的后端，配置值单独列出
+    stats = service.get_stats()
+    assert (stats["backend"], stats["quantization"]) == ("eager", "none")
+    assert (stats["configured_backend"], stats["configured_quantization"]) == ("torchscript", "static")
+
+
+@pytest.mark.parametrize("backend, quantization, device", [
+    ("tensorrt", "none", "cpu"),
+    ("eager", "int4", "cpu"),
+    ("eager", "dynamic", "cpu"),  # 动态量化只对 onnx 后端有意义
+    ("torchscript", "static", "cuda")  # INT8 模型只能在CPU上运行
+])
+def test_unsupported_backend_combinations_are_rejected(tmp_path, backend, quantization, device):
+    builder = InferenceBackendBuilder("resnet18", False, SimpleNamespace(type=device), str(tmp_path))
+    with pytest.raises(ValueError):
+        builder.build(backend, quantization)
+
+
+def test_onnx_export_is_redone_when_parameters_change(tmp_path, monkeypatch):
+    exports = []
+    
+    def fake_export(model, example, path, **kwargs):
+        exports.append(path)
+        open(path, 'wb').close()
+    
+    monkeypatch.setattr(backends_module, "build_backbone", lambda *args, **kwargs: None)
+    monkeypatch.setattr(backends_module.torch, "onnx", SimpleNamespace(export=fake_export))
+    
+    def export(pretrained=False, input_size=224):
+        builder = InferenceBackendBuilder("resnet18", pretrained, SimpleNamespace(type="cpu"),
+                                          str(tmp_path), input_size=input_size)
+        return builder._export_onnx("none")
+    
+    path = export()
+    assert export() == path
+    assert len(exports) == 1
+    
+    # 权重、输入尺寸或库版本变化时重新导出
+    export(pretrained=True)
+    export(pretrained=True, input_size=288)
+    monkeypatch.setattr(backends_module, "_package_version", lambda name: "99.0")
+    export(pretrained=True, input_size=288)
+    assert len(exports) == 4
+    export(pretrained=True, input_size=288)
+    assert len(exports) == 4
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""
+近邻表测试：查表结果与索引版本的一致性、增量合并
+"""
+
+import numpy as np
+import pytest
+
+from app.services.neighbor_table import NeighborTable
+
+
+class FakeFaissService:
+    def __init__(self, indexed_ids):
+        self.indexed = set(indexed_ids)
+        self.generation = 1
+        self.insert_generation = 1
+        self.scores_descending = True
+    
+    def contains_images(self, image_ids):
+        return np.array([int(image_id) in self.indexed for image_id in image_ids], dtype=bool)
+
+
+def _table(faiss_service, tmp_path, k=2) -> NeighborTable:
+    table = NeighborTable(faiss_service, str(tmp_path / "neighbors"), k=k)
+    table._table = (
+        np.array([1, 2, 3], dtype=np.int64),
+        np.array([[2, 3], [1, 3], [1, 2]], dtype=np.int64),
+        np.array([[0.9, 0.5], [0.9, 0.4], [0.5, 0.4]], dtype=np.float32)
+    )
+    table._generation = faiss_service.generation
+    return table
+
+
+def test_lookup_hits_current_table(tmp_path):
+    table = _table(FakeFaissService([1, 2, 3]), tmp_path)
+    hits = table.lookup(1, 2)
+    assert [image_id for image_id, _ in hits] == [2, 3]
+    assert [score for _, score in hits] == pytest.approx([0.9, 0.5])
+    assert table.lookup(4, 2) is None
+    assert table.lookup(1, 3) is None
+
+
+def test_lookup_misses_after_insert(tmp_path):
+    faiss_service = FakeFaissService([1, 2, 3])
+    table = _table(faiss_service, tmp_path)
+    
+    # 新图像可能比表中的近邻更相似，刷新前不能查表
+    faiss_service.indexed.add(4)
+    faiss_service.generation = faiss_service.insert_generation = 2
+    assert table.lookup(1, 2) is None
+    assert not table.covers_inserts()
+
+
+def test_lookup_filters_deleted_neighbors(tmp_path):
+    faiss_service = FakeFaissService([1, 2, 3])
+    table = _table(faiss_service, tmp_path)
+    
+    # 只有删除时表仍然可用，已删除的近邻被过滤，剩余近邻不足k个时回退
+    faiss_service.indexed.discard(3)
+    faiss_service.generation = 2
+    assert table.covers_inserts()
+    assert table.lookup(1, 1) == [(2, pytest.approx(0.9))]
+    assert table.lookup(1, 2) is None
+
+
+def test_merge_inserts_new_neighbors_in_score_order(tmp_path):
+    table = _table(FakeFaissService([1, 2, 3, 4]), tmp_path)
+    ids, neighbors, scores = table._table
+    kept = (ids, neighbors.copy(), scores.copy())
+    inserted = (np.array([1, 3]), np.array([[4], [4]]), np.array([[0.7], [0.1]], dtype=np.float32))
+    recomputed = (np.array([4]), np.array([[1, 2]]), np.array([[0.7, 0.3]], dtype=np.float32))
+    
+    merged_ids, merged_neighbors, _ = table._merge(kept, inserted, recomputed)
+    assert merged_ids.tolist() == [1, 2, 3, 4]
+    assert merged_neighbors.tolist() == [[2, 4], [1, 3], [1, 2], [1, 2]]
\ No newline at end of file
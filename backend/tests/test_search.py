@@ -0,0 +1,81 @@
+"""
+搜索接口测试：结果缓存命中后图片详情仍从数据库读取
+"""
+
+import asyncio
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.api.endpoints.search import search_by_content
+from app.core.database import Base
+from app.models.image import Image
+from app.models.user import User
+from app.services.result_cache import SearchResultCache
+
+
+class FakeModelService:
+    def __init__(self):
+        self.calls = 0
+    
+    async def extract_features(self, image_input):
+        self.calls += 1
+        return np.ones(4, dtype=np.float32)
+
+
+class FakeFaissService:
+    """索引内容不变，版本号保持不变"""
+    generation = 1
+    
+    def __init__(self):
+        self.searches = 0
+    
+    async def search(self, query_vector, k, nprobe=None, ef_search=None):
+        self.searches += 1
+        return [0.9, 0.8], [1, 2]
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine, tables=[User.__table__, Image.__table__])
+    session = sessionmaker(bind=engine)()
+    for image_id in (1, 2):
+        session.add(Image(
+            id=image_id, filename=f"{image_id}.jpg", original_name=f"{image_id}.jpg",
+            file_path=f"{image_id}.jpg", file_size=1, hash_value=str(image_id)
+        ))
+    session.commit()
+    yield session
+    session.close()
+
+
+def _search(db, model_service, faiss_service, result_cache):
+    return asyncio.run(search_by_content(
+        b"query", 10, None, None, db, model_service, faiss_service, None, None, result_cache
+    ))
+
+
+def test_cached_hits_are_hydrated_from_database(db):
+    model_service, faiss_service = FakeModelService(), FakeFaissService()
+    result_cache = SearchResultCache()
+    results, cache_hit = _search(db, model_service, faiss_service, result_cache)
+    assert not cache_hit
+    assert [result["image"]["original_name"] for result in results] == ["1.jpg", "2.jpg"]
+    
+    # 修改图片信息、停用未入索引的图片都不改变索引版本
+    db.query(Image).filter(Image.id == 1).update({Image.original_name: "renamed.jpg"})
+    db.query(Image).filter(Image.id == 2).update({Image.is_active: False})
+    db.commit()
+    
+    results, cache_hit = _search(db, model_service, faiss_service, result_cache)
+    assert cache_hit
+    assert model_service.calls == 1 and faiss_service.searches == 1
+    assert [result["image"]["original_name"] for result in results] == ["renamed.jpg"]
+    assert results[0]["similarity"] == 0.9
\ No newline at end of file
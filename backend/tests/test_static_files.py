@@ -0,0 +1,83 @@
+"""
+静态文件服务测试：缓存头、条件请求、Range 请求、预压缩文件、禁止访问的目录
+"""
+
+import gzip
+
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Mount
+from starlette.testclient import TestClient
+
+from app.utils.static_files import CachedStaticFiles
+
+CONTENT_HASH = "0123456789abcdef0123456789abcdef"
+
+
+@pytest.fixture
+def static_dir(tmp_path):
+    (tmp_path / "ab").mkdir()
+    (tmp_path / "ab" / f"{CONTENT_HASH}.jpg").write_bytes(b"0123456789")
+    (tmp_path / "thumbnails").mkdir()
+    (tmp_path / "thumbnails" / "a_thumb.webp").write_bytes(b"thumb")
+    (tmp_path / "info.txt").write_text("plain " * 100, encoding='utf-8')
+    (tmp_path / "info.txt.gz").write_bytes(gzip.compress(b"plain " * 100))
+    (tmp_path / "analysis").mkdir()
+    (tmp_path / "analysis" / "a.webp").write_bytes(b"analysis")
+    (tmp_path / ".incoming").mkdir()
+    (tmp_path / ".incoming" / "tmp1.part").write_bytes(b"partial")
+    return tmp_path
+
+
+def _client(static_dir, **kwargs) -> TestClient:
+    app = Starlette(routes=[Mount("/static", CachedStaticFiles(
+        directory=str(static_dir), derived_max_age=60, default_max_age=30,
+        derived_dirs=("thumbnails",), denied_dirs=("analysis",), **kwargs
+    ))])
+    return TestClient(app)
+
+
+def test_content_addressed_file_is_immutable_and_revalidated_by_hash(static_dir):
+    client = _client(static_dir)
+    response = client.get(f"/static/ab/{CONTENT_HASH}.jpg")
+    
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert response.headers["etag"] == f'"{CONTENT_HASH}"'
+    
+    response = client.get(f"/static/ab/{CONTENT_HASH}.jpg", headers={"if-none-match": f'"{CONTENT_HASH}"'})
+    assert response.status_code == 304
+
+
+def test_derived_and_other_files_use_short_max_age(static_dir):
+    client = _client(static_dir)
+    assert client.get("/static/thumbnails/a_thumb.webp").headers["cache-control"] == "public, max-age=60"
+    
+    response = client.get("/static/info.txt", headers={"accept-encoding": "identity"})
+    assert response.headers["cache-control"] == "public, max-age=30"
+    assert "content-encoding" not in response.headers
+
+
+def test_range_request_returns_partial_content(static_dir):
+    response = _client(static_dir).get(f"/static/ab/{CONTENT_HASH}.jpg", headers={"range": "bytes=2-5"})
+    assert response.status_code == 206
+    assert response.content == b"2345"
+
+
+def test_precompressed_variant_is_served_when_accepted(static_dir):
+    response = _client(static_dir).get("/static/info.txt", headers={"accept-encoding": "br, gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.text == "plain " * 100
+
+
+def test_sendfile_header_delegates_body_to_proxy(static_dir):
+    client = _client(static_dir, sendfile_header="X-Accel-Redirect")
+    response = client.get(f"/static/ab/{CONTENT_HASH}.jpg")
+    assert response.headers["x-accel-redirect"] == f"/_protected_static/ab/{CONTENT_HASH}.jpg"
+    assert response.content == b""
+
+
+@pytest.mark.parametrize("path", ["analysis/a.webp", ".incoming/tmp1.part", "ab/../.incoming/tmp1.part"])
+def test_denied_and_hidden_paths_are_not_served(static_dir, path):
+    assert _client(static_dir).get(f"/static/{path}").status_code == 404
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""
+图片URL下载器测试：通过 httpx.MockTransport 模拟远端服务器
+"""
+
+import asyncio
+import os
+
+import httpx
+import pytest
+
+from app.services.url_fetcher import FetchError, UrlFetcher
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\0" * 56
+
+
+def _fetcher(handler, **kwargs) -> UrlFetcher:
+    kwargs.setdefault("max_bytes", 1024)
+    return UrlFetcher(transport=httpx.MockTransport(handler), **kwargs)
+
+
+def _run(fetcher: UrlFetcher, coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await fetcher.cleanup()
+    return asyncio.run(main())
+
+
+async def _fetch(fetcher: UrlFetcher, url: str) -> dict:
+    async with fetcher.fetch(url) as fetched:
+        with open(fetched["path"], "rb") as f:
+            return dict(fetched, body=f.read())
+
+
+def test_download_is_cached():
+    requests = []
+    
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, content=PNG, headers={"content-type": "image/png"})
+    
+    fetcher = _fetcher(handler)
+    
+    async def main():
+        first = await _fetch(fetcher, "http://img.test/a.png")
+        second = await _fetch(fetcher, "http://img.test/a.png")
+        return first, second
+    
+    first, second = _run(fetcher, main())
+    assert first["body"] == PNG and first["size"] == len(PNG)
+    assert second["path"] == first["path"]
+    assert len(requests) == 1
+    assert fetcher.get_stats()["cache_hits"] == 1
+    assert not os.path.exists(first["path"])
+
+
+@pytest.mark.parametrize("response, message", [
+    (httpx.Response(404), "状态码"),
+    (httpx.Response(200, content=b"<html></html>", headers={"content-type": "text/html"}), "图片文件"),
+    (httpx.Response(200, content=b"GIF89a" + b"\0" * 10, headers={"content-type": "image/gif"}), "格式"),
+    (httpx.Response(200, content=b"not an image at all", headers={"content-type": "image/png"}), "格式"),
+    (httpx.Response(200, content=PNG * 100, headers={"content-type": "image/png"}), "大小"),
+])
+def test_rejected_responses(response, message):
+    fetcher = _fetcher(lambda request: response, allowed_extensions=["png", "jpg"])
+    with pytest.raises(FetchError, match=message):
+        _run(fetcher, _fetch(fetcher, "http://img.test/bad"))
+    assert fetcher.get_stats()["rejected"] == 1
+
+
+def test_streamed_body_over_limit_is_aborted():
+    async def stream():
+        yield PNG
+        for _ in range(100):
+            yield b"\0" * 256
+    
+    # 没有 Content-Length 时按累计大小中止，已写入的临时文件被删除
+    fetcher = _fetcher(lambda request: httpx.Response(200, content=stream(), headers={"content-type": "image/png"}))
+    
+    async def main():
+        with pytest.raises(FetchError, match="大小"):
+            await _fetch(fetcher, "http://img.test/huge")
+        return os.listdir(fetcher.cache_dir)
+    
+    assert _run(fetcher, main()) == []
+
+
+def test_redirect_limit():
+    def handler(request):
+        return httpx.Response(302, headers={"location": f"{request.url}x"})
+    
+    fetcher = _fetcher(handler, max_redirects=3)
+    with pytest.raises(FetchError):
+        _run(fetcher, _fetch(fetcher, "http://img.test/loop"))
+
+
+def test_stale_entry_revalidated_with_etag():
+    statuses = []
+    
+    def handler(request):
+        if request.headers.get("if-none-match") == '"v1"':
+            statuses.append(304)
+            return httpx.Response(304)
+        statuses.append(200)
+        return httpx.Response(200, content=PNG, headers={"content-type": "image/png", "etag": '"v1"'})
+    
+    fetcher = _fetcher(handler)
+    
+    async def main():
+        first = await _fetch(fetcher, "http://img.test/a.png")
+        fetcher._cache["http://img.test/a.png"]["expires_at"] = 0
+        second = await _fetch(fetcher, "http://img.test/a.png")
+        return first, second
+    
+    first, second = _run(fetcher, main())
+    assert statuses == [200, 304]
+    assert second["path"] == first["path"] and second["body"] == PNG
+    assert fetcher.get_stats()["revalidated"] == 1
+
+
+def test_per_host_concurrency_limit():
+    active = {"img.test": 0, "other.test": 0}
+    peak = dict(active)
+    
+    async def handler(request):
+        host = request.url.host
+        active[host] += 1
+        peak[host] = max(peak[host], active[host])
+        await asyncio.sleep(0.02)
+        active[host] -= 1
+        return httpx.Response(200, content=PNG, headers={"content-type": "image/png"})
+    
+    fetcher = _fetcher(handler, max_per_host=2, cache_max_entries=0)
+    
+    async def main():
+        urls = [f"http://img.test/{i}.png" for i in range(6)] + [f"http://other.test/{i}.png" for i in range(2)]
+        await asyncio.gather(*[_fetch(fetcher, url) for url in urls])
+    
+    _run(fetcher, main())
+    assert peak == {"img.test": 2, "other.test": 2}
+    assert fetcher.get_stats()["active_hosts"] == 0
+
+
+def test_entry_evicted_while_in_use_keeps_file():
+    fetcher = _fetcher(
+        lambda request: httpx.Response(200, content=PNG, headers={"content-type": "image/png"}),
+        cache_max_entries=1
+    )
+    
+    async def main():
+        async with fetcher.fetch("http://img.test/a.png") as first:
+            await _fetch(fetcher, "http://img.test/b.png")
+            # a 已被淘汰，但仍在使用中，文件保留到上下文退出
+            assert "http://img.test/a.png" not in fetcher._cache
+            assert os.path.exists(first["path"])
+        assert not os.path.exists(first["path"])
+    
+    _run(fetcher, main())
\ No newline at end of file
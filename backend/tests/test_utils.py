@@ -0,0 +1,115 @@
+"""
+工具模块测试：读写锁、微批处理、搜索结果缓存
+"""
+
+import asyncio
+import threading
+import time
+
+from app.services.result_cache import SearchResultCache
+from app.utils.batcher import MicroBatcher
+from app.utils.rwlock import RWLock
+
+
+def test_rwlock_allows_concurrent_readers():
+    lock = RWLock()
+    inside = threading.Barrier(3, timeout=2)
+    
+    def reader():
+        with lock.read():
+            inside.wait()
+    
+    threads = [threading.Thread(target=reader) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(2)
+    assert not any(thread.is_alive() for thread in threads)
+    assert lock.readers == 0
+
+
+def test_rwlock_waiting_writer_blocks_new_readers():
+    lock = RWLock()
+    events = []
+    lock.acquire_read()
+    
+    def writer():
+        with lock.write():
+            events.append("write")
+    
+    def late_reader():
+        with lock.read():
+            events.append("read")
+    
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.start()
+    while not lock._waiting_writers:
+        time.sleep(0.001)
+    reader_thread = threading.Thread(target=late_reader)
+    reader_thread.start()
+    time.sleep(0.05)
+    assert events == []
+    
+    # 写者优先：释放读锁后写者先于后到的读者执行
+    lock.release_read()
+    writer_thread.join(2)
+    reader_thread.join(2)
+    assert events == ["write", "read"]
+
+
+def test_batcher_merges_concurrent_requests_by_key():
+    batches = []
+    
+    async def run_batch(key, items):
+        batches.append((key, list(items)))
+        return [item * 10 for item in items]
+    
+    async def main():
+        batcher = MicroBatcher(run_batch, max_batch_size=3, max_wait_ms=20)
+        results = await asyncio.gather(
+            *[batcher.submit(i, key="a") for i in range(4)],
+            batcher.submit(100, key="b")
+        )
+        return results, batcher.get_stats()
+    
+    results, stats = asyncio.run(main())
+    assert results == [0, 10, 20, 30, 1000]
+    # 达到 max_batch_size 立即处理，剩余请求等待超时后成批
+    assert sorted(batches) == [("a", [0, 1, 2]), ("a", [3]), ("b", [100])]
+    assert stats["total_batches"] == 3 and stats["total_items"] == 5
+
+
+def test_batcher_propagates_errors_to_every_caller():
+    async def run_batch(key, items):
+        raise ValueError("boom")
+    
+    async def main():
+        batcher = MicroBatcher(run_batch, max_batch_size=8, max_wait_ms=1)
+        return await asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True)
+    
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_result_cache_checks_generation_and_ttl(monkeypatch):
+    cache = SearchResultCache(max_entries=2, ttl_seconds=10)
+    cache.put("a", 1, "result-a")
+    assert cache.get("a", 1) == "result-a"
+    # 索引版本变化后条目失效
+    assert cache.get("a", 2) is None
+    assert cache.get("a", 1) is None
+    
+    cache.put("b", 1, "result-b")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 11)
+    assert cache.get("b", 1) is None
+    assert cache.get_stats()["stale"] == 2
+
+
+def test_result_cache_lru_eviction():
+    cache = SearchResultCache(max_entries=2)
+    for key in "abc":
+        cache.put(key, 0, key)
+    assert cache.get("a", 0) is None
+    assert cache.get("c", 0) == "c"
+    assert cache.get_stats()["evictions"] == 1
@@ -33,12 +33,22 @@ CREATE TABLE IF NOT EXISTS images (
     tags JSON,
     description TEXT,
     is_active BOOLEAN DEFAULT TRUE,
+    index_status VARCHAR(16) NOT NULL DEFAULT 'indexed',  -- pending/indexing/indexed/failed
+    index_attempts INT NOT NULL DEFAULT 0,
+    index_error VARCHAR(500),
     INDEX idx_faiss_id (faiss_id),
     INDEX idx_hash_value (hash_value),
     INDEX idx_upload_time (upload_time),
+    INDEX idx_index_status (index_status),
     FOREIGN KEY (upload_by) REFERENCES users(id) ON DELETE SET NULL
 );
 
+-- 已有数据库升级（新增索引状态字段）
+-- ALTER TABLE images
+--     ADD COLUMN index_status VARCHAR(16) NOT NULL DEFAULT 'indexed',
+--     ADD COLUMN index_attempts INT NOT NULL DEFAULT 0,
+--     ADD COLUMN index_error VARCHAR(500),
+--     ADD INDEX idx_index_status (index_status);
 
 
 -- Faiss索引信息表